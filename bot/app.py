@@ -0,0 +1,65 @@
+import os
+import django
+
+from django.conf import settings
+
+# Bot modules use the models, so they are imported once Django is set up
+
+
+async def post_stop(application):
+    """
+    Lets the background tasks finish once the in-flight updates
+    have been processed, then writes the buffered records.
+    """
+
+    from bot.database import write_buffer
+    from bot.tasks import task_queue
+
+    await task_queue.stop(settings.TASK_SHUTDOWN_TIMEOUT)
+    await write_buffer.aflush()
+
+
+async def post_shutdown(application):
+    """
+    Closes the HTTP sessions of the OpenAI and article clients.
+    """
+
+    from bot import articles
+    from bot.helpers import close_openai_session
+
+    await close_openai_session()
+    await articles.close_session()
+
+
+def run(application, **kwargs):
+    """
+    Polls Telegram for updates and processes up to
+    `BOT_CONCURRENT_UPDATES` of them concurrently until a stop signal
+    is received. On shutdown the updates being processed and the queued
+    background tasks are allowed to finish.
+
+    :param application: The Application to run.
+    :param kwargs: Extra arguments of `Application.run_polling`.
+    """
+
+    application.post_stop = post_stop
+    application.post_shutdown = post_shutdown
+    application.run_polling(**kwargs)
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+    from bot.bot import application
+    from bot.helpers import logger
+
+    logger.info(
+        'Polling for updates, up to %s at a time',
+        settings.BOT_CONCURRENT_UPDATES
+    )
+    run(application)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import asyncio
+import aiohttp
+import weakref
+import trafilatura
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from trafilatura.settings import use_config
+from django.conf import settings
+
+from bot.cache import TTLCache
+
+
+USER_AGENT = 'Mozilla/5.0 (compatible; FluentMindBot/1.0)'
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid', 'yclid')
+
+# To disable signal in trafilatura
+config = use_config()
+config.set("DEFAULT", "EXTRACTION_TIMEOUT", "0")
+
+# Pooled HTTP sessions for fetching articles, one per event loop
+sessions = weakref.WeakKeyDictionary()
+
+# Extracted content and summary of articles by normalized URL
+article_cache = TTLCache(
+    'article_cache', settings.ARTICLE_CACHE_SIZE, settings.ARTICLE_CACHE_TTL
+)
+
+
+class ArticleFetchError(Exception):
+    """
+    Raised when an article can't be downloaded or has no text.
+    """
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalizes a URL so that the same article is cached once:
+    lowercases the scheme and host, drops the default port, the fragment
+    and tracking parameters, and sorts the query parameters.
+    A malformed URL raises ArticleFetchError.
+
+    :param url: The URL to normalize.
+    :return: The normalized URL.
+    """
+
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError as error:
+        raise ArticleFetchError(f'Invalid URL {url}: {error!r}')
+
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+
+    if port and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+
+    query = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not name.lower().startswith(TRACKING_PARAMS)
+    )
+
+    return urlunsplit(
+        (scheme, host, parts.path or '/', urlencode(query), '')
+    )
+
+
+def get_session():
+    """
+    Returns the pooled HTTP session used for fetching articles
+    in the running event loop, creating it on first use.
+
+    :return: An aiohttp ClientSession.
+    """
+
+    loop = asyncio.get_running_loop()
+    session = sessions.get(loop)
+
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.ARTICLE_MAX_CONNECTIONS
+            ),
+            headers={'User-Agent': USER_AGENT}
+        )
+        sessions[loop] = session
+
+    return session
+
+
+async def close_session():
+    """
+    Closes the pooled article HTTP session of the running event loop.
+    """
+
+    session = sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def fetch_url(url: str) -> str:
+    """
+    Downloads a page, giving up after `ARTICLE_FETCH_TIMEOUT` seconds
+    or `ARTICLE_MAX_SIZE` bytes.
+
+    :param url: The URL of the page.
+    :return: The decoded page.
+    """
+
+    max_size = settings.ARTICLE_MAX_SIZE
+    timeout = aiohttp.ClientTimeout(total=settings.ARTICLE_FETCH_TIMEOUT)
+
+    try:
+        async with get_session().get(url, timeout=timeout) as response:
+            response.raise_for_status()
+
+            if (response.content_length or 0) > max_size:
+                raise ArticleFetchError(f'Page is too large: {url}')
+
+            body = await response.content.read(max_size + 1)
+            if len(body) > max_size:
+                raise ArticleFetchError(f'Page is too large: {url}')
+
+            # Pages without a charset in Content-Type are read as UTF-8
+            encoding = response.charset or 'utf-8'
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+        raise ArticleFetchError(f'Failed to fetch {url}: {error!r}')
+
+    return decode_page(body, encoding)
+
+
+def decode_page(body: bytes, encoding: str) -> str:
+    """
+    Decodes a downloaded page, falling back to UTF-8
+    if its encoding is unknown.
+    """
+
+    try:
+        return body.decode(encoding, errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+
+async def get_article(url: str) -> dict:
+    """
+    Gets the cached entry of an article, downloading the page and
+    extracting its main text on a cache miss. Callers may store derived
+    data, such as the summary, in the entry.
+
+    :param url: The URL of the article.
+    :return: A dictionary with the extracted `content` of the article.
+    """
+
+    key = normalize_url(url)
+    article = article_cache.get(key)
+
+    if article is None:
+        downloaded = await fetch_url(url)
+        content = await asyncio.to_thread(
+            trafilatura.extract, downloaded, config=config
+        )
+        if not content:
+            raise ArticleFetchError(f'No text found: {url}')
+
+        article = {'content': content}
+        article_cache.set(key, article)
+
+    return article
@@ -1,15 +1,29 @@
+import atexit
+import asyncio
+import threading
+
 from django.conf import settings
 
 from telegram import Update
-from telegram.ext import Application, MessageHandler, CommandHandler, filters
+from telegram.ext import (
+    Application, MessageHandler, CommandHandler, TypeHandler, filters
+)
 
-from bot import handlers
+from bot import articles, handlers, ratelimit
+from bot.database import write_buffer
+from bot.helpers import close_openai_session
+from bot.tasks import task_queue
 
 
 TOKEN = settings.TELEGRAM_BOT_TOKEN
 # API_KEY = settings.OPENAI_API_KEY
 
-application = Application.builder().token(TOKEN).build()
+application = Application.builder().token(TOKEN).concurrent_updates(
+    settings.BOT_CONCURRENT_UPDATES
+).build()
+
+# Admission control runs before the handlers and stops rate limited updates
+application.add_handler(TypeHandler(Update, ratelimit.check_admission), -1)
 
 application.add_handler(CommandHandler('start', handlers.start))
 application.add_handler(CommandHandler('help', handlers.help))
@@ -24,11 +38,146 @@ application.add_handler(MessageHandler(
     handlers.chat)
                         )
 application.add_handler(MessageHandler(filters.COMMAND, handlers.unknown))
-# application.add_error_handler(handlers.error_handler)
+application.add_error_handler(handlers.error_handler)
+
+task_queue.bot = application.bot
+
+# Long-lived event loop of the worker process. The application is
+# initialized on it once and then reused for every incoming update.
+_loop = None
+_loop_lock = threading.Lock()
+
+# Guards starting the application inside the ASGI server's event loop.
+_start_lock = asyncio.Lock()
 
 
 async def run(data):
+    """
+    Processes a single update with a fully initialized and shut down
+    application. Kept for one-off scripts; the webhook uses `process`.
+    """
+
     async with application:
         await application.process_update(
             Update.de_json(data=data, bot=application.bot)
         )
+        await task_queue.stop(settings.TASK_SHUTDOWN_TIMEOUT)
+        await write_buffer.aflush()
+
+
+async def process_update(data):
+    """
+    Processes a single update with the already initialized application.
+    """
+
+    await application.process_update(
+        Update.de_json(data=data, bot=application.bot)
+    )
+
+
+async def enqueue(data):
+    """
+    Puts an update to the application's update queue and returns
+    immediately. The update is processed in the background.
+
+    On first use initializes and starts the application in the running
+    event loop, so it must be awaited from the ASGI server's loop.
+
+    :param data: The update data received from Telegram.
+    """
+
+    if not application.running:
+        async with _start_lock:
+            if not application.running:
+                await application.initialize()
+                await application.start()
+
+    await application.update_queue.put(
+        Update.de_json(data=data, bot=application.bot)
+    )
+
+
+async def stop():
+    """
+    Stops the application started by `enqueue` once the queued updates
+    are processed, lets the background tasks finish and closes the
+    sessions. Awaited from the ASGI server's loop on shutdown.
+    """
+
+    if application.running:
+        await application.stop()
+
+    await _shutdown()
+
+
+def get_event_loop():
+    """
+    Returns the persistent event loop of the worker process.
+
+    On first use starts the loop in a background thread and initializes
+    the application on it, so the bot and its HTTP connection pool live
+    for the life of the process.
+
+    :return: The running event loop.
+    """
+
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever,
+                name='bot-event-loop',
+                daemon=True
+            ).start()
+
+            try:
+                asyncio.run_coroutine_threadsafe(
+                    application.initialize(), loop
+                ).result()
+            except Exception:
+                loop.call_soon_threadsafe(loop.stop)
+                raise
+
+            _loop = loop
+            atexit.register(shutdown)
+
+    return _loop
+
+
+def process(data):
+    """
+    Feeds an update to the persistent application and waits
+    until it is processed.
+
+    :param data: The update data received from Telegram.
+    """
+
+    loop = get_event_loop()
+    future = asyncio.run_coroutine_threadsafe(process_update(data), loop)
+    future.result()
+
+
+async def _shutdown():
+    await task_queue.stop(settings.TASK_SHUTDOWN_TIMEOUT)
+    await write_buffer.aflush()
+    await application.shutdown()
+    await close_openai_session()
+    await articles.close_session()
+
+
+def shutdown():
+    """
+    Shuts down the application and stops the persistent event loop.
+    """
+
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(_shutdown(), _loop).result()
+        _loop.call_soon_threadsafe(_loop.stop)
+        _loop = None
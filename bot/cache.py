@@ -0,0 +1,111 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+from bot import metrics
+
+
+class TTLCache:
+    """
+    A bounded least recently used cache whose entries expire
+    `ttl` seconds after they were set.
+
+    Hits and misses are counted in metrics as `<name>.hits` and
+    `<name>.misses`, the number of entries as `<name>.size`.
+
+    :param name: The name of the cache used in metrics.
+    :param maxsize: The maximum number of entries.
+    :param ttl: The lifetime of an entry in seconds.
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get(key) is not None
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return item
+
+    def get(self, key, default=None):
+        """
+        Returns the value for the key if it is cached and not expired.
+        """
+
+        with self._lock:
+            item = self._get(key)
+
+            if item is None:
+                self.misses += 1
+                metrics.increment(f'{self.name}.misses')
+                return default
+
+            self.hits += 1
+            metrics.increment(f'{self.name}.hits')
+            return item[1]
+
+    def peek(self, key, default=None):
+        """
+        Returns the value for the key like `get`, without counting
+        a hit or miss and without refreshing its recency.
+        """
+
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= time.monotonic():
+                return default
+            return item[1]
+
+    def set(self, key, value):
+        """
+        Caches the value for the key, evicting the least recently
+        used entries if the cache is full.
+        """
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+            metrics.set_gauge(f'{self.name}.size', len(self._data))
+
+    def delete(self, key):
+        """
+        Removes the key from the cache if it is there.
+        """
+
+        with self._lock:
+            self._data.pop(key, None)
+            metrics.set_gauge(f'{self.name}.size', len(self._data))
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+
+        with self._lock:
+            self._data.clear()
+            metrics.set_gauge(f'{self.name}.size', 0)
@@ -1,12 +1,226 @@
+import atexit
+import asyncio
+import logging
+import threading
+
+from collections import Counter
+from datetime import timedelta
+
 from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
 
-from chats.models import Text, Chat
+from chats.models import Text, Chat, Usage
+from bot import metrics
+from bot.models import Job
+from bot.cache import TTLCache
+from bot.llm import get_cost
+from bot.tokens import num_tokens_from_string
 
 
-@sync_to_async
-def get_or_create_chat(telegram_id, create_new_chat=False):
+HISTORY_PAGE_SIZE = 50
+
+logger = logging.getLogger(__name__)
+
+# Current chat of each user by Telegram ID
+chat_cache = TTLCache(
+    'chat_cache', settings.CHAT_CACHE_SIZE, settings.CHAT_CACHE_TTL
+)
+
+
+class WriteBuffer:
+    """
+    A write-behind buffer of recorded exchanges.
+
+    Text rows, the last update of their chats and the usage of the
+    requests are kept in memory and written in a single transaction with
+    `bulk_create` and `bulk_update` once `max_rows` rows are collected,
+    or `interval` seconds after the flush was scheduled. Reads of the
+    process see its buffered rows, but other processes don't, so it may
+    only be used where every chat is served by a single process.
+
+    The number of buffered rows is tracked in metrics as
+    `write_buffer.size`, written rows as `write_buffer.flushed` and
+    failed flushes as `write_buffer.errors`.
+
+    :param max_rows: The number of rows that triggers a flush.
+    :param interval: The maximum delay of a flush in seconds.
+    """
+
+    def __init__(self, max_rows, interval):
+        self.max_rows = max_rows
+        self.interval = interval
+        self.texts = []
+        self.touches = {}
+        self.usage = {}
+        # Rows being written, still visible to readers until committed
+        self.flushing = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        self._timer_loop = None
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, text, kind, usage):
+        """
+        Buffers an unsaved Text instance along with the usage
+        of its request.
+
+        :param text: The Text instance.
+        :param kind: The kind of the request, see `add_usage`.
+        :param usage: The keyword arguments of `add_usage`.
+        :return: True if the buffer is full and must be flushed.
+        """
+
+        with self._lock:
+            self.texts.append(text)
+            self.touches[text.chat_id] = text.date
+            key = (text.telegram_id, timezone.localdate(), kind)
+            self.usage.setdefault(key, Counter()).update(requests=1, **usage)
+            metrics.set_gauge('write_buffer.size', len(self.texts))
+
+            return len(self.texts) >= self.max_rows
+
+    def pending(self, telegram_id, chat):
+        """
+        Returns the buffered Text instances of a chat, oldest first.
+        """
+
+        with self._lock:
+            texts = self.flushing + self.texts
+
+        return [
+            text for text in texts
+            if text.chat_id == chat.pk
+            and str(text.telegram_id) == str(telegram_id)
+        ]
+
+    def schedule(self):
+        """
+        Schedules a flush in the running event loop unless
+        one is already scheduled.
+        """
+
+        loop = asyncio.get_running_loop()
+        if self._timer is not None and self._timer_loop is loop:
+            return
+
+        self._timer_loop = loop
+        self._timer = loop.call_later(self.interval, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_loop.create_task(self.aflush())
+
+    def flush(self):
+        """
+        Writes the buffered rows to the database in a single transaction.
+        Rows of chats deleted in the meantime are dropped, rows that
+        could not be written are put back for the next flush.
+
+        :return: The number of written rows.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                texts, touches, usage = self.texts, self.touches, self.usage
+                self.texts, self.touches, self.usage = [], {}, {}
+                self.flushing = texts
+                metrics.set_gauge('write_buffer.size', 0)
+
+            if not texts:
+                return 0
+
+            try:
+                written = self._write(texts, touches, usage)
+            except Exception:
+                logger.exception('Failed to write %s buffered rows', len(texts))
+                metrics.increment('write_buffer.errors')
+                self._restore(texts, touches, usage)
+                return 0
+            finally:
+                with self._lock:
+                    self.flushing = []
+
+        metrics.increment('write_buffer.flushed', written)
+        return written
+
+    def _write(self, texts, touches, usage):
+        with transaction.atomic():
+            chat_ids = set(Chat.objects.filter(
+                pk__in=touches
+            ).values_list('pk', flat=True))
+            texts = [text for text in texts if text.chat_id in chat_ids]
+
+            Text.objects.bulk_create(texts)
+            Chat.objects.bulk_update([
+                Chat(pk=pk, last_update=last_update)
+                for pk, last_update in touches.items() if pk in chat_ids
+            ], ['last_update'])
+
+            for (telegram_id, date, kind), values in usage.items():
+                add_usage(telegram_id, kind, date=date, **values)
+
+        return len(texts)
+
+    def _restore(self, texts, touches, usage):
+        for text in texts:
+            text.pk = None
+            text._state.adding = True
+
+        with self._lock:
+            self.texts[:0] = texts
+            # Touches buffered in the meantime are more recent
+            for pk, last_update in touches.items():
+                self.touches.setdefault(pk, last_update)
+            for key, values in usage.items():
+                self.usage.setdefault(key, Counter()).update(values)
+            metrics.set_gauge('write_buffer.size', len(self.texts))
+
+    async def aflush(self):
+        """
+        Writes the buffered rows asynchronously, see `flush`.
+        """
+
+        return await sync_to_async(self.flush)()
+
+
+write_buffer = WriteBuffer(
+    settings.WRITE_BUFFER_SIZE, settings.WRITE_BUFFER_INTERVAL
+)
+atexit.register(write_buffer.flush)
+
+
+async def get_or_create_chat(telegram_id, create_new_chat=False):
     """
     Gets or creates a chat instance.
+    The user's current chat is served from `chat_cache` when possible.
+
+    :param telegram_id: The user's Telegram ID.
+    :param create_new_chat: A boolean indicating whether to create
+    a new chat instance.
+    :return: A Chat instance.
+    """
+
+    if not create_new_chat:
+        chat = chat_cache.get(str(telegram_id))
+        if chat is not None:
+            return chat
+
+    chat = await fetch_or_create_chat(telegram_id, create_new_chat)
+    chat_cache.set(str(telegram_id), chat)
+
+    return chat
+
+
+@sync_to_async
+def fetch_or_create_chat(telegram_id, create_new_chat=False):
+    """
+    Gets or creates a chat instance in the database.
 
     :param telegram_id: The user's Telegram ID.
     :param create_new_chat: A boolean indicating whether to create
@@ -25,10 +239,23 @@ def get_or_create_chat(telegram_id, create_new_chat=False):
     return chat
 
 
+def invalidate_chat(chat):
+    """
+    Removes the chat from `chat_cache` if it is the cached current chat.
+
+    :param chat: The Chat instance to invalidate.
+    """
+
+    cached_chat = chat_cache.peek(str(chat.telegram_id))
+    if cached_chat is not None and cached_chat.pk == chat.pk:
+        chat_cache.delete(str(chat.telegram_id))
+
+
 @sync_to_async
 def get_messages_count(telegram_id, chat):
     """
-    Gets the number of messages in the specified chat.
+    Gets the number of messages in the specified chat,
+    including those still in the write buffer.
     """
 
     count = Text.objects.filter(
@@ -36,27 +263,176 @@ def get_messages_count(telegram_id, chat):
         chat=chat
         ).count()
 
-    return count
+    return count + len(write_buffer.pending(telegram_id, chat))
+
+
+def build_text(chat, **kwargs):
+    """
+    Builds a new unsaved Text instance with the provided kwargs.
+    Token counts of the request and response are stored along with it,
+    so the history never has to be tokenized again.
+
+    :param chat: The Chat instance the message belongs to.
+    :param kwargs: The keyword arguments to create the Text instance.
+    :return: The unsaved Text instance.
+    """
+
+    if 'request_tokens' not in kwargs:
+        kwargs['request_tokens'] = num_tokens_from_string(
+            kwargs.get('request', '')
+        )
+    if 'response_tokens' not in kwargs:
+        kwargs['response_tokens'] = num_tokens_from_string(
+            kwargs.get('response', '')
+        )
+    if 'total_tokens' not in kwargs and None not in (
+        kwargs.get('prompt_tokens'), kwargs.get('completion_tokens')
+    ):
+        kwargs['total_tokens'] = (
+            kwargs['prompt_tokens'] + kwargs['completion_tokens']
+        )
+
+    return Text(chat=chat, **kwargs)
+
+
+def create_text(chat, **kwargs):
+    """
+    Creates a new Text instance with the provided kwargs,
+    see `build_text`.
+
+    :param chat: The Chat instance the message belongs to.
+    :param kwargs: The keyword arguments to create the Text instance.
+    :return: The created Text instance.
+    """
+
+    text = build_text(chat, **kwargs)
+    text.save(force_insert=True)
+
+    return text
 
 
 @sync_to_async
 def create_message_entry(chat, **kwargs):
     """
-    Creates a new Text instance with the provided kwargs.
+    Creates a new Text instance asynchronously, see `create_text`.
+    """
+
+    return create_text(chat, **kwargs)
+
+
+async def record_exchange(chat, kind='chat', **kwargs):
+    """
+    Records a request and its response: creates the Text instance with
+    its cost, bumps the chat's last update and adds the request to the
+    user's usage.
+
+    With `WRITE_BUFFER_ENABLED` the records are collected in
+    `write_buffer` and written in bulk later, otherwise they are written
+    at once in a single transaction, see `save_exchange`.
+
+    :param chat: The Chat instance the message belongs to.
+    :param kind: The kind of the request in the usage, see `add_usage`.
+    :param kwargs: The keyword arguments to create the Text instance.
+    :return: The created Text instance, unsaved if it is buffered.
+    """
+
+    usage = {
+        'prompt_tokens': kwargs.get('prompt_tokens') or 0,
+        'completion_tokens': kwargs.get('completion_tokens') or 0,
+        'images': int(kind == 'img'),
+    }
+    kwargs.setdefault('cost', get_cost(**usage))
+
+    if settings.WRITE_BUFFER_ENABLED:
+        text = build_text(chat, **kwargs)
+        if write_buffer.add(text, kind, usage):
+            await write_buffer.aflush()
+        else:
+            write_buffer.schedule()
+    else:
+        text = await save_exchange(chat, kind, usage, **kwargs)
+
+    chat.last_update = text.date
+
+    return text
+
+
+@sync_to_async
+def save_exchange(chat, kind, usage, **kwargs):
+    """
+    Creates the Text instance, updates only the `last_update` column
+    of the chat and adds the request to the user's usage
+    in a single transaction.
 
     :param chat: The Chat instance the message belongs to.
+    :param kind: The kind of the request, see `add_usage`.
+    :param usage: The keyword arguments of `add_usage`.
     :param kwargs: The keyword arguments to create the Text instance.
     :return: The created Text instance.
     """
 
-    text = Text.objects.create(
-        chat=chat,
-        **kwargs
-        )
+    with transaction.atomic():
+        text = create_text(chat, **kwargs)
+        Chat.objects.filter(pk=chat.pk).update(last_update=text.date)
+        add_usage(kwargs['telegram_id'], kind, **usage)
 
     return text
 
 
+def add_usage(telegram_id, kind, prompt_tokens=0, completion_tokens=0,
+              images=0, requests=1, date=None):
+    """
+    Adds OpenAI requests to the user's usage of the day,
+    incrementing the counters of the day's row in place.
+
+    :param telegram_id: The user's Telegram ID.
+    :param kind: The kind of the request, one of `Usage.KIND_CHOICES`.
+    :param prompt_tokens: The number of prompt tokens.
+    :param completion_tokens: The number of completion tokens.
+    :param images: The number of generated images.
+    :param requests: The number of requests.
+    :param date: The day of the requests, today by default.
+    """
+
+    date = date or timezone.localdate()
+    values = {
+        'requests': requests,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'images': images,
+        'cost': get_cost(prompt_tokens, completion_tokens, images),
+    }
+    usage = Usage.objects.filter(
+        telegram_id=telegram_id, date=date, kind=kind
+    )
+    increments = {name: F(name) + value for name, value in values.items()}
+
+    if usage.update(**increments):
+        return
+
+    try:
+        with transaction.atomic():
+            Usage.objects.create(
+                telegram_id=telegram_id,
+                date=date,
+                kind=kind,
+                **values
+            )
+    except IntegrityError:
+        # Created by a concurrent request in the meantime
+        usage.update(**increments)
+
+
+@sync_to_async
+def record_usage(telegram_id, kind, **usage):
+    """
+    Adds an OpenAI request to the user's usage asynchronously,
+    see `add_usage`.
+    """
+
+    add_usage(telegram_id, kind, **usage)
+
+
 def get_message_objects(telegram_id, chat):
     """
     Gets the message objects for a specific chat.
@@ -75,6 +451,90 @@ def get_message_objects(telegram_id, chat):
     return messages
 
 
+def iter_message_objects(telegram_id, chat, page_size=HISTORY_PAGE_SIZE):
+    """
+    Iterates over the message objects of a specific chat, newest first,
+    skipping those already folded into the chat's memory.
+
+    Messages still in the write buffer come first. Rows are then fetched
+    lazily in pages of `page_size` with only the columns needed to build
+    the conversation history, so a consumer that stops early never loads
+    the rest of the chat.
+
+    :param telegram_id: The user's Telegram ID.
+    :param chat: The Chat instance to get the message objects from.
+    :param page_size: The number of rows fetched per query.
+    :return: An iterator over Text instances.
+    """
+
+    messages = get_message_objects(telegram_id, chat).order_by(
+        '-date', '-id'
+    ).only('request', 'response', 'request_tokens', 'response_tokens')
+
+    if chat.memory_date is not None:
+        messages = messages.filter(date__gt=chat.memory_date)
+
+    pending = get_pending_messages(telegram_id, chat)
+    yield from reversed(pending)
+
+    offset = 0
+    while True:
+        page = list(messages[offset:offset + page_size])
+        # Buffered messages written in the meantime were already yielded
+        flushed = {message.pk for message in pending}
+        yield from (message for message in page if message.pk not in flushed)
+
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+@sync_to_async
+def get_unfolded_messages(telegram_id, chat):
+    """
+    Gets the messages of a chat not yet folded into its memory.
+
+    :param telegram_id: The user's Telegram ID.
+    :param chat: The Chat instance to get the messages from.
+    :return: A list of Text instances, oldest first.
+    """
+
+    messages = get_message_objects(telegram_id, chat).order_by(
+        'date', 'id'
+    ).only(
+        'request', 'response', 'request_tokens', 'response_tokens', 'date'
+    )
+
+    if chat.memory_date is not None:
+        messages = messages.filter(date__gt=chat.memory_date)
+
+    messages = list(messages)
+    pending = get_pending_messages(telegram_id, chat)
+    flushed = {message.pk for message in pending}
+
+    return [
+        message for message in messages if message.pk not in flushed
+    ] + pending
+
+
+def get_pending_messages(telegram_id, chat):
+    """
+    Gets the text messages of a chat still in the write buffer,
+    skipping those already folded into the chat's memory.
+
+    :param telegram_id: The user's Telegram ID.
+    :param chat: The Chat instance to get the messages from.
+    :return: A list of unsaved Text instances, oldest first.
+    """
+
+    return [
+        message for message in write_buffer.pending(telegram_id, chat)
+        if message.content_type == 'text' and (
+            chat.memory_date is None or message.date > chat.memory_date
+        )
+    ]
+
+
 @sync_to_async
 def get_last_text_entry(telegram_id, chat):
     """
@@ -85,6 +545,10 @@ def get_last_text_entry(telegram_id, chat):
     :return: The last Text instance.
     """
 
+    # The entry is about to be changed, so it must be saved first
+    if write_buffer.pending(telegram_id, chat):
+        write_buffer.flush()
+
     last_text_entry = Text.objects.filter(
         telegram_id=telegram_id,
         chat=chat,
@@ -92,3 +556,88 @@ def get_last_text_entry(telegram_id, chat):
     ).order_by('-date').first()
 
     return last_text_entry
+
+
+@sync_to_async
+def get_chat(chat_id):
+    """
+    Gets a chat instance by its primary key.
+
+    :param chat_id: The primary key of the chat.
+    :return: A Chat instance or None if it doesn't exist.
+    """
+
+    return Chat.objects.filter(pk=chat_id).first()
+
+
+@sync_to_async
+def update_chat(telegram_id, chat_id, **fields):
+    """
+    Updates only the given fields of a chat, keeping the cached
+    current chat instance in sync.
+
+    :param telegram_id: The user's Telegram ID.
+    :param chat_id: The primary key of the chat.
+    :param fields: The field values to update.
+    """
+
+    Chat.objects.filter(pk=chat_id).update(**fields)
+
+    chat = chat_cache.peek(str(telegram_id))
+    if chat is not None and chat.pk == chat_id:
+        for name, value in fields.items():
+            setattr(chat, name, value)
+
+
+@sync_to_async
+def create_job(name, payload, attempts=0, delay=0, error='', failed=False):
+    """
+    Stores a background job in the database to be run later.
+
+    :param name: The name of the registered task.
+    :param payload: The keyword arguments of the task.
+    :param attempts: The number of attempts already made.
+    :param delay: The number of seconds to postpone the job for.
+    :param error: The error of the last attempt.
+    :param failed: Whether the job ran out of attempts and is kept
+    only for inspection.
+    :return: The created Job instance.
+    """
+
+    return Job.objects.create(
+        name=name,
+        payload=payload,
+        attempts=attempts,
+        last_error=error,
+        failed=failed,
+        run_after=timezone.now() + timedelta(seconds=delay)
+    )
+
+
+@sync_to_async
+def claim_jobs(limit):
+    """
+    Takes due jobs out of the database so that no other worker runs them.
+
+    The rows locked by another worker are skipped where the database
+    supports it, and a job is claimed only if this worker deleted its
+    row, so a job selected by two workers at once runs only once.
+
+    :param limit: The maximum number of jobs to claim.
+    :return: A list of claimed Job instances.
+    """
+
+    claimed = []
+
+    with transaction.atomic():
+        jobs = Job.objects.filter(
+            failed=False,
+            run_after__lte=timezone.now()
+        ).order_by('run_after').select_for_update(skip_locked=True)
+
+        for job in jobs[:limit]:
+            deleted, _ = Job.objects.filter(pk=job.pk).delete()
+            if deleted:
+                claimed.append(job)
+
+    return claimed
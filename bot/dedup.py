@@ -0,0 +1,137 @@
+import time
+
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from bot import metrics
+from bot.cache import TTLCache
+from bot.models import ReceivedUpdate
+
+
+# Seconds between deletions of the expired ReceivedUpdate rows
+PURGE_INTERVAL = 60 * 60
+
+# update_ids recently received by this process
+received_updates = TTLCache(
+    'received_updates',
+    settings.WEBHOOK_DEDUP_CACHE_SIZE,
+    settings.WEBHOOK_DEDUP_TTL
+)
+
+_next_purge = 0
+
+
+def mark_received(update_id):
+    """
+    Records an update as received.
+
+    The update_id is checked in memory first, then inserted into the
+    ReceivedUpdate table, whose primary key catches updates received
+    by another process. The update_id is remembered only once the row
+    is stored, so an update whose insert fails is still handled when
+    Telegram delivers it again.
+
+    :param update_id: The ID of the Telegram update.
+    :return: True if the update was received for the first time,
+    False if it is a redelivery.
+    """
+
+    if update_id in received_updates:
+        return False
+
+    try:
+        with transaction.atomic():
+            ReceivedUpdate.objects.create(update_id=update_id)
+    except IntegrityError:
+        received_updates.set(update_id, True)
+        return False
+
+    received_updates.set(update_id, True)
+    purge_expired()
+    return True
+
+
+def purge_expired():
+    """
+    Deletes the ReceivedUpdate rows older than `WEBHOOK_DEDUP_TTL`,
+    at most once every `PURGE_INTERVAL` seconds.
+    """
+
+    global _next_purge
+
+    now = time.monotonic()
+    if now < _next_purge:
+        return
+
+    _next_purge = now + PURGE_INTERVAL
+    expired = timezone.now() - timedelta(seconds=settings.WEBHOOK_DEDUP_TTL)
+    ReceivedUpdate.objects.filter(creation_date__lt=expired).delete()
+
+
+def is_duplicate(data):
+    """
+    Checks whether an incoming webhook update was already received,
+    counting the duplicates as `webhook.duplicates`.
+
+    :param data: The update data received from Telegram.
+    :return: True if the update must be dropped.
+    """
+
+    update_id = data.get('update_id')
+
+    if not settings.WEBHOOK_DEDUPLICATE or update_id is None:
+        return False
+
+    if mark_received(update_id):
+        return False
+
+    metrics.increment('webhook.duplicates')
+    return True
+
+
+@sync_to_async
+def ais_duplicate(data):
+    """
+    Checks whether an incoming webhook update was already received
+    asynchronously, see `is_duplicate`.
+    """
+
+    return is_duplicate(data)
+
+
+def forget(data):
+    """
+    Forgets a received update whose hand-off to the bot failed,
+    so that it is handled when Telegram delivers it again.
+
+    :param data: The update data received from Telegram.
+    """
+
+    update_id = data.get('update_id')
+
+    received_updates.delete(update_id)
+    ReceivedUpdate.objects.filter(update_id=update_id).delete()
+
+
+@sync_to_async
+def aforget(data):
+    """
+    Forgets a received update asynchronously, see `forget`.
+    """
+
+    forget(data)
+
+
+def reset():
+    """
+    Forgets the received updates of this process.
+    """
+
+    global _next_purge
+
+    received_updates.clear()
+    _next_purge = 0
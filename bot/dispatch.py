@@ -0,0 +1,273 @@
+import os
+import signal
+import asyncio
+import django
+
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+from telegram import Update
+
+from bot import metrics
+from bot.models import QueuedUpdate
+from bot.helpers import logger
+
+
+class DatabaseQueue:
+    """
+    A partitioned queue of updates kept in the QueuedUpdate table,
+    shared by the webhook and the worker processes.
+    """
+
+    def put(self, partition, data):
+        """
+        Appends an update to the partition.
+        """
+
+        QueuedUpdate.objects.create(partition=partition, payload=data)
+
+    def get(self, partitions, limit):
+        """
+        Returns the oldest updates of the given partitions
+        without removing them.
+
+        :param partitions: A list of partition numbers.
+        :param limit: The maximum number of updates.
+        :return: A list of (id, partition, data) tuples, oldest first.
+        """
+
+        return list(QueuedUpdate.objects.filter(
+            partition__in=partitions
+        ).order_by('id').values_list('id', 'partition', 'payload')[:limit])
+
+    def ack(self, ids):
+        """
+        Removes the processed updates from the queue.
+        """
+
+        QueuedUpdate.objects.filter(id__in=ids).delete()
+
+
+def get_queue():
+    """
+    Returns the queue backend configured by `DISPATCH_QUEUE`.
+    """
+
+    return import_string(settings.DISPATCH_QUEUE)()
+
+
+def get_chat_id(data):
+    """
+    Returns the ID of the chat an update belongs to, falling back to
+    the user's ID and then to the update ID for updates without a chat.
+    """
+
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+
+        chat = value.get('chat') or value.get('message', {}).get('chat')
+        if chat:
+            return chat['id']
+        if 'from' in value:
+            return value['from']['id']
+
+    return data['update_id']
+
+
+def get_partition(data):
+    """
+    Returns the partition of an update. Updates of the same chat
+    always go to the same partition.
+    """
+
+    return get_chat_id(data) % settings.DISPATCH_PARTITIONS
+
+
+def get_partitions(index, processes):
+    """
+    Returns the partitions owned by the worker process `index`
+    out of `processes`.
+    """
+
+    return [
+        partition for partition in range(settings.DISPATCH_PARTITIONS)
+        if partition % processes == index
+    ]
+
+
+def put_update(data):
+    """
+    Queues an update received by the webhook for the worker
+    owning its partition.
+
+    :param data: The update data received from Telegram.
+    """
+
+    get_queue().put(get_partition(data), data)
+    metrics.increment('dispatch.queued')
+
+
+class Worker:
+    """
+    Processes the queued updates of a set of partitions. Updates of a
+    partition are processed one by one in the order they were queued,
+    different partitions concurrently and independently: a partition
+    busy with slow updates doesn't hold up the others. Each update is
+    removed from the queue as soon as it is processed.
+
+    :param application: The initialized Application to process with.
+    :param partitions: The partitions owned by the worker.
+    :param queue: The queue backend, `DISPATCH_QUEUE` by default.
+    """
+
+    def __init__(self, application, partitions, queue=None):
+        self.application = application
+        self.partitions = partitions
+        self.queue = queue or get_queue()
+        # Tasks processing the fetched updates, by partition
+        self._tasks = {}
+        # Set when a partition is done, so that it is polled again
+        self._idle = asyncio.Event()
+        self._stop = asyncio.Event()
+
+    async def process_batch(self):
+        """
+        Fetches up to `DISPATCH_BATCH_SIZE` queued updates of the
+        partitions that are not being processed and starts processing
+        them in the background, see `join`.
+
+        :return: The number of updates fetched.
+        """
+
+        partitions = [
+            partition for partition in self.partitions
+            if partition not in self._tasks
+        ]
+        if not partitions:
+            return 0
+
+        items = await sync_to_async(self.queue.get)(
+            partitions, settings.DISPATCH_BATCH_SIZE
+        )
+
+        updates = defaultdict(list)
+        for pk, partition, data in items:
+            updates[partition].append((pk, data))
+
+        for partition, batch in updates.items():
+            task = asyncio.create_task(self.process_partition(batch))
+            task.add_done_callback(
+                lambda _, partition=partition: self._done(partition)
+            )
+            self._tasks[partition] = task
+
+        return len(items)
+
+    def _done(self, partition):
+        del self._tasks[partition]
+        self._idle.set()
+
+    async def process_partition(self, items):
+        """
+        Processes the fetched updates of a partition in order,
+        removing each from the queue once it is processed. The rest
+        are left in the queue when the worker is stopping.
+
+        :param items: A list of (id, data) tuples.
+        """
+
+        for pk, data in items:
+            if self._stop.is_set():
+                return
+
+            try:
+                await self.application.process_update(
+                    Update.de_json(data=data, bot=self.application.bot)
+                )
+            except Exception:
+                logger.exception('Update %s failed', data.get('update_id'))
+
+            await sync_to_async(self.queue.ack)([pk])
+            metrics.increment('dispatch.processed')
+
+    async def join(self):
+        """
+        Waits until the partitions being processed are done.
+        """
+
+        await asyncio.gather(*self._tasks.values())
+
+    async def wait(self, stop):
+        """
+        Waits up to `DISPATCH_POLL_INTERVAL` seconds until the worker
+        is stopped or a partition is done.
+        """
+
+        waiters = [
+            asyncio.ensure_future(event.wait())
+            for event in (stop, self._idle)
+        ]
+        await asyncio.wait(
+            waiters,
+            timeout=settings.DISPATCH_POLL_INTERVAL,
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        for waiter in waiters:
+            waiter.cancel()
+
+    async def run(self, stop):
+        """
+        Processes updates until the `stop` event is set, polling the
+        idle partitions whenever one is done and every
+        `DISPATCH_POLL_INTERVAL` seconds, then waits for the updates
+        being processed.
+
+        :param stop: An asyncio.Event.
+        """
+
+        self._stop = stop
+
+        while not stop.is_set():
+            self._idle.clear()
+            if not await self.process_batch():
+                await self.wait(stop)
+
+        await self.join()
+
+
+async def serve(index, processes):
+    """
+    Runs the worker process `index` until it receives SIGINT or SIGTERM,
+    then lets its background tasks finish.
+    """
+
+    from bot.app import post_stop, post_shutdown
+    from bot.bot import application
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    partitions = get_partitions(index, processes)
+    logger.info('Worker %s owns partitions %s', index, partitions)
+
+    async with application:
+        await Worker(application, partitions).run(stop)
+        await post_stop(application)
+
+    await post_shutdown(application)
+
+
+def run_worker(index, processes):
+    """
+    The entry point of a worker process.
+    """
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    django.setup()
+
+    asyncio.run(serve(index, processes))
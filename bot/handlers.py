@@ -1,5 +1,6 @@
-from django.utils import timezone
+from django.conf import settings
 
+from openai.error import OpenAIError
 from telegram import Update
 from telegram.ext import CallbackContext
 from telegram.constants import ParseMode, ChatAction
@@ -8,15 +9,21 @@ from telegram.constants import ParseMode, ChatAction
 # from bot import database
 
 from bot.helpers import (
-    send_action, get_conversation_topic, save_chat,
-    delete_chat, get_conversation_summary, get_conversation_history,
+    send_action, delete_chat, get_conversation_history,
     save_text_entry, call_openai_api, openai_image_create,
-    get_article_summary, logger
+    get_article_summary, stream_openai_api, send_streamed_message,
+    send_long_message, PromptTooLongError,
+    num_tokens_from_string, num_tokens_from_messages, logger
 )
 from bot.database import (
     get_messages_count, get_or_create_chat,
-    create_message_entry, get_last_text_entry
+    record_exchange, record_usage, get_last_text_entry
 )
+from bot.llm import get_cost
+from bot.tasks import task_queue
+from bot.mailbox import mailbox, serialized
+from bot.articles import ArticleFetchError, get_article
+from bot.ratelimit import admit_summary
 
 
 HELP_MESSAGE = (
@@ -31,6 +38,19 @@ HELP_MESSAGE = (
 # 💾 /save — Save current chat
 # 📝 /history — Show previous chats 🚧
 
+OPENAI_ERROR_MESSAGE = (
+    "😔 OpenAI is not responding right now. Please try again later."
+)
+
+TOO_LONG_MESSAGE = (
+    "✂️ Your message is too long for me to answer. "
+    "Please send a shorter one."
+)
+
+EMPTY_ANSWER_MESSAGE = (
+    "😔 OpenAI returned an empty answer. Please try again."
+)
+
 START_MESSAGE = (
     "🤖 Hi! I'm *ChatGPT* bot "
     "implemented with GPT-3.5 OpenAI API 🤖\n\n"
@@ -39,6 +59,7 @@ START_MESSAGE = (
 )
 
 
+@serialized
 @send_action(ChatAction.TYPING)
 async def start(update: Update, context: CallbackContext):
     """
@@ -69,6 +90,7 @@ async def start(update: Update, context: CallbackContext):
     await get_or_create_chat(telegram_id, create_new_chat=True)
 
 
+@serialized
 async def help(update: Update, context: CallbackContext):
     """
     Sends a message with a list of available commands.
@@ -87,6 +109,7 @@ async def help(update: Update, context: CallbackContext):
     )
 
 
+@serialized
 @send_action(ChatAction.TYPING)
 async def new(update: Update, context: CallbackContext):
     """
@@ -118,6 +141,7 @@ async def new(update: Update, context: CallbackContext):
     await get_or_create_chat(telegram_id, create_new_chat=True)
 
 
+@serialized
 @send_action(ChatAction.TYPING)
 async def save(update: Update, context: CallbackContext):
     """
@@ -131,10 +155,6 @@ async def save(update: Update, context: CallbackContext):
         update.message.from_user.username
         )
 
-    # Reply to the user immediately
-    text = "Saving the chat..."
-    await update.message.reply_text(text)
-
     # Process chat data
     telegram_id = update.message.chat.id
     current_chat = await get_or_create_chat(telegram_id)
@@ -142,26 +162,22 @@ async def save(update: Update, context: CallbackContext):
     messages_count = await get_messages_count(telegram_id, current_chat)
 
     if messages_count > 0:
-        request = await get_conversation_history(
+        # The summary is generated in the background,
+        # the user is notified when it is saved
+        await task_queue.enqueue(
+            'chat_summary',
+            key=f'chat_summary:{current_chat.pk}',
             telegram_id=telegram_id,
-            chat=current_chat
+            chat_id=current_chat.pk
         )
-        summary = await get_conversation_summary(request)
-        current_chat.summary = summary[:1000]
-
-        request = [None, {"role": "assistant", "content": summary}]
-        title = await get_conversation_topic(request)
-        current_chat.topic = title[:250]
-
-        await save_chat(current_chat)
-
-        text = f"Chat saved: {title}"
+        text = "Saving the chat..."
     else:
         text = "There are no messages in the current chat to save."
 
     await update.message.reply_text(text)
 
 
+@serialized
 async def unknown(update: Update, context: CallbackContext):
     """
     Sends a message when an unknown command is entered.
@@ -181,7 +197,54 @@ async def unknown(update: Update, context: CallbackContext):
     await context.bot.send_message(chat_id=update.message.chat_id, text=text)
 
 
-@send_action(ChatAction.TYPING)
+async def send_answer(context: CallbackContext, telegram_id, request,
+                      cache=True):
+    """
+    Generates an answer to the conversation and sends it to the user,
+    streaming it if `OPENAI_STREAM` is enabled.
+
+    :param context: The callback context.
+    :param telegram_id: The user's Telegram ID.
+    :param request: A list of message dictionaries representing
+    the conversation history.
+    :param cache: Whether the answer may come from the response cache.
+    :return: A tuple of the answer, completion tokens and prompt tokens.
+    The answer is empty if OpenAI returned a blank one, which the user
+    is told about and which must not be stored.
+    """
+
+    if settings.OPENAI_STREAM:
+        answer = await send_streamed_message(
+            context.bot, telegram_id, stream_openai_api(request)
+        )
+        completion_tokens = num_tokens_from_string(answer)
+        prompt_tokens = num_tokens_from_messages(request)
+    else:
+        response = await call_openai_api(request, cache=cache)
+
+        answer = response['choices'][0]['message']['content']
+        completion_tokens = response['usage']['completion_tokens']
+        prompt_tokens = response['usage']['prompt_tokens']
+        # total_tokens = response['usage']['total_tokens']
+
+        logger.debug('usage: %s', response['usage'])
+
+        # Send the response message as early as possible
+        await send_long_message(
+            context.bot, telegram_id, answer, parse_mode="Markdown"
+        )
+
+    logger.info('answer: %s', answer)
+
+    if not answer.strip():
+        await context.bot.send_message(
+            chat_id=telegram_id, text=EMPTY_ANSWER_MESSAGE
+        )
+        answer = ''
+
+    return answer, completion_tokens, prompt_tokens
+
+
 async def chat(update: Update, context: CallbackContext):
     """
     Processes user input, generates a response using GPT-3.5,
@@ -194,7 +257,26 @@ async def chat(update: Update, context: CallbackContext):
         update.message.from_user.username
         )
 
-    text = update.message.text
+    # A user's messages are answered one at a time, in order;
+    # messages merged into an earlier answer get an empty list
+    async with mailbox.collect(
+        update.message.chat.id, update.message.text
+    ) as texts:
+        if len(texts) == 1:
+            await answer_chat(update, context, texts[0])
+        elif texts:
+            await answer_chat(update, context, '\n\n'.join(texts))
+
+
+@send_action(ChatAction.TYPING)
+async def answer_chat(update: Update, context: CallbackContext, text):
+    """
+    Answers the user's message in the current chat and stores
+    the exchange.
+
+    :param text: The text of the message, or of several merged messages.
+    """
+
     telegram_id = update.message.chat.id
     username = update.message.from_user.username
 
@@ -203,26 +285,16 @@ async def chat(update: Update, context: CallbackContext):
 
     request.append({"role": 'user', "content": text})
 
-    response = await call_openai_api(request)
-
-    answer = response['choices'][0]['message']['content']
-    completion_tokens = response['usage']['completion_tokens']
-    prompt_tokens = response['usage']['prompt_tokens']
-    # total_tokens = response['usage']['total_tokens']
-
     logger.info('request: %s', text)
-    logger.info('answer: %s', answer)
-    logger.debug('usage: %s', response['usage'])
-
-    # Send the response message as early as possible
-    await context.bot.send_message(
-        chat_id=telegram_id,
-        text=answer,
-        parse_mode="Markdown",
+    answer, completion_tokens, prompt_tokens = await send_answer(
+        context, telegram_id, request
     )
 
+    if not answer:
+        return
+
     # Process the remaining data
-    await create_message_entry(
+    await record_exchange(
         chat=chat,
         telegram_id=telegram_id,
         username=username,
@@ -232,17 +304,29 @@ async def chat(update: Update, context: CallbackContext):
         prompt_tokens=prompt_tokens,
     )
 
-    chat.last_update = timezone.now()
-    await save_chat(chat)
-
     if chat.topic == "":
         request.append({"role": 'assistant', "content": answer})
-        topic = await get_conversation_topic(request)
-        chat.topic = topic[:250]
+        await task_queue.enqueue(
+            'chat_topic',
+            key=f'chat_topic:{chat.pk}',
+            telegram_id=telegram_id,
+            chat_id=chat.pk,
+            request=request
+        )
 
-        await save_chat(chat)
+    # Long history is folded into the chat's memory in the background
+    if settings.MEMORY_ENABLED and (
+        prompt_tokens > settings.MEMORY_THRESHOLD_TOKENS
+    ):
+        await task_queue.enqueue(
+            'chat_memory',
+            key=f'chat_memory:{chat.pk}',
+            telegram_id=telegram_id,
+            chat_id=chat.pk
+        )
 
 
+@serialized
 @send_action(ChatAction.TYPING)
 async def retry(update: Update, context: CallbackContext):
     """
@@ -278,32 +362,33 @@ async def retry(update: Update, context: CallbackContext):
         await update.message.reply_text(text)
         return
 
-    response = await call_openai_api(request)
-
-    answer = response['choices'][0]['message']['content']
-    completion_tokens = response['usage']['completion_tokens']
-    prompt_tokens = response['usage']['prompt_tokens']
-    # total_tokens = response['usage']['total_tokens']
-
-    logger.info("response: %s", last_user_message['content'])
-    logger.info("response: %s", answer)
-    logger.debug('usage: %s', response['usage'])
-
-    # Send the response message
-    await context.bot.send_message(
-        chat_id=telegram_id,
-        text=answer,
-        parse_mode="Markdown",
+    logger.info("request: %s", last_user_message['content'])
+    # A cached answer would repeat the one the user wants regenerated
+    answer, completion_tokens, prompt_tokens = await send_answer(
+        context, telegram_id, request, cache=False
     )
 
+    if not answer:
+        return
+
     # Update the last message's response in the database
     last_text_entry = await get_last_text_entry(telegram_id, chat)
     last_text_entry.response = answer
+    last_text_entry.response_tokens = num_tokens_from_string(answer)
     last_text_entry.completion_tokens = completion_tokens
     last_text_entry.prompt_tokens = prompt_tokens
+    last_text_entry.total_tokens = completion_tokens + prompt_tokens
+    last_text_entry.cost = get_cost(prompt_tokens, completion_tokens)
     await save_text_entry(last_text_entry)
+    await record_usage(
+        telegram_id,
+        'retry',
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens
+    )
 
 
+@serialized
 @send_action(ChatAction.TYPING)
 async def img(update: Update, context: CallbackContext):
 
@@ -336,8 +421,9 @@ async def img(update: Update, context: CallbackContext):
         # answer = image_url
         await update.message.reply_photo(photo=image_url, caption=request)
 
-        await create_message_entry(
+        await record_exchange(
             chat=chat,
+            kind='img',
             telegram_id=telegram_id,
             username=username,
             request=text,
@@ -347,10 +433,29 @@ async def img(update: Update, context: CallbackContext):
 
 
 async def error_handler(update: Update, context: CallbackContext) -> None:
+    """
+    Logs errors raised by the handlers and tells the user when
+    the OpenAI API couldn't answer or the message was too long.
+    """
 
     logger.error('Update: "%s" \nError: "%s"', update, context.error)
 
+    if not isinstance(update, Update):
+        return
+
+    if isinstance(context.error, PromptTooLongError):
+        text = TOO_LONG_MESSAGE
+    elif isinstance(context.error, OpenAIError):
+        text = OPENAI_ERROR_MESSAGE
+    else:
+        return
 
+    await context.bot.send_message(
+        chat_id=update.effective_message.chat_id, text=text
+    )
+
+
+@serialized
 async def summarize(update: Update, context: CallbackContext) -> None:
 
     logger.debug(
@@ -371,7 +476,18 @@ async def summarize(update: Update, context: CallbackContext) -> None:
         await update.message.reply_text(answer)
     else:
         logger.info('request: %s', url)
-        response = await get_article_summary(url)
+        try:
+            # Long articles are charged for all their chunks
+            article = await get_article(url)
+            if 'summary' not in article and not await admit_summary(
+                update, context, article['content']
+            ):
+                return
+            response = await get_article_summary(url)
+        except ArticleFetchError as error:
+            logger.warning(error)
+            await update.message.reply_text("Couldn't read the article.")
+            return
 
         answer = response['choices'][0]['message']['content']
         completion_tokens = response['usage']['completion_tokens']
@@ -382,15 +498,14 @@ async def summarize(update: Update, context: CallbackContext) -> None:
         logger.debug('usage: %s', response['usage'])
 
         # Send the response message as early as possible
-        await context.bot.send_message(
-            chat_id=telegram_id,
-            text=answer,
-            parse_mode="Markdown",
+        await send_long_message(
+            context.bot, telegram_id, answer, parse_mode="Markdown"
         )
 
         # Process the remaining data
-        await create_message_entry(
+        await record_exchange(
             chat=chat,
+            kind='sum',
             telegram_id=telegram_id,
             username=username,
             request=url,
@@ -399,9 +514,6 @@ async def summarize(update: Update, context: CallbackContext) -> None:
             prompt_tokens=prompt_tokens,
         )
 
-        chat.last_update = timezone.now()
-        await save_chat(chat)
-
 
 # async def history(update: Update, context: CallbackContext) -> None:
 
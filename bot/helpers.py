@@ -1,27 +1,78 @@
+import json
 import openai
-import tiktoken
+import asyncio
+import aiohttp
+import hashlib
 import logging
+import weakref
+import time
 # import httpx
 # import marvin
-import trafilatura
 
-from trafilatura.settings import use_config
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
 from colorlog import ColoredFormatter
 from functools import wraps
 from typing import Callable
 from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from bot import articles, database, openai_client
+from bot.cache import TTLCache
+from bot.llm import IMAGE_SIZE, get_model
+from bot.tokens import (  # noqa: F401
+    get_encoding, num_tokens_from_string, num_tokens_from_message,
+    num_tokens_from_messages, num_tokens_from_text_entry, split_into_chunks,
+    split_tokens
+)
+
+
+SUMMARY_MAX_DEPTH = 3
+
+# Longer answers are sent as several messages
+MAX_MESSAGE_LENGTH = MessageLimit.MAX_TEXT_LENGTH
+# Attempts to send the final edit of a streamed message when rate limited
+FINAL_EDIT_ATTEMPTS = 3
+
+SUMMARY_PROMPT = (
+    "Provide a comprehensive and concise summary of the provided text, "
+    "highlighting its main ideas and key points, while maintaining the "
+    "overall context and significance of the original content. "
+    "The summary should be a single paragraph of no more than 5 sentences "
+    "plus a list of bullet points."
+    )
+CHUNK_SUMMARY_PROMPT = (
+    "The provided text is a part of a longer document. "
+    "Summarize it concisely, keeping all its main ideas and key points."
+    )
+
+MEMORY_PROMPT = (
+    "Update the summary of the earlier conversation with the messages "
+    "above. Keep the facts, names, decisions and open questions the "
+    "assistant needs to continue the conversation. "
+    "Reply with the updated summary only."
+    )
 
-from bot import database
+system = {"role": "system", "content": "You are a helpful assistant."}
 
+# Pooled HTTP sessions for OpenAI requests, one per event loop
+openai_sessions = weakref.WeakKeyDictionary()
 
-MAX_TOKENS = 4096
-TOKENS_BUFFER = 200
+CACHED_USAGE = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
 
-system = {"role": "system", "content": "You are a helpful assistant."}
+# Responses to identical chat completion requests
+response_cache = TTLCache(
+    'response_cache',
+    settings.RESPONSE_CACHE_SIZE,
+    settings.RESPONSE_CACHE_TTL
+)
 
-# To disable signal in trafilatura
-config = use_config()
-config.set("DEFAULT", "EXTRACTION_TIMEOUT", "0")
+
+class PromptTooLongError(Exception):
+    """
+    Raised when a request leaves no room for the reply
+    in the model's context.
+    """
 
 
 def setup_colored_logging(level=logging.DEBUG):
@@ -83,21 +134,269 @@ def send_action(action: str) -> Callable:
     return decorator
 
 
-async def call_openai_api(request):
+def get_openai_session():
+    """
+    Returns the pooled HTTP session used for OpenAI requests
+    in the running event loop, creating it on first use.
+
+    :return: An aiohttp ClientSession.
+    """
+
+    loop = asyncio.get_running_loop()
+    session = openai_sessions.get(loop)
+
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.OPENAI_MAX_CONNECTIONS
+            )
+        )
+        openai_sessions[loop] = session
+
+    return session
+
+
+async def close_openai_session():
+    """
+    Closes the pooled OpenAI HTTP session of the running event loop.
+    """
+
+    session = openai_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def get_response_cache_key(**params):
+    """
+    Returns a hash of the model, parameters and messages of a request.
+    """
+
+    data = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def get_max_tokens(request, model):
+    """
+    Returns the number of tokens to reserve for the reply: at most
+    `OPENAI_MAX_TOKENS`, and no more than the model's context leaves.
+    Raises PromptTooLongError if the request fills the whole context,
+    which the API would reject.
+
+    :param request: A list of message dictionaries.
+    :param model: The Model the request is sent to.
+    """
+
+    available_tokens = (
+        model.context_tokens - num_tokens_from_messages(request, model)
+    )
+    if available_tokens <= 0:
+        raise PromptTooLongError(
+            f'The request exceeds the context by {-available_tokens} tokens'
+        )
+
+    return min(settings.OPENAI_MAX_TOKENS, available_tokens)
+
+
+async def call_openai_api(request, cache=True):
     """
     Calls the OpenAI API for chat completion using the provided `request`.
 
+    With `RESPONSE_CACHE_ENABLED` the response to an identical request
+    is served from the cache unless `cache` is False.
+
     :param request: A list of strings representing the chat history.
+    :param cache: Whether the response may come from the cache.
     return: A dictionary containing the response from the OpenAI API.
     """
 
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=request
+    model = get_model()
+    params = {
+        'model': model.name,
+        'messages': request,
+        'max_tokens': get_max_tokens(request, model),
+    }
+
+    cache = cache and settings.RESPONSE_CACHE_ENABLED
+    if cache:
+        key = get_response_cache_key(**params)
+        response = response_cache.get(key)
+        if response is not None:
+            # A cached response is not billed again
+            return {**response, 'usage': CACHED_USAGE}
+
+    openai.aiosession.set(get_openai_session())
+    response = await openai_client.call(
+        openai.ChatCompletion.acreate, **params
     )
+
+    if cache:
+        response_cache.set(key, response)
+
     return response
 
 
+async def stream_openai_api(request):
+    """
+    Calls the OpenAI API for chat completion using the provided `request`
+    and yields the answer piece by piece as it is generated.
+
+    :param request: A list of strings representing the chat history.
+    :return: An async iterator over the pieces of the answer.
+    """
+
+    model = get_model()
+
+    openai.aiosession.set(get_openai_session())
+    response = await openai_client.call(
+        openai.ChatCompletion.acreate,
+        model=model.name,
+        messages=request,
+        max_tokens=get_max_tokens(request, model),
+        stream=True
+    )
+
+    async for chunk in response:
+        content = chunk['choices'][0]['delta'].get('content')
+        if content:
+            yield content
+
+
+def split_text(text, limit=None):
+    """
+    Splits a text into parts that fit in a Telegram message, breaking
+    at the last line break within the limit where possible. Blank parts,
+    which Telegram doesn't accept, are left out.
+
+    :param text: The text to split.
+    :param limit: The maximum length of a part,
+    `MAX_MESSAGE_LENGTH` by default.
+    :return: A list of parts.
+    """
+
+    limit = limit or MAX_MESSAGE_LENGTH
+    parts = []
+
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut > 0:
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+        else:
+            parts.append(text[:limit])
+            text = text[limit:]
+    parts.append(text)
+
+    return [part for part in parts if part.strip()]
+
+
+async def send_long_message(bot, chat_id, text, **kwargs):
+    """
+    Sends a text, split into several messages if it is too long
+    for a single one.
+    """
+
+    for part in split_text(text):
+        await bot.send_message(chat_id=chat_id, text=part, **kwargs)
+
+
+async def edit_message(bot, message, text, attempts=1, **kwargs):
+    """
+    Edits the text of a sent message, ignoring edits Telegram rejects.
+    A rate limited edit is retried once Telegram allows it
+    while attempts remain.
+
+    :param attempts: The number of times to try the edit.
+    :return: True if the message was edited, False otherwise.
+    """
+
+    for attempt in range(1, attempts + 1):
+        try:
+            await bot.edit_message_text(
+                text=text,
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                **kwargs
+            )
+        except RetryAfter as error:
+            logger.warning('Message edit is rate limited: %s', error)
+            if attempt < attempts:
+                await asyncio.sleep(error.retry_after)
+        except BadRequest as error:
+            logger.debug('Message edit is rejected: %s', error)
+            return 'not modified' in error.message
+        else:
+            return True
+
+    return False
+
+
+async def finish_message(bot, message, text):
+    """
+    Sends the final text of a streamed message with Markdown formatting,
+    or as plain text if Telegram rejects the formatting.
+    """
+
+    for parse_mode in ("Markdown", None):
+        if await edit_message(
+            bot, message, text, FINAL_EDIT_ATTEMPTS, parse_mode=parse_mode
+        ):
+            return
+
+
+async def continue_message(bot, chat_id, messages, parts):
+    """
+    Completes the last message of a streamed answer once it is full
+    and sends the rest of the answer in new messages.
+
+    :param messages: The messages sent so far, extended in place.
+    :param parts: The parts of the answer, see `split_text`.
+    """
+
+    if messages:
+        await edit_message(bot, messages[-1], parts[len(messages) - 1])
+
+    for part in parts[len(messages):]:
+        messages.append(await bot.send_message(chat_id=chat_id, text=part))
+
+
+async def send_streamed_message(bot, chat_id, chunks):
+    """
+    Sends a message as soon as the first piece of the answer arrives
+    and keeps editing it while the rest is generated. Edits are sent at
+    most once per `STREAM_EDIT_INTERVAL` seconds to respect Telegram's
+    limits; the final text is sent with Markdown formatting. An answer
+    too long for one message continues in the following messages.
+    Nothing is sent while the answer is blank.
+
+    :param bot: The bot to send the message with.
+    :param chat_id: The chat to send the message to.
+    :param chunks: An async iterator over the pieces of the answer.
+    :return: The full text of the answer.
+    """
+
+    text = ""
+    messages = []
+    last_edit = 0
+
+    async for chunk in chunks:
+        text += chunk
+        parts = split_text(text)
+
+        if len(parts) > len(messages):
+            await continue_message(bot, chat_id, messages, parts)
+            last_edit = time.monotonic()
+        elif messages and time.monotonic() - last_edit >= (
+            settings.STREAM_EDIT_INTERVAL
+        ):
+            await edit_message(bot, messages[-1], parts[-1])
+            last_edit = time.monotonic()
+
+    for message, part in zip(messages, split_text(text)):
+        await finish_message(bot, message, part)
+
+    return text
+
+
 async def openai_image_create(request):
     """
     Creates an image using OpenAI's API.
@@ -106,10 +405,12 @@ async def openai_image_create(request):
     return: The response from OpenAI's API, containing the generated image.
     """
 
-    response = openai.Image.create(
+    openai.aiosession.set(get_openai_session())
+    response = await openai_client.call(
+        openai.Image.acreate,
         prompt=request,
         n=1,
-        size="1024x1024"
+        size=IMAGE_SIZE
     )
     return response
 
@@ -129,6 +430,7 @@ def delete_chat(chat):
     Deletes the provided chat instance asynchronously.
     """
 
+    database.invalidate_chat(chat)
     chat.delete()
 
 
@@ -141,12 +443,30 @@ def save_text_entry(text_entry):
     text_entry.save()
 
 
-async def get_conversation_topic(request):
+async def record_response_usage(telegram_id, kind, response):
+    """
+    Adds the usage of an OpenAI response to the user's usage,
+    if the user is known.
+    """
+
+    if telegram_id is None:
+        return
+
+    await database.record_usage(
+        telegram_id,
+        kind,
+        prompt_tokens=response['usage']['prompt_tokens'],
+        completion_tokens=response['usage']['completion_tokens']
+    )
+
+
+async def get_conversation_topic(request, telegram_id=None):
     """
     Generates a short sentence describing the topic of the answer.
 
     :param request: A list of message dictionaries representing
     the conversation history.
+    :param telegram_id: The Telegram ID of the user to record usage for.
     :return: A short sentence summarizing the answer's topic.
     """
 
@@ -159,16 +479,18 @@ async def get_conversation_topic(request):
 
     logger.info('topic: %s', topic)
     logger.debug('usage: %s', response['usage'])
+    await record_response_usage(telegram_id, 'topic', response)
 
     return topic
 
 
-async def get_conversation_summary(request):
+async def get_conversation_summary(request, telegram_id=None):
     """
     Generates a summary of the conversation in one paragraph.
 
     :param request: A list of message dictionaries representing
     the conversation history.
+    :param telegram_id: The Telegram ID of the user to record usage for.
     :return: A paragraph summarizing the conversation.
     """
 
@@ -183,45 +505,42 @@ async def get_conversation_summary(request):
 
     logger.info('summary: %s', summary)
     logger.debug('usage: %s', response['usage'])
+    await record_response_usage(telegram_id, 'summary', response)
 
     return summary
 
 
-def num_tokens_from_string(string: str) -> int:
-    """
-    Returns the number of tokens in a text string.
-
-    :param string: A string to be tokenized.
-    :return: Number of tokens in the string.
+def truncate_messages(messages, text, reserved_tokens=0, model=None):
     """
-    encoding = tiktoken.get_encoding("cl100k_base")
-    num_tokens = len(encoding.encode(string))
-
-    return num_tokens
-
-
-def truncate_messages(messages, text):
-    """
-    Truncates the messages based on the token limit.
+    Truncates the messages so that the prompt fits into the model's
+    context along with the `OPENAI_MAX_TOKENS` reserved for the reply.
 
     :param messages: A list of message objects to truncate.
     :param text: The last message from the user.
+    :param reserved_tokens: Tokens taken by other parts of the prompt.
+    :param model: The Model, `OPENAI_MODEL` by default.
     :return: A list of truncated message objects.
     """
 
+    model = model or get_model()
     truncated_messages = []
     total_tokens = 0
 
-    for message in messages:
-        system_tokens = num_tokens_from_string(system['content'])
-        request_tokens = num_tokens_from_string(message.request)
-        response_tokens = num_tokens_from_string(message.response)
-        text_tokens = num_tokens_from_string(text)
+    # Every message takes its role (a single token) and the chat format
+    # overhead; a text entry is a pair of messages
+    message_overhead = model.tokens_per_message + 1
 
-        temp_tokens = system_tokens + text_tokens + TOKENS_BUFFER
-        message_tokens = request_tokens + response_tokens
+    system_tokens = num_tokens_from_string(system['content'])
+    text_tokens = num_tokens_from_string(text)
+    temp_tokens = system_tokens + text_tokens + 2 * message_overhead
+    temp_tokens += model.reply_tokens + settings.OPENAI_MAX_TOKENS
+    temp_tokens += reserved_tokens
 
-        if total_tokens + temp_tokens + message_tokens <= MAX_TOKENS:
+    for message in messages:
+        message_tokens = num_tokens_from_text_entry(message)
+        message_tokens += 2 * message_overhead
+
+        if total_tokens + temp_tokens + message_tokens <= model.context_tokens:
             truncated_messages.append(message)
             total_tokens += message_tokens
         else:
@@ -243,10 +562,18 @@ def get_conversation_history(telegram_id, chat, text=""):
     the conversation history.
     """
 
-    messages = database.get_message_objects(telegram_id, chat)
-    truncated_messages = truncate_messages(messages, text)
-
     request = [system]
+    reserved_tokens = 0
+
+    # Turns folded into the chat's memory are replaced by their summary
+    if chat.memory:
+        memory = get_memory_message(chat.memory)
+        request.append(memory)
+        reserved_tokens = num_tokens_from_message(memory)
+
+    messages = database.iter_message_objects(telegram_id, chat)
+    truncated_messages = truncate_messages(messages, text, reserved_tokens)
+
     for message in reversed(truncated_messages):
         request.extend([
             {"role": "user", "content": message.request},
@@ -256,25 +583,99 @@ def get_conversation_history(telegram_id, chat, text=""):
     return request
 
 
-def get_content_from_url(url: str) -> str:
-    downloaded = trafilatura.fetch_url(url)
-    content = trafilatura.extract(downloaded, config=config)
+def get_memory_message(memory):
+    """
+    Returns the system message carrying the summary of earlier turns.
+    """
+
+    return {
+        "role": "system",
+        "content": f"Summary of the earlier conversation: {memory}"
+    }
+
 
-    # logger.info('content: %s', content)
+def select_messages_to_fold(messages):
+    """
+    Selects the oldest messages to fold into the chat's memory, keeping
+    the most recent `MEMORY_RECENT_TOKENS` tokens of the conversation
+    as they are. At most `SUMMARY_CHUNK_TOKENS` tokens are folded at once.
 
-    return content
+    :param messages: The messages not yet folded, oldest first.
+    :return: A list of messages, oldest first.
+    """
 
+    recent_tokens = 0
+    recent = len(messages)
+    while recent > 0:
+        tokens = num_tokens_from_text_entry(messages[recent - 1])
+        if recent_tokens + tokens > settings.MEMORY_RECENT_TOKENS:
+            break
+        recent_tokens += tokens
+        recent -= 1
 
-async def get_article_summary(url: str) -> str:
-    content = get_content_from_url(url)
+    selected = []
+    total_tokens = 0
+    for message in messages[:recent]:
+        total_tokens += num_tokens_from_text_entry(message)
+        if selected and total_tokens > settings.SUMMARY_CHUNK_TOKENS:
+            break
+        selected.append(message)
 
-    text = (
-        "Provide a comprehensive and concise summary of the provided text, "
-        "highlighting its main ideas and key points, while maintaining the "
-        "overall context and significance of the original content. "
-        "The summary should be a single paragraph of no more than 5 sentences "
-        "plus a list of bullet points."
-        )
+    return selected
+
+
+async def fold_conversation_memory(memory, messages, telegram_id=None):
+    """
+    Generates a new summary of the conversation from the previous one
+    and the given messages.
+
+    :param memory: The previous summary, may be empty.
+    :param messages: The messages to fold into the summary, oldest first.
+    :param telegram_id: The Telegram ID of the user to record usage for.
+    :return: The new summary.
+    """
+
+    request = [{"role": "system", "content": "You summarize conversations."}]
+    if memory:
+        request.append(get_memory_message(memory))
+
+    for message in messages:
+        request.extend([
+            {"role": "user", "content": message.request},
+            {"role": "assistant", "content": message.response}
+        ])
+    request.append({"role": "user", "content": MEMORY_PROMPT})
+
+    response = await call_openai_api(request, cache=False)
+    memory = response['choices'][0]['message']['content']
+
+    logger.debug('memory: %s', memory)
+    logger.debug('usage: %s', response['usage'])
+    await record_response_usage(telegram_id, 'memory', response)
+
+    return memory
+
+
+async def get_content_from_url(url: str) -> str:
+    """
+    Gets the main text of the article at the given URL.
+    """
+
+    article = await articles.get_article(url)
+
+    # logger.info('content: %s', article['content'])
+
+    return article['content']
+
+
+async def summarize_text(content: str, text: str):
+    """
+    Summarizes a text in a single OpenAI API call.
+
+    :param content: The text to summarize.
+    :param text: The summarization instructions.
+    :return: The response from the OpenAI API containing the summary.
+    """
 
     request = [
         {"role": "system", "content": "You are a text summarizer."},
@@ -284,7 +685,97 @@ async def get_article_summary(url: str) -> str:
 
     # logger.info('request: %s', request)
 
-    response = await call_openai_api(request)
+    return await call_openai_api(request)
+
+
+def shorten_chunks(chunks):
+    """
+    Joins chunks into a text of at most `SUMMARY_CHUNK_TOKENS` tokens,
+    truncating each of them to an equal share of the tokens.
+
+    :param chunks: A list of texts.
+    :return: The joined text.
+    """
+
+    # One token of each share is left for the joining line break
+    share = max(1, settings.SUMMARY_CHUNK_TOKENS // len(chunks) - 1)
+
+    return '\n'.join(
+        split_tokens(chunk, share)[0] for chunk in chunks if chunk
+    )
+
+
+async def summarize_document(content: str, depth=0):
+    """
+    Summarizes a text of any length. A text that doesn't fit into
+    `SUMMARY_CHUNK_TOKENS` is split into chunks which are summarized
+    concurrently (at most `SUMMARY_CONCURRENCY` at a time); the joined
+    chunk summaries are then summarized the same way. Only the first
+    `SUMMARY_MAX_CHUNKS` chunks of the text are summarized.
+
+    :param content: The text to summarize.
+    :param depth: The number of reduce steps already made.
+    :return: The response from the OpenAI API containing the summary,
+    with the usage of all the calls made.
+    """
+
+    chunks = split_into_chunks(content, settings.SUMMARY_CHUNK_TOKENS)
+    if len(chunks) > settings.SUMMARY_MAX_CHUNKS:
+        logger.info('Summarizing the first %s of %s chunks',
+                    settings.SUMMARY_MAX_CHUNKS, len(chunks))
+        chunks = chunks[:settings.SUMMARY_MAX_CHUNKS]
+
+    if len(chunks) == 1:
+        return await summarize_text(chunks[0], SUMMARY_PROMPT)
+
+    if depth >= SUMMARY_MAX_DEPTH:
+        return await summarize_text(shorten_chunks(chunks), SUMMARY_PROMPT)
+
+    semaphore = asyncio.Semaphore(settings.SUMMARY_CONCURRENCY)
+
+    async def summarize_chunk(chunk):
+        async with semaphore:
+            return await summarize_text(chunk, CHUNK_SUMMARY_PROMPT)
+
+    responses = await asyncio.gather(*map(summarize_chunk, chunks))
+    logger.debug('Summarized %s chunks', len(chunks))
+
+    summaries = '\n\n'.join(
+        response['choices'][0]['message']['content']
+        for response in responses
+    )
+    response = await summarize_document(summaries, depth + 1)
+
+    return {
+        'choices': response['choices'],
+        'usage': {
+            key: sum(
+                item['usage'][key] for item in [response, *responses]
+            )
+            for key in ('prompt_tokens', 'completion_tokens')
+        },
+    }
+
+
+async def get_article_summary(url: str) -> str:
+    """
+    Summarizes the article at the given URL. Both the article and its
+    summary are cached, so a popular link is summarized once; a cached
+    summary comes with no usage, as it costs nothing.
+
+    :param url: The URL of the article.
+    :return: The response from the OpenAI API containing the summary.
+    """
+
+    article = await articles.get_article(url)
+    if 'summary' in article:
+        return {
+            'choices': [{'message': {'content': article['summary']}}],
+            'usage': CACHED_USAGE,
+        }
+
+    response = await summarize_document(article['content'])
+    article['summary'] = response['choices'][0]['message']['content']
 
     # logger.info('summary: %s', response['choices'][0]['message']['content'])
     # logger.debug('usage: %s', response['usage'])
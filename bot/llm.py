@@ -0,0 +1,105 @@
+from decimal import Decimal
+from typing import NamedTuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+class Model(NamedTuple):
+    """
+    A chat completion model and what it takes to budget its requests.
+
+    Chat messages cost `tokens_per_message` tokens on top of their
+    content (plus `tokens_per_name` if the message has a name), and every
+    reply is primed with `reply_tokens` tokens. Prices are in USD per
+    1000 tokens.
+    """
+
+    name: str
+    context_tokens: int
+    encoding: str = 'cl100k_base'
+    tokens_per_message: int = 3
+    tokens_per_name: int = 1
+    reply_tokens: int = 3
+    prompt_price: Decimal = Decimal('0')
+    completion_price: Decimal = Decimal('0')
+
+    def cost(self, prompt_tokens, completion_tokens):
+        """
+        Returns the price of a request in USD.
+        """
+
+        return (
+            prompt_tokens * self.prompt_price
+            + completion_tokens * self.completion_price
+        ) / 1000
+
+
+MODELS = {
+    model.name: model for model in [
+        Model(
+            'gpt-3.5-turbo', 4096,
+            prompt_price=Decimal('0.0015'),
+            completion_price=Decimal('0.002'),
+        ),
+        Model(
+            'gpt-3.5-turbo-0301', 4096,
+            tokens_per_message=4,
+            tokens_per_name=-1,
+            prompt_price=Decimal('0.0015'),
+            completion_price=Decimal('0.002'),
+        ),
+        Model(
+            'gpt-3.5-turbo-16k', 16384,
+            prompt_price=Decimal('0.003'),
+            completion_price=Decimal('0.004'),
+        ),
+        Model(
+            'gpt-4', 8192,
+            prompt_price=Decimal('0.03'),
+            completion_price=Decimal('0.06'),
+        ),
+        Model(
+            'gpt-4-32k', 32768,
+            prompt_price=Decimal('0.06'),
+            completion_price=Decimal('0.12'),
+        ),
+    ]
+}
+
+
+# Size of the generated images and their prices in USD
+IMAGE_SIZE = '1024x1024'
+IMAGE_PRICES = {
+    '256x256': Decimal('0.016'),
+    '512x512': Decimal('0.018'),
+    '1024x1024': Decimal('0.02'),
+}
+
+
+def get_model(name=None):
+    """
+    Returns the model with the given name, `OPENAI_MODEL` by default.
+
+    :param name: The name of the model.
+    :return: A Model.
+    """
+
+    name = name or settings.OPENAI_MODEL
+
+    try:
+        return MODELS[name]
+    except KeyError:
+        raise ImproperlyConfigured(f'Unknown OpenAI model: {name}')
+
+
+def get_cost(prompt_tokens=0, completion_tokens=0, images=0):
+    """
+    Returns the price in USD of completion tokens of `OPENAI_MODEL`
+    and of images of `IMAGE_SIZE`.
+    """
+
+    return (
+        get_model().cost(prompt_tokens, completion_tokens)
+        + images * IMAGE_PRICES[IMAGE_SIZE]
+    )
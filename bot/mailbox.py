@@ -0,0 +1,104 @@
+import asyncio
+import weakref
+
+from contextlib import asynccontextmanager
+from functools import wraps
+from typing import Callable
+
+from django.conf import settings
+
+from bot import metrics
+
+
+class Mailbox:
+    """
+    Serializes the processing of each user's updates while updates of
+    different users run concurrently. Updates of a user are processed in
+    the order they arrived; consecutive messages can be merged into one.
+    """
+
+    def __init__(self):
+        # Locks stay alive while any update of the user holds or awaits them
+        self.locks = weakref.WeakValueDictionary()
+        self.pending = {}
+
+    def lock(self, key):
+        """
+        Returns the lock of the given user.
+
+        :param key: The user's Telegram ID.
+        :return: An asyncio.Lock.
+        """
+
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def collect(self, key, message):
+        """
+        Waits for the user's previous updates and yields the messages
+        to answer. With `CHAT_MERGE_MESSAGES` these are all messages
+        received until now (and within `CHAT_MERGE_WINDOW` seconds),
+        so the updates of messages merged into an earlier one get an
+        empty list; otherwise it is just the given message.
+
+        :param key: The user's Telegram ID.
+        :param message: The text of the message.
+        :return: An async context manager yielding a list of messages.
+        """
+
+        if not settings.CHAT_MERGE_MESSAGES:
+            async with self.lock(key):
+                yield [message]
+            return
+
+        batch = self.pending.setdefault(key, [])
+        batch.append(message)
+
+        async with self.lock(key):
+            if self.pending.get(key) is batch:
+                await asyncio.sleep(settings.CHAT_MERGE_WINDOW)
+                self.close(key, batch)
+
+            # The first update of the batch answers all of its messages
+            messages = batch[:]
+            batch.clear()
+            if len(messages) > 1:
+                metrics.increment('mailbox.merged', len(messages) - 1)
+
+            yield messages
+
+    def close(self, key, batch=None):
+        """
+        Ends the merge window of the user, so that messages received
+        from now on are not merged into the pending ones.
+
+        :param key: The user's Telegram ID.
+        :param batch: Only close the window if it still collects
+        this list of messages.
+        """
+
+        if batch is None or self.pending.get(key) is batch:
+            self.pending.pop(key, None)
+
+
+mailbox = Mailbox()
+
+
+def serialized(func: Callable) -> Callable:
+    """
+    A decorator that runs the handler after the user's previous updates
+    have been processed. Messages received after the command are not
+    merged into those received before it.
+    """
+
+    @wraps(func)
+    async def handler(update, context, *args, **kwargs):
+        key = update.effective_message.chat_id
+        mailbox.close(key)
+
+        async with mailbox.lock(key):
+            return await func(update, context, *args, **kwargs)
+    return handler
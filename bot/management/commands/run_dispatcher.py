@@ -0,0 +1,52 @@
+import signal
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from bot.dispatch import run_worker
+
+
+class Command(BaseCommand):
+    help = (
+        'Runs worker processes that process the updates queued by the '
+        'webhook, each owning a share of the partitions.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=settings.DISPATCH_PROCESSES,
+            help='The number of worker processes.'
+        )
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+
+        # Worker processes open their own database connections
+        connections.close_all()
+
+        workers = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(index, processes),
+                name=f'dispatcher-{index}'
+            )
+            for index in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+
+        def stop(signum, frame):
+            for worker in workers:
+                worker.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        for worker in workers:
+            worker.join()
+
+        self.stdout.write(f'Stopped {processes} workers')
@@ -0,0 +1,41 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from bot.bot import application
+from bot.helpers import close_openai_session
+from bot.tasks import run_stored_jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs background jobs stored in the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run the due jobs once and exit.'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=5,
+            help='Seconds to wait when there are no due jobs.'
+        )
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options['once'], options['interval']))
+
+    async def run(self, once, interval):
+        async with application.bot:
+            while True:
+                count = await run_stored_jobs()
+                if count:
+                    self.stdout.write(f'Ran {count} jobs')
+
+                if once:
+                    break
+                if not count:
+                    await asyncio.sleep(interval)
+
+        await close_openai_session()
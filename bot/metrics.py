@@ -0,0 +1,54 @@
+import threading
+
+from collections import Counter
+
+
+counters = Counter()
+gauges = {}
+
+_lock = threading.Lock()
+
+
+def increment(name, value=1):
+    """
+    Increments the counter with the given name.
+
+    :param name: The name of the counter.
+    :param value: The value to add to the counter.
+    """
+
+    with _lock:
+        counters[name] += value
+
+
+def set_gauge(name, value):
+    """
+    Sets the gauge with the given name to the current value.
+
+    :param name: The name of the gauge.
+    :param value: The current value.
+    """
+
+    with _lock:
+        gauges[name] = value
+
+
+def get_metrics():
+    """
+    Returns a snapshot of all counters and gauges.
+
+    :return: A dictionary mapping metric names to their values.
+    """
+
+    with _lock:
+        return {**counters, **gauges}
+
+
+def reset():
+    """
+    Resets all counters and gauges.
+    """
+
+    with _lock:
+        counters.clear()
+        gauges.clear()
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:34
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='Name')),
+                ('payload', models.JSONField(default=dict, verbose_name='Payload')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('failed', models.BooleanField(default=False, verbose_name='Failed')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last error')),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Run after')),
+                ('creation_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Creation date')),
+            ],
+            options={
+                'verbose_name': 'Job',
+                'verbose_name_plural': 'Jobs',
+                'indexes': [models.Index(fields=['failed', 'run_after'], name='job_failed_run_after_idx')],
+            },
+        ),
+    ]
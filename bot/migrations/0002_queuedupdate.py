@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:53
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('partition', models.IntegerField(verbose_name='Partition')),
+                ('payload', models.JSONField(verbose_name='Payload')),
+                ('creation_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Creation date')),
+            ],
+            options={
+                'verbose_name': 'Queued update',
+                'verbose_name_plural': 'Queued updates',
+                'indexes': [models.Index(fields=['partition', 'id'], name='update_partition_id_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0002_queuedupdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceivedUpdate',
+            fields=[
+                ('update_id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='Update ID')),
+                ('creation_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Creation date')),
+            ],
+            options={
+                'verbose_name': 'Received update',
+                'verbose_name_plural': 'Received updates',
+                'indexes': [models.Index(fields=['creation_date'], name='received_update_date_idx')],
+            },
+        ),
+    ]
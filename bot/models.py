@@ -0,0 +1,96 @@
+from django.db import models
+from django.utils import timezone
+
+
+class Job(models.Model):
+    name = models.CharField(
+        max_length=100,
+        verbose_name='Name'
+    )
+    payload = models.JSONField(
+        default=dict,
+        verbose_name='Payload'
+    )
+    attempts = models.IntegerField(
+        default=0,
+        verbose_name='Attempts'
+    )
+    failed = models.BooleanField(
+        default=False,
+        verbose_name='Failed'
+    )
+    last_error = models.TextField(
+        blank=True,
+        verbose_name='Last error'
+    )
+    run_after = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Run after'
+    )
+    creation_date = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Creation date'
+    )
+
+    def __str__(self):
+        return f"{self.name} #{self.pk}"
+
+    class Meta:
+        verbose_name = 'Job'
+        verbose_name_plural = 'Jobs'
+        indexes = [
+            models.Index(
+                fields=['failed', 'run_after'],
+                name='job_failed_run_after_idx'
+            ),
+        ]
+
+
+class QueuedUpdate(models.Model):
+    partition = models.IntegerField(
+        verbose_name='Partition'
+    )
+    payload = models.JSONField(
+        verbose_name='Payload'
+    )
+    creation_date = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Creation date'
+    )
+
+    def __str__(self):
+        return f"Update #{self.pk} ({self.partition})"
+
+    class Meta:
+        verbose_name = 'Queued update'
+        verbose_name_plural = 'Queued updates'
+        indexes = [
+            models.Index(
+                fields=['partition', 'id'],
+                name='update_partition_id_idx'
+            ),
+        ]
+
+
+class ReceivedUpdate(models.Model):
+    update_id = models.BigIntegerField(
+        primary_key=True,
+        verbose_name='Update ID'
+    )
+    creation_date = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Creation date'
+    )
+
+    def __str__(self):
+        return f"Update #{self.update_id}"
+
+    class Meta:
+        verbose_name = 'Received update'
+        verbose_name_plural = 'Received updates'
+        indexes = [
+            models.Index(
+                fields=['creation_date'],
+                name='received_update_date_idx'
+            ),
+        ]
@@ -0,0 +1,230 @@
+import time
+import random
+import asyncio
+import itertools
+import threading
+
+from django.conf import settings
+from openai import error
+
+from bot import metrics
+
+
+# Errors worth retrying: rate limits, overload and network failures
+RETRYABLE_ERRORS = (
+    error.RateLimitError,
+    error.ServiceUnavailableError,
+    error.TryAgain,
+    error.Timeout,
+    error.APIConnectionError,
+)
+
+
+class CircuitOpenError(error.OpenAIError):
+    """
+    Raised without calling the API while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while. After `threshold`
+    consecutive failures the circuit opens and calls fail fast; after
+    `reset_timeout` seconds a single trial call is let through, which
+    closes the circuit on success and opens it again on failure.
+
+    :param name: The name of the breaker, used as the metrics prefix.
+    :param threshold: The number of consecutive failures to open.
+    :param reset_timeout: Seconds to stay open before a trial call.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns True if a call may be made now.
+        """
+
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    metrics.increment(f'{self.name}.rejected')
+                    return False
+                self._set_state(self.HALF_OPEN)
+
+            if self.state == self.HALF_OPEN:
+                if self.trial:
+                    metrics.increment(f'{self.name}.rejected')
+                    return False
+                self.trial = True
+
+            return True
+
+    def success(self):
+        """
+        Records a call that reached a healthy service.
+        """
+
+        with self._lock:
+            self.failures = 0
+            self.trial = False
+            self._set_state(self.CLOSED)
+
+    def failure(self):
+        """
+        Records a call that failed because of the service.
+        """
+
+        with self._lock:
+            self.failures += 1
+            self.trial = False
+
+            if self.state == self.HALF_OPEN or (
+                self.failures >= self.threshold
+            ):
+                self.opened_at = time.monotonic()
+                if self.state != self.OPEN:
+                    metrics.increment(f'{self.name}.opened')
+                self._set_state(self.OPEN)
+
+    def release(self):
+        """
+        Records a call that ended without an outcome, e.g. cancelled.
+        """
+
+        with self._lock:
+            self.trial = False
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.set_gauge(f'{self.name}.open', int(state == self.OPEN))
+
+
+breaker = CircuitBreaker(
+    'openai.breaker',
+    settings.OPENAI_BREAKER_THRESHOLD,
+    settings.OPENAI_BREAKER_RESET_TIMEOUT
+)
+
+
+def is_retryable(exception):
+    """
+    Returns True if the failed call may succeed when repeated.
+    """
+
+    if isinstance(exception, error.RateLimitError):
+        # Running out of quota is not fixed by waiting
+        return exception.code != 'insufficient_quota'
+
+    if isinstance(exception, RETRYABLE_ERRORS):
+        return True
+
+    return isinstance(exception, error.APIError) and (
+        (exception.http_status or 500) >= 500
+    )
+
+
+def get_retry_after(exception):
+    """
+    Returns the delay in seconds the server asked to wait before
+    retrying, or None if it didn't.
+    """
+
+    value = exception.headers.get('Retry-After')
+
+    try:
+        return max(0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_delay(attempt, exception):
+    """
+    Returns the delay before the next attempt: the server's Retry-After
+    if given, otherwise a jittered exponential backoff.
+
+    :param attempt: The number of the failed attempt, starting from 0.
+    :param exception: The error of the failed attempt.
+    """
+
+    retry_after = get_retry_after(exception)
+    if retry_after is not None:
+        return retry_after
+
+    delay = min(
+        settings.OPENAI_RETRY_MAX_DELAY,
+        settings.OPENAI_RETRY_BASE_DELAY * 2 ** attempt
+    )
+    return random.uniform(0, delay)
+
+
+async def _attempt(create, kwargs, remaining):
+    """
+    Makes a single call within `remaining` seconds, recording its
+    outcome in the circuit breaker.
+    """
+
+    if not breaker.allow():
+        raise CircuitOpenError('OpenAI API is unavailable')
+
+    try:
+        response = await create(**kwargs, request_timeout=(
+            min(settings.OPENAI_CONNECT_TIMEOUT, remaining),
+            min(settings.OPENAI_REQUEST_TIMEOUT, remaining)
+        ))
+    except error.OpenAIError as exception:
+        if is_retryable(exception):
+            breaker.failure()
+            metrics.increment('openai.errors')
+        else:
+            breaker.success()
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+
+    breaker.success()
+    return response
+
+
+async def call(create, **kwargs):
+    """
+    Calls an OpenAI API method, retrying transient failures until
+    `OPENAI_MAX_RETRIES` retries or `OPENAI_DEADLINE` seconds are spent.
+    Fails fast with CircuitOpenError while the circuit breaker is open.
+
+    :param create: The API method, e.g. openai.ChatCompletion.acreate.
+    :param kwargs: The arguments of the method.
+    :return: The response from the OpenAI API.
+    """
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.OPENAI_DEADLINE
+
+    for attempt in itertools.count():
+        try:
+            return await _attempt(create, kwargs, deadline - loop.time())
+        except error.OpenAIError as exception:
+            if not is_retryable(exception) or (
+                attempt >= settings.OPENAI_MAX_RETRIES
+            ):
+                raise
+
+            delay = get_retry_delay(attempt, exception)
+            if loop.time() + delay >= deadline:
+                raise
+
+        metrics.increment('openai.retries')
+        await asyncio.sleep(delay)
@@ -0,0 +1,333 @@
+import time
+import threading
+
+from abc import ABC, abstractmethod
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, CallbackContext
+
+from bot import metrics
+from bot.cache import TTLCache
+from bot.helpers import logger
+from bot.tokens import num_tokens_from_string
+
+
+# Commands that call the OpenAI API and the tokens they are expected
+# to use on top of their text; plain text messages are chats
+COMMAND_TOKENS = {
+    'retry': settings.RATE_LIMIT_CHAT_TOKENS,
+    'save': settings.RATE_LIMIT_CHAT_TOKENS,
+    'img': settings.RATE_LIMIT_IMAGE_TOKENS,
+    'sum': settings.SUMMARY_CHUNK_TOKENS,
+}
+
+SLOW_DOWN_MESSAGE = (
+    "⏳ Slow down, please! Too many requests. "
+    "Try again in {seconds} s."
+)
+
+# Users asked to slow down, by the time until which they aren't asked
+# again, so that flooding doesn't multiply outgoing messages
+slow_down_notices = TTLCache('slow_down_notices', 10000, 60)
+
+
+class Limit:
+    """
+    A token bucket: holds up to `capacity` tokens and refills
+    `capacity` tokens every `period` seconds.
+
+    :param name: The name of the bucket, part of the backend key.
+    :param capacity: The size of the bucket.
+    :param period: The time to refill the bucket in seconds.
+    """
+
+    def __init__(self, name, capacity, period=60):
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / period
+
+    def refill(self, state, now):
+        """
+        Returns the level of the bucket at `now` from its stored state.
+        """
+
+        if state is None:
+            return self.capacity
+
+        level, updated = state
+        return min(self.capacity, level + (now - updated) * self.rate)
+
+    def wait(self, level, cost):
+        """
+        Returns the seconds until the bucket has `cost` tokens.
+        """
+
+        if cost > self.capacity:
+            return float('inf')
+        return max(0, (cost - level) / self.rate)
+
+
+class Backend(ABC):
+    """
+    Stores the buckets. Subclasses implement `consume`.
+    """
+
+    @abstractmethod
+    async def consume(self, charges):
+        """
+        Takes tokens from several buckets at once: either from all
+        of them, or, if any of them doesn't have enough, from none.
+
+        :param charges: A list of (key, limit, cost) tuples.
+        :return: 0 if the tokens were taken, otherwise the number of
+        seconds until they are available.
+        """
+
+    @staticmethod
+    def charge(charges, states, now):
+        """
+        Computes the new states of the buckets.
+
+        :param charges: A list of (key, limit, cost) tuples.
+        :param states: The stored states of the buckets by key.
+        :param now: The current time.
+        :return: A tuple of the seconds to wait and the new states,
+        which are None if the tokens can't be taken.
+        """
+
+        levels = [
+            limit.refill(states.get(key), now)
+            for key, limit, cost in charges
+        ]
+        wait = max(
+            limit.wait(level, cost)
+            for level, (key, limit, cost) in zip(levels, charges)
+        )
+
+        if wait > 0:
+            return wait, None
+
+        return 0, {
+            key: (level - cost, now)
+            for level, (key, limit, cost) in zip(levels, charges)
+        }
+
+
+class MemoryBackend(Backend):
+    """
+    Keeps the buckets in process memory.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    async def consume(self, charges):
+        with self._lock:
+            wait, states = self.charge(
+                charges, self.buckets, time.monotonic()
+            )
+            if states:
+                self.buckets.update(states)
+
+        return wait
+
+
+class CacheBackend(Backend):
+    """
+    Keeps the buckets in the Django cache `RATE_LIMIT_CACHE`, so that
+    they are shared by all processes using the same cache (e.g. Redis).
+    The read-modify-write is not atomic across processes, so concurrent
+    requests may occasionally be admitted over the limit.
+    """
+
+    def __init__(self):
+        self.cache = caches[settings.RATE_LIMIT_CACHE]
+
+    async def consume(self, charges):
+        charges = [
+            (f'ratelimit:{key}', limit, cost)
+            for key, limit, cost in charges
+        ]
+        stored = await self.cache.aget_many([key for key, *_ in charges])
+
+        wait, states = self.charge(charges, stored, time.time())
+        if states:
+            await self.cache.aset_many(states, timeout=None)
+
+        return wait
+
+
+class Admission:
+    """
+    Admits requests while both the user's and the global buckets,
+    counted in requests and in estimated tokens, are not empty.
+
+    :param backend: The backend storing the buckets.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.user_requests = Limit(
+            'user_requests', settings.RATE_LIMIT_USER_REQUESTS
+        )
+        self.user_tokens = Limit(
+            'user_tokens', settings.RATE_LIMIT_USER_TOKENS
+        )
+        self.global_requests = Limit(
+            'global_requests', settings.RATE_LIMIT_GLOBAL_REQUESTS
+        )
+        self.global_tokens = Limit(
+            'global_tokens', settings.RATE_LIMIT_GLOBAL_TOKENS
+        )
+
+    async def admit(self, telegram_id, tokens):
+        """
+        Takes one request and `tokens` tokens from the buckets.
+
+        :param telegram_id: The user's Telegram ID.
+        :param tokens: The estimated number of tokens of the request.
+        :return: 0 if the request is admitted, otherwise the number of
+        seconds to wait before retrying.
+        """
+
+        return await self.backend.consume([
+            (f'{telegram_id}:requests', self.user_requests, 1),
+            (f'{telegram_id}:tokens', self.user_tokens, tokens),
+            ('global:requests', self.global_requests, 1),
+            ('global:tokens', self.global_tokens, tokens),
+        ])
+
+    async def charge(self, telegram_id, tokens):
+        """
+        Takes `tokens` more tokens for an admitted request
+        once its cost turns out to be higher than estimated.
+
+        :param telegram_id: The user's Telegram ID.
+        :param tokens: The number of additional tokens.
+        :return: 0 if the tokens were taken, otherwise the number of
+        seconds to wait before retrying.
+        """
+
+        return await self.backend.consume([
+            (f'{telegram_id}:tokens', self.user_tokens, tokens),
+            ('global:tokens', self.global_tokens, tokens),
+        ])
+
+
+admission = Admission(import_string(settings.RATE_LIMIT_BACKEND)())
+
+
+def estimate_tokens(message):
+    """
+    Estimates the number of tokens a message will use.
+
+    :param message: The incoming Telegram message.
+    :return: The estimated number of tokens, or None if the message
+    doesn't call the OpenAI API.
+    """
+
+    text = message.text or ''
+
+    if not text.startswith('/'):
+        return num_tokens_from_string(text) + settings.RATE_LIMIT_CHAT_TOKENS
+
+    command, _, arguments = text[1:].partition(' ')
+    command = command.split('@')[0]
+
+    if command not in COMMAND_TOKENS:
+        return None
+
+    return num_tokens_from_string(arguments) + COMMAND_TOKENS[command]
+
+
+async def check_admission(update: Update, context: CallbackContext):
+    """
+    Stops processing of the update and asks the user to slow down
+    if the request is over the rate limits.
+    """
+
+    message = update.message
+    if message is None or message.text is None:
+        return
+
+    tokens = estimate_tokens(message)
+    if tokens is None:
+        return
+
+    wait = await admission.admit(message.chat.id, tokens)
+    if wait == 0:
+        metrics.increment('ratelimit.admitted')
+        return
+
+    await reject(message, context, wait)
+    raise ApplicationHandlerStop
+
+
+async def reject(message, context, wait):
+    """
+    Asks the user to slow down, at most once until the time
+    the user was told to wait for has passed.
+
+    :param message: The rate limited Telegram message.
+    :param wait: The number of seconds to wait before retrying.
+    """
+
+    logger.warning(
+        "Rate limited. Chat ID: %s. Retry in %s s",
+        message.chat_id,
+        wait
+    )
+    metrics.increment('ratelimit.rejected')
+
+    now = time.monotonic()
+    if slow_down_notices.peek(message.chat_id, 0) > now:
+        return
+
+    seconds = 60 if wait == float('inf') else max(1, round(wait))
+    slow_down_notices.set(message.chat_id, now + seconds)
+    await context.bot.send_message(
+        chat_id=message.chat_id,
+        text=SLOW_DOWN_MESSAGE.format(seconds=seconds)
+    )
+
+
+def estimate_summary_tokens(content):
+    """
+    Estimates the number of tokens summarizing a document will use
+    beyond its first chunk, which is charged on admission.
+
+    :param content: The text of the document.
+    :return: The estimated number of tokens.
+    """
+
+    chunk_tokens = settings.SUMMARY_CHUNK_TOKENS
+    chunks = min(
+        -(-num_tokens_from_string(content) // chunk_tokens),
+        settings.SUMMARY_MAX_CHUNKS
+    )
+
+    return max(0, chunks - 1) * chunk_tokens
+
+
+async def admit_summary(update: Update, context: CallbackContext, content):
+    """
+    Charges the rest of the tokens of summarizing a document
+    and asks the user to slow down if it is over the rate limits.
+
+    :param content: The text of the document.
+    :return: True if the summary may be generated.
+    """
+
+    tokens = estimate_summary_tokens(content)
+    if tokens == 0:
+        return True
+
+    wait = await admission.charge(update.message.chat.id, tokens)
+    if wait == 0:
+        return True
+
+    await reject(update.message, context, wait)
+    return False
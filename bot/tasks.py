@@ -0,0 +1,274 @@
+import asyncio
+
+from django.conf import settings
+
+from bot import database, metrics
+from bot.helpers import (
+    get_conversation_topic, get_conversation_summary,
+    get_conversation_history, select_messages_to_fold,
+    fold_conversation_memory, logger
+)
+
+
+registry = {}
+
+
+def task(name):
+    """
+    A decorator that registers a coroutine function as a background
+    task under the given name.
+
+    :param name: The name to enqueue the task by.
+    :return: A decorator for the function.
+    """
+
+    def decorator(func):
+        registry[name] = func
+        return func
+    return decorator
+
+
+class TaskQueue:
+    """
+    A queue of background jobs processed by a pool of asyncio workers
+    in the event loop the queue was started in.
+
+    The number of workers limits how many jobs run concurrently. A job
+    that raises is retried with exponential backoff up to `max_retries`
+    times. Jobs that don't fit into the queue or are left when it stops
+    are stored in the database and picked up by `run_stored_jobs`.
+
+    :param workers: The number of workers.
+    :param max_size: The maximum number of queued jobs.
+    :param max_retries: The number of retries of a failing job.
+    :param retry_delay: The delay before the first retry in seconds.
+    """
+
+    def __init__(self, workers, max_size, max_retries, retry_delay):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Bot used by tasks to notify users
+        self.bot = None
+        self._loop = None
+        self._queue = None
+        self._workers = []
+        self._keys = set()
+
+    @property
+    def running(self):
+        """
+        Whether the workers are running in the current event loop.
+        """
+
+        try:
+            return self._loop is asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+
+    def start(self):
+        """
+        Starts the workers in the running event loop.
+        """
+
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.max_size)
+        self._keys = set()
+        self._workers = [
+            self._loop.create_task(self._work())
+            for _ in range(self.workers)
+        ]
+
+    async def enqueue(self, name, key=None, **kwargs):
+        """
+        Schedules a registered task to run in the background,
+        starting the workers on first use.
+
+        :param name: The name of the task.
+        :param key: An optional key; a job is not queued while another
+        one with the same key is waiting or running.
+        :param kwargs: JSON serializable keyword arguments of the task.
+        """
+
+        if key is not None and key in self._keys:
+            return
+
+        if not self.running:
+            self.start()
+
+        try:
+            self._queue.put_nowait((name, kwargs, key))
+        except asyncio.QueueFull:
+            logger.warning('Task queue is full, storing job: %s', name)
+            metrics.increment('tasks.stored')
+            await database.create_job(name, kwargs)
+            return
+
+        if key is not None:
+            self._keys.add(key)
+        metrics.set_gauge('tasks.queued', self._queue.qsize())
+
+    async def _work(self):
+        while True:
+            name, kwargs, key = await self._queue.get()
+            try:
+                await self.run(name, kwargs)
+            except asyncio.CancelledError:
+                await database.create_job(name, kwargs)
+                raise
+            finally:
+                self._keys.discard(key)
+                self._queue.task_done()
+
+    async def run(self, name, kwargs, attempts=0):
+        """
+        Runs a task, retrying it with exponential backoff when it fails.
+        A task that runs out of retries is stored as failed.
+
+        :param name: The name of the task.
+        :param kwargs: The keyword arguments of the task.
+        :param attempts: The number of attempts already made.
+        :return: True if the task succeeded, False otherwise.
+        """
+
+        while True:
+            try:
+                await registry[name](**kwargs)
+            except Exception as error:
+                attempts += 1
+
+                if attempts > self.max_retries:
+                    logger.error('Task %s failed: %r', name, error)
+                    metrics.increment('tasks.failed')
+                    await database.create_job(
+                        name, kwargs, attempts, error=repr(error), failed=True
+                    )
+                    return False
+
+                logger.warning('Task %s will be retried: %r', name, error)
+                metrics.increment('tasks.retried')
+                await asyncio.sleep(self.retry_delay * 2 ** (attempts - 1))
+            else:
+                metrics.increment('tasks.completed')
+                return True
+
+    async def stop(self, timeout=None):
+        """
+        Waits for the queued jobs to finish, then stops the workers.
+        Jobs that are not finished in time are stored in the database.
+
+        :param timeout: The number of seconds to wait for.
+        """
+
+        if not self.running:
+            return
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Task queue is not drained, storing jobs')
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+        while not self._queue.empty():
+            name, kwargs, key = self._queue.get_nowait()
+            await database.create_job(name, kwargs)
+
+        self._loop = None
+        self._workers = []
+
+    async def send_message(self, chat_id, text):
+        """
+        Sends a message to the user if the queue has a bot.
+        """
+
+        if self.bot is not None:
+            await self.bot.send_message(chat_id=chat_id, text=text)
+
+
+task_queue = TaskQueue(
+    workers=settings.TASK_WORKERS,
+    max_size=settings.TASK_QUEUE_SIZE,
+    max_retries=settings.TASK_MAX_RETRIES,
+    retry_delay=settings.TASK_RETRY_DELAY
+)
+
+
+async def run_stored_jobs(limit=100):
+    """
+    Runs the due jobs stored in the database,
+    at most `TASK_WORKERS` at a time.
+
+    :param limit: The maximum number of jobs to run.
+    :return: The number of jobs run.
+    """
+
+    jobs = await database.claim_jobs(limit)
+    semaphore = asyncio.Semaphore(task_queue.workers)
+
+    async def run(job):
+        async with semaphore:
+            await task_queue.run(job.name, job.payload, job.attempts)
+
+    await asyncio.gather(*(run(job) for job in jobs))
+
+    return len(jobs)
+
+
+@task('chat_topic')
+async def generate_chat_topic(telegram_id, chat_id, request):
+    """
+    Generates the topic of a chat from its first exchange.
+    """
+
+    topic = await get_conversation_topic(list(request), telegram_id)
+    await database.update_chat(telegram_id, chat_id, topic=topic[:250])
+
+
+@task('chat_summary')
+async def generate_chat_summary(telegram_id, chat_id):
+    """
+    Generates a new summary and title for a chat and notifies the user.
+    """
+
+    chat = await database.get_chat(chat_id)
+    if chat is None:
+        return
+
+    request = await get_conversation_history(telegram_id, chat)
+    summary = await get_conversation_summary(request, telegram_id)
+
+    request = [None, {"role": "assistant", "content": summary}]
+    title = await get_conversation_topic(request, telegram_id)
+
+    await database.update_chat(
+        telegram_id, chat_id, summary=summary[:1000], topic=title[:250]
+    )
+    await task_queue.send_message(telegram_id, f"Chat saved: {title}")
+
+
+@task('chat_memory')
+async def update_chat_memory(telegram_id, chat_id):
+    """
+    Folds the oldest turns of a chat into its rolling memory, so they
+    are sent to the model as a short summary instead of in full.
+    """
+
+    chat = await database.get_chat(chat_id)
+    if chat is None:
+        return
+
+    messages = await database.get_unfolded_messages(telegram_id, chat)
+    messages = select_messages_to_fold(messages)
+    if not messages:
+        return
+
+    memory = await fold_conversation_memory(
+        chat.memory, messages, telegram_id
+    )
+    await database.update_chat(
+        telegram_id, chat_id, memory=memory, memory_date=messages[-1].date
+    )
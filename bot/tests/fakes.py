@@ -0,0 +1,196 @@
+import json
+import asyncio
+
+from aiohttp import web
+from telegram.request import BaseRequest
+
+
+BOT_USER = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'Bot',
+    'username': 'test_bot',
+}
+
+
+class FakeRequest(BaseRequest):
+    """
+    A Telegram request backend answering every Bot API call locally.
+
+    :param latency: Simulated network round trip in seconds.
+    :param updates: Updates returned by the first getUpdates call.
+    """
+
+    def __init__(self, latency=0, updates=()):
+        self.latency = latency
+        self.updates = list(updates)
+        self.calls = []
+        self.initialized = 0
+
+    async def initialize(self):
+        self.initialized += 1
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args,
+                         **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls.append(endpoint)
+        await asyncio.sleep(self.latency)
+
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint == 'getUpdates':
+            result, self.updates = self.updates, []
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': len(self.calls),
+                'date': 0,
+                'chat': {'id': 1, 'type': 'private'},
+                'text': 'text',
+            }
+        else:
+            result = True
+
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def make_update_data(update_id=1, text='Hello', chat_id=1):
+    """
+    Builds the JSON payload of a text message update.
+    """
+
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'first_name': 'Test', 'is_bot': False},
+            'text': text,
+        },
+    }
+
+
+class FakeOpenAIServer:
+    """
+    A local HTTP server imitating the OpenAI API.
+
+    :param delay: Seconds to wait before answering each request.
+    :param answer: The content of every chat completion.
+    :param chunk_delay: Seconds between the words of a streamed answer.
+    :param faults: HTTP error statuses, or (status, headers) tuples,
+    returned instead of the answers to the first requests.
+    """
+
+    def __init__(self, delay=0, answer='Test answer', chunk_delay=0,
+                 faults=()):
+        self.delay = delay
+        self.answer = answer
+        self.chunk_delay = chunk_delay
+        self.faults = list(faults)
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_post('/v1/images/generations', self.images)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/v1'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def fault(self):
+        """
+        Returns the next injected error response, if any.
+        """
+
+        if not self.faults:
+            return None
+
+        fault = self.faults.pop(0)
+        status, headers = fault if isinstance(fault, tuple) else (fault, {})
+        return web.json_response(
+            {'error': {'message': f'Fault {status}', 'type': 'server_error'}},
+            status=status,
+            headers=headers
+        )
+
+    async def respond(self, request, body):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return web.json_response(body)
+
+    async def stream(self, request):
+        response = web.StreamResponse(
+            headers={'Content-Type': 'text/event-stream'}
+        )
+        await response.prepare(request)
+
+        for index, word in enumerate(self.answer.split(' ')):
+            await asyncio.sleep(self.chunk_delay)
+            content = word if index == 0 else f' {word}'
+            chunk = {
+                'object': 'chat.completion.chunk',
+                'choices': [{
+                    'index': 0,
+                    'delta': {'content': content},
+                    'finish_reason': None,
+                }],
+            }
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests.append(body)
+
+        fault = self.fault()
+        if fault is not None:
+            return fault
+
+        if body.get('stream'):
+            return await self.stream(request)
+
+        return await self.respond(request, {
+            'id': 'chatcmpl-test',
+            'object': 'chat.completion',
+            'created': 0,
+            'model': 'gpt-3.5-turbo',
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': self.answer},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': 10,
+                'completion_tokens': 5,
+                'total_tokens': 15,
+            },
+        })
+
+    async def images(self, request):
+        self.requests.append(await request.json())
+        return await self.respond(request, {
+            'created': 0,
+            'data': [{'url': 'https://example.com/image.png'}],
+        })
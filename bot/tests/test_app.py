@@ -0,0 +1,46 @@
+import os
+import signal
+import asyncio
+from unittest import TestCase
+from unittest.mock import AsyncMock, patch
+
+from telegram.ext import Application, MessageHandler, filters
+
+from bot import app
+from bot.tests.fakes import FakeRequest, make_update_data
+
+
+class TestPollingWorker(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def test_drains_in_flight_updates(self):
+        started = []
+        finished = []
+
+        async def slow(update, context):
+            started.append(update.message.text)
+            if len(started) == 2:
+                # Both updates are in flight when the worker is stopped
+                os.kill(os.getpid(), signal.SIGINT)
+            await asyncio.sleep(0.2)
+            finished.append(update.message.text)
+
+        updates = FakeRequest(updates=[
+            make_update_data(1, 'First', chat_id=1),
+            make_update_data(2, 'Second', chat_id=2),
+        ])
+        application = Application.builder().token('123:abc').request(
+            FakeRequest()
+        ).get_updates_request(updates).concurrent_updates(True).build()
+        application.add_handler(MessageHandler(filters.TEXT, slow))
+
+        with patch('bot.tasks.task_queue.stop', AsyncMock()) as mock_stop:
+            app.run(application, close_loop=False)
+
+        self.assertCountEqual(finished, ['First', 'Second'])
+        self.assertIn('getUpdates', updates.calls)
+        mock_stop.assert_awaited_once()
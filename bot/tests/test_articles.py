@@ -0,0 +1,164 @@
+import asyncio
+from aiohttp import web
+from django.test import override_settings
+from unittest import IsolatedAsyncioTestCase, TestCase
+from unittest.mock import AsyncMock, patch
+
+from bot import articles, helpers
+from bot.articles import ArticleFetchError, normalize_url
+
+
+PARAGRAPH = (
+    "The quick brown fox jumps over the lazy dog while the curious cat "
+    "watches from the window, wondering why anyone would jump at all. "
+)
+ARTICLE = (
+    "<html><head><title>Article</title></head><body><article>"
+    "<h1>Foxes and dogs</h1>"
+    + "".join(f"<p>{PARAGRAPH * 3}</p>" for _ in range(5))
+    + "</article></body></html>"
+)
+API_RESPONSE = {
+    'choices': [{'message': {'content': 'Summary'}}],
+    'usage': {'completion_tokens': 5, 'prompt_tokens': 10},
+}
+
+
+class TestNormalizeUrl(TestCase):
+    def test_normalize_url(self):
+        self.assertEqual(
+            normalize_url(
+                'HTTPS://Example.COM:443/post?b=2&utm_source=x&a=1#comments'
+            ),
+            'https://example.com/post?a=1&b=2'
+        )
+
+    def test_normalize_url_keeps_custom_port(self):
+        self.assertEqual(
+            normalize_url('http://example.com:8080'),
+            'http://example.com:8080/'
+        )
+
+    def test_malformed_url(self):
+        for url in (
+            'http://example.com:99999/',
+            'http://example.com:abc/x',
+            'http://[::1/',
+        ):
+            with self.subTest(url=url):
+                with self.assertRaises(ArticleFetchError):
+                    normalize_url(url)
+
+
+class TestArticles(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+
+        app = web.Application()
+        app.router.add_get('/article', self.article)
+        app.router.add_get('/plain', self.plain)
+        app.router.add_get('/unknown', self.unknown)
+        app.router.add_get('/large', self.large)
+        app.router.add_get('/slow', self.slow)
+        app.router.add_get('/missing', self.missing)
+        app.router.add_get('/empty', self.empty)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+
+        overrider = override_settings(
+            ARTICLE_MAX_SIZE=10000, ARTICLE_FETCH_TIMEOUT=0.2
+        )
+        overrider.enable()
+        self.addCleanup(overrider.disable)
+
+        articles.article_cache.clear()
+        self.addAsyncCleanup(self.runner.cleanup)
+        self.addAsyncCleanup(articles.close_session)
+
+    async def article(self, request):
+        self.requests.append(request.path_qs)
+        return web.Response(text=ARTICLE, content_type='text/html')
+
+    async def plain(self, request):
+        return web.Response(
+            body=ARTICLE.encode(), headers={'Content-Type': 'text/html'}
+        )
+
+    async def unknown(self, request):
+        return web.Response(
+            body=ARTICLE.encode(),
+            headers={'Content-Type': 'text/html; charset=unknown'}
+        )
+
+    async def large(self, request):
+        self.requests.append(request.path_qs)
+        return web.Response(text='a' * 20000, content_type='text/html')
+
+    async def slow(self, request):
+        await asyncio.sleep(1)
+        return web.Response(text=ARTICLE, content_type='text/html')
+
+    async def missing(self, request):
+        return web.Response(status=404)
+
+    async def empty(self, request):
+        return web.Response(text='<html></html>', content_type='text/html')
+
+    async def test_get_content_from_url(self):
+        content = await helpers.get_content_from_url(f'{self.url}/article')
+
+        self.assertIn('quick brown fox', content)
+
+    async def test_article_cached_by_normalized_url(self):
+        await articles.get_article(f'{self.url}/article?utm_source=x')
+        await articles.get_article(f'{self.url}/article#top')
+
+        self.assertEqual(self.requests, ['/article?utm_source=x'])
+
+    async def test_no_charset(self):
+        page = await articles.fetch_url(f'{self.url}/plain')
+
+        self.assertEqual(page, ARTICLE)
+
+    async def test_unknown_charset(self):
+        page = await articles.fetch_url(f'{self.url}/unknown')
+
+        self.assertEqual(page, ARTICLE)
+
+    async def test_too_large(self):
+        with self.assertRaises(ArticleFetchError):
+            await articles.fetch_url(f'{self.url}/large')
+
+    async def test_timeout(self):
+        with self.assertRaises(ArticleFetchError):
+            await articles.fetch_url(f'{self.url}/slow')
+
+    async def test_http_error(self):
+        with self.assertRaises(ArticleFetchError):
+            await articles.fetch_url(f'{self.url}/missing')
+
+    async def test_no_text(self):
+        with self.assertRaises(ArticleFetchError):
+            await articles.get_article(f'{self.url}/empty')
+
+        self.assertEqual(len(articles.article_cache), 0)
+
+    @patch('bot.helpers.call_openai_api', new_callable=AsyncMock)
+    async def test_article_summary_cached(self, mock_call):
+        mock_call.return_value = API_RESPONSE
+
+        first = await helpers.get_article_summary(f'{self.url}/article')
+        second = await helpers.get_article_summary(f'{self.url}/article#top')
+
+        self.assertEqual(first, API_RESPONSE)
+        self.assertEqual(second, {
+            'choices': API_RESPONSE['choices'],
+            'usage': helpers.CACHED_USAGE,
+        })
+        self.assertEqual(len(self.requests), 1)
+        mock_call.assert_awaited_once()
@@ -0,0 +1,184 @@
+import os
+import asyncio
+import time
+import tiktoken
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from django import test
+
+from chats.models import Chat, Text
+from bot import bot, database, helpers, tokens
+from bot.tests.fakes import FakeRequest, make_update_data
+from bot.tests.test_bot import make_application
+
+
+BENCHMARK = os.getenv('BENCHMARK') == 'True'
+UPDATES = 50
+LATENCY = 0.01
+
+
+def report(name, before, after):
+    print(
+        f"\n{name}: before {before * 1000:.2f} ms, "
+        f"after {after * 1000:.2f} ms ({before / after:.1f}x)"
+    )
+
+
+@skipUnless(BENCHMARK, "Set BENCHMARK=True to run benchmarks")
+class BenchmarkWebhookUpdate(TestCase):
+    """
+    Per-update overhead of the webhook path: a new event loop plus
+    application initialize/shutdown per update versus the persistent
+    application of the worker process.
+    """
+
+    def setUp(self):
+        patcher = patch.object(
+            bot, 'application', make_application(FakeRequest(LATENCY))
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(bot.shutdown)
+
+    def test_per_update_overhead(self):
+        start = time.perf_counter()
+        for update_id in range(UPDATES):
+            asyncio.run(bot.run(make_update_data(update_id)))
+        before = (time.perf_counter() - start) / UPDATES
+
+        bot.process(make_update_data(0))
+        start = time.perf_counter()
+        for update_id in range(UPDATES):
+            bot.process(make_update_data(update_id))
+        after = (time.perf_counter() - start) / UPDATES
+
+        report('Webhook update', before, after)
+        self.assertLess(after, before)
+
+
+def legacy_truncate_messages(messages, text, *args, **kwargs):
+    """
+    `truncate_messages` as it was before the tiktoken encoder was cached:
+    the encoder is looked up and every string is re-counted on each call.
+    """
+
+    def num_tokens(string):
+        return len(tiktoken.get_encoding("cl100k_base").encode(string))
+
+    truncated_messages = []
+    total_tokens = 0
+
+    for message in messages:
+        system_tokens = num_tokens(helpers.system['content'])
+        request_tokens = num_tokens(message.request)
+        response_tokens = num_tokens(message.response)
+        text_tokens = num_tokens(text)
+
+        temp_tokens = system_tokens + text_tokens + 200
+        message_tokens = request_tokens + response_tokens
+
+        if total_tokens + temp_tokens + message_tokens <= 4096:
+            truncated_messages.append(message)
+            total_tokens += message_tokens
+        else:
+            break
+
+    return truncated_messages
+
+
+@skipUnless(BENCHMARK, "Set BENCHMARK=True to run benchmarks")
+@test.override_settings(OPENAI_MODEL='gpt-3.5-turbo-16k')
+class BenchmarkConversationHistory(test.TestCase):
+    """
+    `get_conversation_history` on a 500-message chat, called once per
+    incoming message, with and without the cached token counting.
+    The model's context fits the whole chat.
+    """
+
+    MESSAGES = 500
+    CALLS = 10
+
+    def setUp(self):
+        self.chat = Chat.objects.create(telegram_id='1')
+        Text.objects.bulk_create(
+            Text(
+                telegram_id='1',
+                chat=self.chat,
+                request=f'Question {number}',
+                response=f'Answer {number}',
+            )
+            for number in range(self.MESSAGES)
+        )
+        helpers.get_encoding()
+
+    def measure(self):
+        start = time.perf_counter()
+        for _ in range(self.CALLS):
+            history = async_to_sync(helpers.get_conversation_history)(
+                '1', self.chat, 'Hello'
+            )
+        self.assertEqual(len(history), self.MESSAGES * 2 + 1)
+        return (time.perf_counter() - start) / self.CALLS
+
+    def test_get_conversation_history(self):
+        with patch.object(
+            helpers, 'truncate_messages', legacy_truncate_messages
+        ):
+            before = self.measure()
+
+        tokens.count_tokens.cache_clear()
+        after = self.measure()
+
+        report('Conversation history (500 messages)', before, after)
+        self.assertLess(after, before)
+
+
+@skipUnless(BENCHMARK, "Set BENCHMARK=True to run benchmarks")
+class BenchmarkHistoryQuery(test.TestCase):
+    """
+    Loading the token-bounded history of chats with 10, 1k and 50k
+    messages: iterating the whole queryset versus the paged loader.
+    """
+
+    SIZES = (10, 1000, 50000)
+    CALLS = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.chats = {}
+        for size in cls.SIZES:
+            chat = Chat.objects.create(telegram_id=str(size))
+            Text.objects.bulk_create(
+                (
+                    Text(
+                        telegram_id=str(size),
+                        chat=chat,
+                        request=f'Question {number}',
+                        response=f'Answer {number}',
+                        request_tokens=10,
+                        response_tokens=20,
+                    )
+                    for number in range(size)
+                ),
+                batch_size=1000
+            )
+            cls.chats[size] = chat
+
+    def measure(self, load_messages, size):
+        chat = self.chats[size]
+        start = time.perf_counter()
+        for _ in range(self.CALLS):
+            messages = load_messages(str(size), chat)
+            helpers.truncate_messages(messages, 'Hello')
+        return (time.perf_counter() - start) / self.CALLS
+
+    def test_history_query(self):
+        for size in self.SIZES:
+            before = self.measure(database.get_message_objects, size)
+            after = self.measure(database.iter_message_objects, size)
+
+            report(f'History query ({size} messages)', before, after)
+            if size > database.HISTORY_PAGE_SIZE:
+                self.assertLess(after, before)
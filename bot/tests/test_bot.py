@@ -0,0 +1,126 @@
+import asyncio
+from unittest import TestCase, IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from django.test import AsyncRequestFactory
+from telegram.ext import Application, MessageHandler, filters
+
+from bot import bot, dedup
+from config import asgi
+from bot.models import ReceivedUpdate
+from bot.views import TelegramBotWebhookAsyncView
+from bot.tests.fakes import FakeRequest, make_update_data
+
+
+async def echo(update, context):
+    await context.bot.send_message(
+        chat_id=update.message.chat_id,
+        text=update.message.text
+    )
+
+
+def make_application(request):
+    application = Application.builder().token('123:abc').request(
+        request
+    ).get_updates_request(FakeRequest()).build()
+    application.add_handler(MessageHandler(filters.TEXT, echo))
+    return application
+
+
+class TestPersistentApplication(TestCase):
+    def setUp(self):
+        self.request = FakeRequest()
+        patcher = patch.object(
+            bot, 'application', make_application(self.request)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(bot.shutdown)
+
+    def test_process_initializes_once(self):
+        for update_id in range(1, 4):
+            bot.process(make_update_data(update_id))
+
+        self.assertEqual(self.request.calls.count('getMe'), 1)
+        self.assertEqual(self.request.calls.count('sendMessage'), 3)
+        self.assertTrue(bot.application._initialized)
+
+    def test_shutdown(self):
+        bot.process(make_update_data())
+        bot.shutdown()
+
+        self.assertIsNone(bot._loop)
+        self.assertFalse(bot.application._initialized)
+
+
+class TestWebhookAsyncView(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.release = asyncio.Event()
+        self.processed = []
+
+        async def slow_handler(update, context):
+            await self.release.wait()
+            self.processed.append(update.update_id)
+
+        self.application = Application.builder().token('123:abc').request(
+            FakeRequest()
+        ).get_updates_request(FakeRequest()).concurrent_updates(8).build()
+        self.application.add_handler(MessageHandler(filters.TEXT, slow_handler))
+
+        patcher = patch.object(bot, 'application', self.application)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        if self.application.running:
+            await self.application.stop()
+        await self.application.shutdown()
+        await sync_to_async(ReceivedUpdate.objects.all().delete)()
+        dedup.reset()
+
+    async def post_updates(self, count):
+        view = TelegramBotWebhookAsyncView.as_view()
+
+        for update_id in range(1, count + 1):
+            request = AsyncRequestFactory().post(
+                '/bot/webhook/',
+                data=make_update_data(update_id),
+                content_type='application/json'
+            )
+            response = await view(request)
+            self.assertEqual(response.status_code, 200)
+
+    async def test_acknowledges_before_processing(self):
+        await self.post_updates(3)
+
+        self.assertEqual(self.processed, [])
+        self.assertTrue(self.application.running)
+
+        self.release.set()
+        await asyncio.wait_for(self.application.update_queue.join(), 1)
+        await asyncio.sleep(0)
+
+        self.assertEqual(sorted(self.processed), [1, 2, 3])
+
+    async def test_lifespan_shutdown_drains_updates(self):
+        await self.post_updates(3)
+        messages = iter([
+            {'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}
+        ])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        self.release.set()
+        await asgi.application({'type': 'lifespan'}, receive, send)
+
+        self.assertEqual(sorted(self.processed), [1, 2, 3])
+        self.assertFalse(self.application.running)
+        self.assertEqual(sent, [
+            'lifespan.startup.complete', 'lifespan.shutdown.complete'
+        ])
@@ -0,0 +1,64 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from bot import metrics
+from bot.cache import TTLCache
+
+
+class TestTTLCache(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.cache = TTLCache('test_cache', maxsize=2, ttl=10)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(metrics.get_metrics(), {
+            'test_cache.hits': 1,
+            'test_cache.misses': 1,
+            'test_cache.size': 1,
+        })
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), 3)
+
+    @patch('bot.cache.time.monotonic')
+    def test_expires(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.cache.set('a', 1)
+
+        mock_monotonic.return_value = 109
+        self.assertEqual(self.cache.get('a'), 1)
+
+        mock_monotonic.return_value = 110
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_peek(self):
+        self.cache.set('a', 1)
+
+        self.assertEqual(self.cache.peek('a'), 1)
+        self.assertIsNone(self.cache.peek('b'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+
+    def test_delete_clear(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+
+        self.cache.delete('a')
+        self.assertNotIn('a', self.cache)
+        self.assertIn('b', self.cache)
+
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
@@ -1,17 +1,38 @@
-from django.test import TestCase
+import os
+import re
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from unittest.mock import patch
+
+from django.db import DatabaseError, connection, connections, transaction
+from django.test import TestCase, override_settings
 from asgiref.sync import async_to_sync
-from chats.models import Chat, Text
+from chats.models import Chat, Text, Usage
+from bot import metrics
+from bot.llm import get_cost
 from bot.database import (
+    chat_cache,
+    invalidate_chat,
     get_or_create_chat,
     get_messages_count,
     create_message_entry,
+    record_exchange,
+    record_usage,
     get_message_objects,
-    get_last_text_entry
+    iter_message_objects,
+    get_unfolded_messages,
+    get_last_text_entry,
+    update_chat,
+    WriteBuffer
 )
 
 
 class BotDatabaseTestCase(TestCase):
     def setUp(self):
+        chat_cache.clear()
         self.telegram_id = '12345'
         self.chat = Chat.objects.create(telegram_id=self.telegram_id)
 
@@ -20,6 +41,49 @@ class BotDatabaseTestCase(TestCase):
         self.assertIsNotNone(chat)
         self.assertEqual(chat.telegram_id, self.telegram_id)
 
+    def test_get_or_create_chat_cached(self):
+        hits, misses = chat_cache.hits, chat_cache.misses
+        chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+
+        with self.assertNumQueries(0):
+            cached_chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+
+        self.assertIs(cached_chat, chat)
+        self.assertEqual(chat_cache.hits - hits, 1)
+        self.assertEqual(chat_cache.misses - misses, 1)
+
+    def test_update_chat_updates_cache(self):
+        chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+        async_to_sync(update_chat)(self.telegram_id, chat.pk, topic='Topic')
+
+        with self.assertNumQueries(0):
+            cached_chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+
+        self.assertEqual(cached_chat.topic, 'Topic')
+        self.assertEqual(Chat.objects.get(pk=chat.pk).topic, 'Topic')
+
+    def test_get_or_create_new_chat_updates_cache(self):
+        async_to_sync(get_or_create_chat)(self.telegram_id)
+        new_chat = async_to_sync(get_or_create_chat)(
+            self.telegram_id, create_new_chat=True
+        )
+
+        with self.assertNumQueries(0):
+            chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+
+        self.assertEqual(chat, new_chat)
+        self.assertNotEqual(chat, self.chat)
+
+    def test_invalidate_chat(self):
+        chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+        other_chat = Chat.objects.create(telegram_id=self.telegram_id)
+
+        invalidate_chat(other_chat)
+        self.assertEqual(chat_cache.peek(self.telegram_id), chat)
+
+        invalidate_chat(chat)
+        self.assertIsNone(chat_cache.peek(self.telegram_id))
+
     def test_get_messages_count(self):
         Text.objects.create(
             telegram_id=self.telegram_id,
@@ -45,6 +109,83 @@ class BotDatabaseTestCase(TestCase):
         self.assertIsNotNone(text)
         self.assertEqual(text.request, "Test request")
         self.assertEqual(text.response, "Test response")
+        self.assertEqual(text.request_tokens, 2)
+        self.assertEqual(text.response_tokens, 2)
+
+    def test_record_exchange(self):
+        chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+        last_update = chat.last_update
+
+        # SAVEPOINT, INSERT text, UPDATE chat,
+        # UPDATE usage, SAVEPOINT, INSERT usage, RELEASE SAVEPOINT x2
+        with self.assertNumQueries(8):
+            text = async_to_sync(record_exchange)(
+                chat,
+                telegram_id=self.telegram_id,
+                request="Test request",
+                response="Test response",
+                completion_tokens=5,
+                prompt_tokens=5
+            )
+
+        chat.refresh_from_db()
+        self.assertEqual(text.chat, chat)
+        self.assertEqual(text.response_tokens, 2)
+        self.assertEqual(text.total_tokens, 10)
+        self.assertEqual(text.cost, get_cost(5, 5))
+        self.assertGreater(chat.last_update, last_update)
+
+    def test_record_usage(self):
+        chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+        async_to_sync(record_usage)(
+            self.telegram_id, 'topic', prompt_tokens=10, completion_tokens=5
+        )
+
+        # SAVEPOINT, INSERT text, UPDATE chat, UPDATE usage in place,
+        # RELEASE SAVEPOINT
+        with self.assertNumQueries(5):
+            async_to_sync(record_exchange)(
+                chat,
+                kind='topic',
+                telegram_id=self.telegram_id,
+                request="Test request",
+                response="Test response",
+                completion_tokens=5,
+                prompt_tokens=10
+            )
+        async_to_sync(record_exchange)(
+            chat,
+            kind='img',
+            telegram_id=self.telegram_id,
+            request="Test request",
+            content_type='img'
+        )
+
+        topic = Usage.objects.get(telegram_id=self.telegram_id, kind='topic')
+        self.assertEqual(
+            (topic.requests, topic.prompt_tokens, topic.completion_tokens),
+            (2, 20, 10)
+        )
+        self.assertEqual(topic.cost, get_cost(20, 10))
+
+        img = Usage.objects.get(telegram_id=self.telegram_id, kind='img')
+        self.assertEqual((img.requests, img.images), (1, 1))
+        self.assertEqual(img.cost, get_cost(images=1))
+
+    def test_chat_message_queries(self):
+        chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+        async_to_sync(record_usage)(self.telegram_id, 'chat')
+
+        # Cached chat, one history page and the recorded exchange
+        with self.assertNumQueries(6):
+            chat = async_to_sync(get_or_create_chat)(self.telegram_id)
+            list(iter_message_objects(self.telegram_id, chat))
+            async_to_sync(record_exchange)(
+                chat,
+                telegram_id=self.telegram_id,
+                request="Test request",
+                response="Test response"
+            )
 
     def test_get_message_objects(self):
         Text.objects.create(
@@ -59,6 +200,30 @@ class BotDatabaseTestCase(TestCase):
         messages = get_message_objects(self.telegram_id, self.chat)
         self.assertEqual(messages.count(), 1)
 
+    def test_iter_message_objects(self):
+        texts = [
+            Text.objects.create(
+                telegram_id=self.telegram_id,
+                chat=self.chat,
+                request=f"Test request {number}",
+                response="Test response",
+            )
+            for number in range(5)
+        ]
+
+        messages = iter_message_objects(
+            self.telegram_id, self.chat, page_size=2
+        )
+        with self.assertNumQueries(1):
+            first_page = [next(messages), next(messages)]
+        with self.assertNumQueries(2):
+            rest = list(messages)
+
+        self.assertEqual(
+            [message.id for message in first_page + rest],
+            [text.id for text in reversed(texts)]
+        )
+
     def test_get_last_text_entry(self):
         text_entry = Text.objects.create(
             telegram_id=self.telegram_id,
@@ -74,3 +239,271 @@ class BotDatabaseTestCase(TestCase):
         )
         self.assertIsNotNone(last_text_entry)
         self.assertEqual(last_text_entry.id, text_entry.id)
+
+
+@override_settings(WRITE_BUFFER_ENABLED=True)
+class WriteBufferTestCase(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.telegram_id = '12345'
+        self.chat = Chat.objects.create(telegram_id=self.telegram_id)
+        self.buffer = WriteBuffer(max_rows=3, interval=60)
+
+        patcher = patch('bot.database.write_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, number, **kwargs):
+        return async_to_sync(record_exchange)(
+            self.chat,
+            telegram_id=self.telegram_id,
+            request=f"Test request {number}",
+            response="Test response",
+            completion_tokens=5,
+            prompt_tokens=10,
+            **kwargs
+        )
+
+    def get_requests(self, page_size=50):
+        return [
+            message.request
+            for message in iter_message_objects(
+                self.telegram_id, self.chat, page_size
+            )
+        ]
+
+    def test_reads_see_buffered_rows(self):
+        Text.objects.create(
+            telegram_id=self.telegram_id,
+            chat=self.chat,
+            request="Test request 0",
+            response="Test response",
+        )
+
+        with self.assertNumQueries(0):
+            self.record(1)
+            self.record(2)
+
+        self.assertEqual(Text.objects.count(), 1)
+        self.assertEqual(
+            self.get_requests(),
+            ["Test request 2", "Test request 1", "Test request 0"]
+        )
+        self.assertEqual(
+            async_to_sync(get_messages_count)(self.telegram_id, self.chat), 3
+        )
+        unfolded = async_to_sync(get_unfolded_messages)(
+            self.telegram_id, self.chat
+        )
+        self.assertEqual(
+            [message.request for message in unfolded],
+            ["Test request 0", "Test request 1", "Test request 2"]
+        )
+
+    def test_flushes_when_full(self):
+        last_update = self.chat.last_update
+        for number in range(2):
+            self.record(number)
+        self.record(2, kind='sum')
+
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(Text.objects.count(), 3)
+        self.assertEqual(metrics.get_metrics()['write_buffer.flushed'], 3)
+
+        self.chat.refresh_from_db()
+        self.assertGreater(self.chat.last_update, last_update)
+
+        usage = Usage.objects.get(telegram_id=self.telegram_id, kind='chat')
+        self.assertEqual(
+            (usage.requests, usage.prompt_tokens, usage.completion_tokens),
+            (2, 20, 10)
+        )
+        self.assertEqual(usage.cost, get_cost(20, 10))
+        self.assertTrue(Usage.objects.filter(kind='sum').exists())
+
+    async def test_flushes_after_interval(self):
+        self.buffer.interval = 0.01
+        await record_exchange(
+            self.chat,
+            telegram_id=self.telegram_id,
+            request="Test request",
+            response="Test response"
+        )
+
+        await asyncio.sleep(0.1)
+
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(await Text.objects.acount(), 1)
+
+    def test_flush_while_reading(self):
+        Text.objects.create(
+            telegram_id=self.telegram_id,
+            chat=self.chat,
+            request="Test request 0",
+            response="Test response",
+        )
+        self.record(1)
+
+        messages = iter_message_objects(self.telegram_id, self.chat)
+        first = next(messages)
+        self.buffer.flush()
+
+        self.assertEqual(
+            [first.request] + [message.request for message in messages],
+            ["Test request 1", "Test request 0"]
+        )
+
+    def test_last_text_entry_is_flushed(self):
+        text = self.record(1)
+
+        last_text_entry = async_to_sync(get_last_text_entry)(
+            self.telegram_id, self.chat
+        )
+
+        self.assertEqual(last_text_entry.pk, text.pk)
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_failed_flush_is_retried(self):
+        self.record(1)
+
+        with patch.object(
+            Text.objects, 'bulk_create', side_effect=DatabaseError
+        ), self.assertLogs('bot.database', 'ERROR'):
+            self.assertEqual(self.buffer.flush(), 0)
+
+        self.assertEqual(len(self.buffer), 1)
+        self.assertEqual(self.get_requests(), ["Test request 1"])
+        self.assertEqual(metrics.get_metrics()['write_buffer.errors'], 1)
+
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(Text.objects.count(), 1)
+        self.assertEqual(Usage.objects.get().requests, 1)
+
+    def test_drops_rows_of_deleted_chats(self):
+        self.record(1)
+        self.chat.delete()
+
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertFalse(Text.objects.exists())
+
+
+class QueryPlanTestCase(TestCase):
+    """
+    The hot chat and text lookups must be served by an index
+    and never fall back to a table scan or a temporary sort.
+    """
+
+    def setUp(self):
+        self.telegram_id = '12345'
+        self.chat = Chat.objects.create(telegram_id=self.telegram_id)
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan)
+        self.assertNotRegex(plan, re.compile(r'SCAN chats_\w+$', re.MULTILINE))
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_current_chat_lookup(self):
+        queryset = Chat.objects.filter(
+            telegram_id=self.telegram_id
+        ).order_by('-creation_date')[:1]
+
+        self.assertUsesIndex(queryset, 'chat_telegram_created_idx')
+
+    def test_message_objects_lookup(self):
+        queryset = get_message_objects(self.telegram_id, self.chat)
+
+        self.assertUsesIndex(queryset, 'text_user_chat_type_date_idx')
+
+    def test_message_page_lookup(self):
+        queryset = get_message_objects(
+            self.telegram_id, self.chat
+        ).order_by('-date', '-id')[:50]
+
+        self.assertUsesIndex(queryset, 'text_user_chat_type_date_idx')
+
+    def test_messages_count_lookup(self):
+        queryset = Text.objects.filter(
+            telegram_id=self.telegram_id,
+            chat=self.chat
+        )
+
+        self.assertUsesIndex(queryset, 'text_user_chat_type_date_idx')
+
+    def test_user_texts_lookup(self):
+        queryset = Text.objects.filter(telegram_id=self.telegram_id)
+
+        self.assertUsesIndex(queryset, 'text_user_chat_type_date_idx')
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'SQLite profile')
+class SQLiteConcurrencyTestCase(unittest.TestCase):
+    """
+    Concurrent writers on a database file with the production
+    profile wait for each other instead of failing with
+    "database is locked".
+    """
+
+    alias = 'concurrency'
+    threads = 8
+    transactions = 25
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        connections.settings[self.alias] = {
+            **connections.settings['default'],
+            'NAME': os.path.join(directory.name, 'db.sqlite3'),
+        }
+        self.addCleanup(connections.settings.pop, self.alias)
+        self.addCleanup(connections.__delitem__, self.alias)
+        self.addCleanup(connections[self.alias].close)
+
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('CREATE TABLE counter (n INTEGER UNIQUE)')
+
+    def write(self, errors):
+        try:
+            for _ in range(self.transactions):
+                # Reads before writing, like get_or_create and the
+                # write buffer's flush
+                with transaction.atomic(using=self.alias):
+                    with connections[self.alias].cursor() as cursor:
+                        cursor.execute(
+                            'SELECT COALESCE(MAX(n), 0) FROM counter'
+                        )
+                        number = cursor.fetchone()[0] + 1
+                        cursor.execute(
+                            'INSERT INTO counter VALUES (%s)', [number]
+                        )
+        except Exception as error:
+            errors.append(error)
+        finally:
+            connections[self.alias].close()
+
+    def test_pragmas(self):
+        with connections[self.alias].cursor() as cursor:
+            pragmas = [
+                cursor.execute(f'PRAGMA {name}').fetchone()[0]
+                for name in ('journal_mode', 'synchronous', 'busy_timeout')
+            ]
+
+        self.assertEqual(pragmas, ['wal', 1, 20000])
+
+    def test_concurrent_writers(self):
+        errors = []
+        threads = [
+            threading.Thread(target=self.write, args=(errors,))
+            for _ in range(self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('SELECT COUNT(*), MAX(n) FROM counter')
+            total = self.threads * self.transactions
+            self.assertEqual(cursor.fetchone(), (total, total))
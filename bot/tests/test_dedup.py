@@ -0,0 +1,120 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import DatabaseError
+from django.test import (
+    AsyncRequestFactory, RequestFactory, TestCase, override_settings
+)
+from django.utils import timezone
+
+from bot import dedup, metrics
+from bot.models import ReceivedUpdate
+from bot.views import TelegramBotWebhookView, TelegramBotWebhookAsyncView
+from bot.tests.fakes import make_update_data
+
+
+class TestDeduplication(TestCase):
+    def setUp(self):
+        metrics.reset()
+        dedup.reset()
+        self.addCleanup(dedup.reset)
+
+    def test_drops_redelivery(self):
+        self.assertFalse(dedup.is_duplicate(make_update_data(1)))
+        self.assertTrue(dedup.is_duplicate(make_update_data(1)))
+        self.assertFalse(dedup.is_duplicate(make_update_data(2)))
+
+        self.assertEqual(metrics.get_metrics()['webhook.duplicates'], 1)
+        self.assertEqual(ReceivedUpdate.objects.count(), 2)
+
+    def test_drops_redelivery_to_another_process(self):
+        self.assertFalse(dedup.is_duplicate(make_update_data(1)))
+        dedup.received_updates.clear()
+
+        self.assertTrue(dedup.is_duplicate(make_update_data(1)))
+
+    def test_memory_hit_skips_database(self):
+        dedup.is_duplicate(make_update_data(1))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(dedup.is_duplicate(make_update_data(1)))
+
+    def test_failed_insert_is_not_remembered(self):
+        with patch.object(
+            ReceivedUpdate.objects, 'create', side_effect=DatabaseError
+        ):
+            with self.assertRaises(DatabaseError):
+                dedup.is_duplicate(make_update_data(1))
+
+        self.assertNotIn(1, dedup.received_updates)
+        self.assertFalse(dedup.is_duplicate(make_update_data(1)))
+
+    def test_purges_expired(self):
+        ReceivedUpdate.objects.create(
+            update_id=1, creation_date=timezone.now() - timedelta(days=2)
+        )
+
+        dedup.is_duplicate(make_update_data(2))
+
+        self.assertEqual(
+            list(ReceivedUpdate.objects.values_list('update_id', flat=True)),
+            [2]
+        )
+
+    @override_settings(WEBHOOK_DEDUPLICATE=False)
+    def test_disabled(self):
+        dedup.is_duplicate(make_update_data(1))
+
+        self.assertFalse(dedup.is_duplicate(make_update_data(1)))
+        self.assertFalse(ReceivedUpdate.objects.exists())
+
+    @patch('bot.views.process')
+    def test_webhook_acknowledges_duplicate(self, mock_process):
+        view = TelegramBotWebhookView.as_view()
+
+        for _ in range(2):
+            request = RequestFactory().post(
+                '/bot/webhook/',
+                data=make_update_data(1),
+                content_type='application/json'
+            )
+            response = view(request)
+            self.assertEqual(response.status_code, 200)
+
+        mock_process.assert_called_once_with(make_update_data(1))
+
+    @patch('bot.views.process', side_effect=[RuntimeError, None])
+    def test_webhook_failure_allows_redelivery(self, mock_process):
+        view = TelegramBotWebhookView.as_view()
+
+        def post():
+            return view(RequestFactory().post(
+                '/bot/webhook/',
+                data=make_update_data(1),
+                content_type='application/json'
+            ))
+
+        with self.assertRaises(RuntimeError):
+            post()
+        self.assertFalse(ReceivedUpdate.objects.exists())
+
+        self.assertEqual(post().status_code, 200)
+        self.assertEqual(mock_process.call_count, 2)
+
+    @patch('bot.views.enqueue', side_effect=[RuntimeError, None])
+    async def test_async_webhook_failure_allows_redelivery(self, mock_enqueue):
+        view = TelegramBotWebhookAsyncView.as_view()
+
+        def post():
+            return view(AsyncRequestFactory().post(
+                '/bot/webhook/',
+                data=make_update_data(1),
+                content_type='application/json'
+            ))
+
+        with self.assertRaises(RuntimeError):
+            await post()
+        self.assertNotIn(1, dedup.received_updates)
+
+        self.assertEqual((await post()).status_code, 200)
+        self.assertEqual(mock_enqueue.await_count, 2)
@@ -0,0 +1,180 @@
+import time
+import asyncio
+
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError
+from django.test import RequestFactory, TestCase, override_settings
+from telegram.ext import Application, MessageHandler, filters
+
+from bot import dedup, dispatch
+from bot.models import QueuedUpdate, ReceivedUpdate
+from bot.views import TelegramBotWebhookDispatchView
+from bot.tests.fakes import FakeRequest, make_update_data
+
+
+DELAY = 0.1
+
+
+@override_settings(DISPATCH_PARTITIONS=4, DISPATCH_BATCH_SIZE=100)
+class TestDispatch(TestCase):
+    def setUp(self):
+        dedup.reset()
+        self.addCleanup(dedup.reset)
+        self.processed = []
+
+        async def slow_handler(update, context):
+            await asyncio.sleep(DELAY)
+            self.processed.append(
+                (update.message.chat_id, update.message.text)
+            )
+
+        self.application = Application.builder().token('123:abc').request(
+            FakeRequest()
+        ).build()
+        self.application.add_handler(
+            MessageHandler(filters.TEXT, slow_handler)
+        )
+
+    def test_partition_by_chat(self):
+        self.assertEqual(dispatch.get_partition(make_update_data(1, chat_id=5)),
+                         dispatch.get_partition(make_update_data(2, chat_id=5)))
+        self.assertEqual(
+            dispatch.get_partition(make_update_data(1, chat_id=-1001)), 3
+        )
+        self.assertEqual(dispatch.get_chat_id({'update_id': 7}), 7)
+
+    def test_partitions_are_shared_out(self):
+        owned = [dispatch.get_partitions(index, 3) for index in range(3)]
+
+        self.assertEqual(owned, [[0, 3], [1], [2]])
+
+    def test_webhook_queues_update(self):
+        request = RequestFactory().post(
+            '/bot/webhook/',
+            data=make_update_data(1, chat_id=6),
+            content_type='application/json'
+        )
+        response = TelegramBotWebhookDispatchView.as_view()(request)
+
+        self.assertEqual(response.status_code, 200)
+        update = QueuedUpdate.objects.get()
+        self.assertEqual(update.partition, 2)
+        self.assertEqual(update.payload, make_update_data(1, chat_id=6))
+
+    def test_webhook_failure_allows_redelivery(self):
+        view = TelegramBotWebhookDispatchView.as_view()
+
+        def post():
+            return view(RequestFactory().post(
+                '/bot/webhook/',
+                data=make_update_data(1),
+                content_type='application/json'
+            ))
+
+        with patch.object(
+            QueuedUpdate.objects, 'create', side_effect=DatabaseError
+        ):
+            with self.assertRaises(DatabaseError):
+                post()
+
+        self.assertFalse(ReceivedUpdate.objects.exists())
+        self.assertEqual(post().status_code, 200)
+        self.assertEqual(QueuedUpdate.objects.count(), 1)
+
+    async def test_worker_keeps_chat_order(self):
+        for update_id, chat_id in enumerate([1, 2, 1, 2, 1], start=1):
+            await sync_to_async(dispatch.put_update)(
+                make_update_data(update_id, str(update_id), chat_id)
+            )
+
+        worker = dispatch.Worker(self.application, [0, 1, 2, 3])
+
+        start = time.perf_counter()
+        async with self.application:
+            self.assertEqual(await worker.process_batch(), 5)
+            await worker.join()
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(
+            [text for chat_id, text in self.processed if chat_id == 1],
+            ['1', '3', '5']
+        )
+        self.assertEqual(
+            [text for chat_id, text in self.processed if chat_id == 2],
+            ['2', '4']
+        )
+        # The chats' partitions are processed concurrently
+        self.assertLess(elapsed, DELAY * 5)
+        self.assertFalse(await QueuedUpdate.objects.aexists())
+
+    async def test_worker_owns_partitions(self):
+        queue = dispatch.DatabaseQueue()
+        for chat_id in range(4):
+            await sync_to_async(queue.put)(
+                chat_id, make_update_data(chat_id, chat_id=chat_id)
+            )
+
+        worker = dispatch.Worker(self.application, [1, 3], queue)
+        async with self.application:
+            await worker.process_batch()
+            await worker.join()
+
+        self.assertEqual(sorted(chat for chat, _ in self.processed), [1, 3])
+        self.assertEqual(await QueuedUpdate.objects.acount(), 2)
+
+    @override_settings(DISPATCH_POLL_INTERVAL=0.01)
+    async def test_slow_chat_does_not_block_others(self):
+        release = asyncio.Event()
+        processed = []
+
+        async def handler(update, context):
+            if update.message.text == 'slow':
+                await release.wait()
+            processed.append(update.message.text)
+
+        application = Application.builder().token('123:abc').request(
+            FakeRequest()
+        ).build()
+        application.add_handler(MessageHandler(filters.TEXT, handler))
+
+        for update_id, text in enumerate(['fast', 'slow'], start=1):
+            await sync_to_async(dispatch.put_update)(
+                make_update_data(update_id, text, chat_id=1)
+            )
+
+        stop = asyncio.Event()
+        async with application:
+            running = asyncio.create_task(
+                dispatch.Worker(application, [0, 1, 2, 3]).run(stop)
+            )
+            await sync_to_async(dispatch.put_update)(
+                make_update_data(3, 'other', chat_id=2)
+            )
+            for _ in range(100):
+                if 'other' in processed:
+                    break
+                await asyncio.sleep(0.01)
+
+            self.assertEqual(processed, ['fast', 'other'])
+            # Processed updates are removed one by one
+            self.assertEqual(
+                [payload['message']['text'] async for payload in
+                 QueuedUpdate.objects.values_list('payload', flat=True)],
+                ['slow']
+            )
+
+            release.set()
+            await asyncio.sleep(0.05)
+            stop.set()
+            await running
+
+        self.assertEqual(processed, ['fast', 'other', 'slow'])
+        self.assertFalse(await QueuedUpdate.objects.aexists())
+
+    async def test_worker_stops(self):
+        stop = asyncio.Event()
+        stop.set()
+
+        await dispatch.Worker(self.application, [0]).run(stop)
@@ -1,8 +1,17 @@
+import time
+import asyncio
+import openai
+from django.test import override_settings
 from unittest import IsolatedAsyncioTestCase
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import ANY, AsyncMock, MagicMock, patch
 from telegram import Update, Message, Bot
 from telegram.ext import CallbackContext
-from bot import handlers
+from bot import handlers, helpers
+from bot.tests.fakes import FakeOpenAIServer
+
+
+DELAY = 0.3
+CONCURRENT_CHATS = 5
 
 
 class AsyncMagicMock(MagicMock):
@@ -62,10 +71,13 @@ class TestHandlers(IsolatedAsyncioTestCase):
         handlers.save_chat = AsyncMock()
         handlers.delete_chat = AsyncMock()
         handlers.create_message_entry = AsyncMock()
+        handlers.record_exchange = AsyncMock()
+        handlers.record_usage = AsyncMock()
         handlers.save_text_entry = AsyncMock()
         handlers.get_last_text_entry = AsyncMock(
             return_value=AsyncMock()
         )
+        handlers.task_queue = AsyncMock()
 
     async def test_start(self):
         await handlers.start(self.update, self.context)
@@ -86,8 +98,7 @@ class TestHandlers(IsolatedAsyncioTestCase):
         # self.context.bot.send_message.assert_called()
         handlers.get_or_create_chat.assert_called()
         handlers.get_messages_count.assert_called()
-        handlers.get_conversation_history.assert_called()
-        handlers.save_chat.assert_called()
+        handlers.task_queue.enqueue.assert_called()
 
     async def test_unknown(self):
         await handlers.unknown(self.update, self.context)
@@ -99,5 +110,180 @@ class TestHandlers(IsolatedAsyncioTestCase):
         handlers.get_or_create_chat.assert_called()
         handlers.get_conversation_history.assert_called()
         handlers.call_openai_api.assert_called()
-        handlers.create_message_entry.assert_called()
-        handlers.save_chat.assert_called()
+        handlers.record_exchange.assert_called()
+
+    async def test_chat_blank_answer(self):
+        handlers.call_openai_api.return_value['choices'][0]['message'][
+            'content'
+        ] = '\n\n'
+        await handlers.chat(self.update, self.context)
+        self.context.bot.send_message.assert_called_once_with(
+            chat_id=1, text=handlers.EMPTY_ANSWER_MESSAGE
+        )
+        handlers.record_exchange.assert_not_called()
+
+    @override_settings(MEMORY_ENABLED=True, MEMORY_THRESHOLD_TOKENS=5)
+    async def test_chat_schedules_memory(self):
+        await handlers.chat(self.update, self.context)
+        handlers.task_queue.enqueue.assert_any_call(
+            'chat_memory', key=ANY, telegram_id=1, chat_id=ANY
+        )
+
+    async def test_retry_bypasses_cache(self):
+        handlers.get_conversation_history = AsyncMock(
+            return_value=[{'role': 'user', 'content': 'Hello'}]
+        )
+        await handlers.retry(self.update, self.context)
+        handlers.call_openai_api.assert_called_once_with(ANY, cache=False)
+        handlers.record_usage.assert_awaited_once_with(
+            1, 'retry', prompt_tokens=10, completion_tokens=5
+        )
+
+    async def test_error_handler(self):
+        self.context.error = openai.error.RateLimitError('Rate limited')
+        await handlers.error_handler(self.update, self.context)
+        self.context.bot.send_message.assert_called_once_with(
+            chat_id=1, text=handlers.OPENAI_ERROR_MESSAGE
+        )
+
+    async def test_error_handler_prompt_too_long(self):
+        self.context.error = helpers.PromptTooLongError()
+        await handlers.error_handler(self.update, self.context)
+        self.context.bot.send_message.assert_called_once_with(
+            chat_id=1, text=handlers.TOO_LONG_MESSAGE
+        )
+
+
+class TestConcurrentChat(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeOpenAIServer(delay=DELAY)
+        await self.server.start()
+        self.addAsyncCleanup(self.server.stop)
+        self.addAsyncCleanup(helpers.close_openai_session)
+
+        patchers = [
+            patch.object(openai, 'api_base', self.server.url),
+            patch.object(openai, 'api_key', 'test'),
+            patch.object(handlers, 'call_openai_api', helpers.call_openai_api),
+            patch.object(
+                handlers, 'get_or_create_chat',
+                AsyncMock(return_value=MagicMock(topic='Topic'))
+            ),
+            patch.object(
+                handlers, 'get_conversation_history',
+                AsyncMock(return_value=[])
+            ),
+            patch.object(handlers, 'record_exchange', AsyncMock()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_update(self, chat_id):
+        message = TestMessage.de_json({
+            'message_id': chat_id,
+            'from': {'id': chat_id, 'first_name': 'Test', 'is_bot': False},
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': 'Hello',
+            'date': None,
+        }, None)
+        return Update(update_id=chat_id, message=message)
+
+    async def test_concurrent_chats_overlap(self):
+        context = CallbackContextProxy(
+            AsyncMagicMock(spec=Bot), AsyncMock(), MagicMock()
+        )
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            handlers.chat(self.make_update(chat_id), context)
+            for chat_id in range(1, CONCURRENT_CHATS + 1)
+        ))
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(len(self.server.requests), CONCURRENT_CHATS)
+        self.assertEqual(self.server.max_active, CONCURRENT_CHATS)
+        self.assertLess(elapsed, DELAY * 2)
+
+
+class TestStreamingChat(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        overrider = override_settings(
+            OPENAI_STREAM=True, STREAM_EDIT_INTERVAL=0.2
+        )
+        overrider.enable()
+        self.addCleanup(overrider.disable)
+
+        self.words = [f'word{number}' for number in range(10)]
+        self.server = FakeOpenAIServer(
+            answer=' '.join(self.words), chunk_delay=0.05
+        )
+        await self.server.start()
+        self.addAsyncCleanup(self.server.stop)
+        self.addAsyncCleanup(helpers.close_openai_session)
+
+        self.record_exchange = AsyncMock()
+        patchers = [
+            patch.object(openai, 'api_base', self.server.url),
+            patch.object(openai, 'api_key', 'test'),
+            patch.object(
+                handlers, 'stream_openai_api', helpers.stream_openai_api
+            ),
+            patch.object(
+                handlers, 'get_or_create_chat',
+                AsyncMock(return_value=MagicMock(topic='Topic'))
+            ),
+            patch.object(
+                handlers, 'get_conversation_history',
+                AsyncMock(return_value=[])
+            ),
+            patch.object(
+                handlers, 'num_tokens_from_string', MagicMock(return_value=1)
+            ),
+            patch.object(
+                handlers, 'num_tokens_from_messages',
+                MagicMock(return_value=1)
+            ),
+            patch.object(
+                handlers, 'record_exchange', self.record_exchange
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_chat_streams_answer(self):
+        message = TestMessage.de_json({
+            'message_id': 1,
+            'from': {'id': 1, 'first_name': 'Test', 'is_bot': False},
+            'chat': {'id': 1, 'type': 'private'},
+            'text': 'Hello',
+            'date': None,
+        }, None)
+        update = Update(update_id=1, message=message)
+        bot_instance = AsyncMagicMock(spec=Bot)
+        bot_instance.send_message.return_value = MagicMock(
+            chat_id=1, message_id=1
+        )
+        context = CallbackContextProxy(bot_instance, AsyncMock(), MagicMock())
+
+        await handlers.chat(update, context)
+
+        answer = ' '.join(self.words)
+        first_message = bot_instance.send_message.call_args.kwargs['text']
+        edits = [
+            call.kwargs['text']
+            for call in bot_instance.edit_message_text.call_args_list
+        ]
+
+        bot_instance.send_message.assert_called_once()
+        self.assertEqual(first_message, self.words[0])
+        self.assertLess(len(edits), len(self.words) - 1)
+        self.assertEqual(edits[-1], answer)
+        self.assertEqual(
+            bot_instance.edit_message_text.call_args.kwargs['parse_mode'],
+            'Markdown'
+        )
+        self.assertEqual(
+            self.record_exchange.call_args.kwargs['response'], answer
+        )
@@ -1,15 +1,23 @@
 import asyncio
-from django.test import TestCase
-from unittest.mock import AsyncMock, patch
+from types import SimpleNamespace
+from django.test import TestCase, override_settings
+from unittest.mock import AsyncMock, MagicMock, patch
 from telegram import Update, Chat, User, Message
+from telegram.error import RetryAfter
 from telegram.ext import CallbackContext
 
 from bot.helpers import (
     send_action, get_conversation_topic, get_conversation_summary, save_chat,
-    delete_chat, get_conversation_history, save_text_entry, call_openai_api
+    delete_chat, get_conversation_history, save_text_entry, call_openai_api,
+    truncate_messages, summarize_document, split_into_chunks,
+    num_tokens_from_string, response_cache, split_text,
+    send_streamed_message, PromptTooLongError
+)
+from bot.database import (
+    chat_cache, get_or_create_chat, create_message_entry
 )
-from bot.database import get_or_create_chat, create_message_entry
 from bot.handlers import ChatAction
+from bot.llm import get_model
 
 
 TELEGRAM_ID = 12345
@@ -46,6 +54,9 @@ context = CallbackContext(None, None, None)
 
 
 class TestHelpers(TestCase):
+    def setUp(self):
+        chat_cache.clear()
+
     async def test_get_conversation_topic(self):
         with patch("bot.helpers.call_openai_api", return_value=API_RESPONSE):
             request = [{'role': 'user', 'content': TEXT}]
@@ -116,7 +127,7 @@ class TestHelpers(TestCase):
 
         self.assertEqual(result, "dummy response")
 
-    @patch("bot.helpers.openai.ChatCompletion.create")
+    @patch("bot.helpers.openai.ChatCompletion.acreate")
     async def test_call_openai_api(self, mock_create):
         mocked_response = {
             'choices': [
@@ -132,6 +143,234 @@ class TestHelpers(TestCase):
 
         response = await call_openai_api(request)
 
-        mock_create.assert_called_with(model="gpt-3.5-turbo", messages=request)
+        mock_create.assert_called_with(
+            model="gpt-3.5-turbo",
+            messages=request,
+            max_tokens=1000,
+            request_timeout=(10, 60)
+        )
 
         self.assertEqual(response, mocked_response)
+
+    @patch("bot.helpers.openai.ChatCompletion.acreate")
+    async def test_call_openai_api_prompt_too_long(self, mock_create):
+        request = [{"role": "user", "content": "word " * 5000}]
+
+        with self.assertRaises(PromptTooLongError):
+            await call_openai_api(request)
+
+        mock_create.assert_not_called()
+
+    @override_settings(RESPONSE_CACHE_ENABLED=True)
+    @patch("bot.helpers.openai.ChatCompletion.acreate")
+    async def test_call_openai_api_cache(self, mock_create):
+        mock_create.return_value = API_RESPONSE
+        response_cache.clear()
+        hits = response_cache.hits
+        request = [{"role": "user", "content": "Hi"}]
+
+        await call_openai_api(request)
+        response = await call_openai_api(list(request))
+
+        self.assertEqual(response['choices'], API_RESPONSE['choices'])
+        self.assertEqual(response['usage']['prompt_tokens'], 0)
+        self.assertEqual(mock_create.call_count, 1)
+        self.assertEqual(response_cache.hits - hits, 1)
+
+        await call_openai_api(request, cache=False)
+        await call_openai_api([{"role": "user", "content": "Hello"}])
+        self.assertEqual(mock_create.call_count, 3)
+
+    @patch("bot.tokens.num_tokens_from_string")
+    @patch("bot.helpers.num_tokens_from_string", return_value=1)
+    def test_truncate_messages_uses_stored_tokens(self, _, mock_num_tokens):
+        messages = [
+            SimpleNamespace(
+                request=TEXT, response=RESPONSE_TEXT,
+                request_tokens=1500, response_tokens=500
+            )
+            for _ in range(3)
+        ]
+
+        truncated = truncate_messages(messages, TEXT)
+
+        self.assertEqual(truncated, messages[:1])
+        mock_num_tokens.assert_not_called()
+
+    @override_settings(OPENAI_MAX_TOKENS=1000)
+    @patch("bot.helpers.num_tokens_from_string", return_value=1)
+    def test_truncate_messages_model_context(self, _):
+        messages = [
+            SimpleNamespace(
+                request=TEXT, response=RESPONSE_TEXT,
+                request_tokens=1500, response_tokens=500
+            )
+            for _ in range(10)
+        ]
+
+        # 2008 tokens per exchange with the chat format overhead
+        self.assertEqual(len(truncate_messages(messages, TEXT)), 1)
+        self.assertEqual(len(truncate_messages(
+            messages, TEXT, model=get_model('gpt-3.5-turbo-16k')
+        )), 7)
+        self.assertEqual(len(truncate_messages(
+            messages, TEXT, reserved_tokens=1100
+        )), 0)
+
+
+class TestSummarizeDocument(TestCase):
+    def setUp(self):
+        self.active = 0
+        self.max_active = 0
+
+    async def fake_summary(self, request):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        return {
+            'choices': [{'message': {'content': RESPONSE_TEXT}}],
+            'usage': {'completion_tokens': 5, 'prompt_tokens': 10},
+        }
+
+    def test_split_into_chunks(self):
+        paragraphs = [f"Paragraph number {number}." for number in range(10)]
+
+        chunks = split_into_chunks('\n'.join(paragraphs), 15)
+
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual('\n'.join(chunks), '\n'.join(paragraphs))
+        for chunk in chunks:
+            self.assertLessEqual(num_tokens_from_string(chunk), 15)
+
+    def test_split_into_chunks_long_paragraph(self):
+        chunks = split_into_chunks(' '.join(['word'] * 100), 30)
+
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(''.join(chunks), ' '.join(['word'] * 100))
+
+    async def test_short_document(self):
+        with patch("bot.helpers.call_openai_api", wraps=self.fake_summary) \
+                as mock_call:
+            response = await summarize_document(TEXT)
+
+        mock_call.assert_called_once()
+        self.assertEqual(
+            response['usage'], {'completion_tokens': 5, 'prompt_tokens': 10}
+        )
+
+    @override_settings(SUMMARY_CHUNK_TOKENS=20, SUMMARY_CONCURRENCY=2)
+    async def test_long_document(self):
+        content = '\n'.join(
+            f"Paragraph number {number} of the text." for number in range(10)
+        )
+
+        with patch("bot.helpers.call_openai_api", wraps=self.fake_summary) \
+                as mock_call:
+            response = await summarize_document(content)
+
+        # Five chunk summaries and the final summary
+        self.assertEqual(mock_call.call_count, 6)
+        self.assertEqual(self.max_active, 2)
+        self.assertEqual(
+            response['choices'][0]['message']['content'], RESPONSE_TEXT
+        )
+        self.assertEqual(
+            response['usage'], {'completion_tokens': 30, 'prompt_tokens': 60}
+        )
+
+    @override_settings(SUMMARY_CHUNK_TOKENS=20, SUMMARY_MAX_CHUNKS=2)
+    async def test_long_document_is_capped(self):
+        content = '\n'.join(
+            f"Paragraph number {number} of the text." for number in range(10)
+        )
+
+        with patch("bot.helpers.call_openai_api", wraps=self.fake_summary) \
+                as mock_call:
+            await summarize_document(content)
+
+        # Two chunk summaries and the final summary
+        self.assertEqual(mock_call.call_count, 3)
+
+    @override_settings(SUMMARY_CHUNK_TOKENS=20)
+    @patch("bot.helpers.SUMMARY_MAX_DEPTH", 0)
+    async def test_max_depth_keeps_all_chunks(self):
+        content = '\n'.join(
+            f"Paragraph number {number} of the text." for number in range(4)
+        )
+
+        with patch("bot.helpers.call_openai_api", wraps=self.fake_summary) \
+                as mock_call:
+            await summarize_document(content)
+
+        mock_call.assert_called_once()
+        # The beginning of both chunks is summarized
+        request = mock_call.call_args.args[0][1]['content']
+        self.assertIn("Paragraph number 0", request)
+        self.assertIn("Paragraph number 2", request)
+        self.assertLessEqual(num_tokens_from_string(request), 20)
+
+
+async def stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class TestStreamedMessage(TestCase):
+    def setUp(self):
+        self.bot = MagicMock()
+        self.bot.send_message = AsyncMock(
+            side_effect=lambda **kwargs: SimpleNamespace(
+                chat_id=kwargs['chat_id'], message_id=kwargs['text']
+            )
+        )
+        self.bot.edit_message_text = AsyncMock()
+
+    def final_edits(self):
+        return [
+            (call.kwargs['message_id'], call.kwargs['text'])
+            for call in self.bot.edit_message_text.call_args_list
+            if call.kwargs.get('parse_mode') == 'Markdown'
+        ]
+
+    def test_split_text(self):
+        self.assertEqual(split_text('abc', 5), ['abc'])
+        self.assertEqual(split_text('ab\ncd\nef', 7), ['ab\ncd', 'ef'])
+        self.assertEqual(split_text('abcdefg', 3), ['abc', 'def', 'g'])
+        self.assertEqual(split_text('abc\n', 3), ['abc'])
+
+    @patch('bot.helpers.MAX_MESSAGE_LENGTH', 10)
+    async def test_long_answer_continues_in_new_message(self):
+        text = await send_streamed_message(
+            self.bot, CHAT_ID, stream('first ', 'line\n', 'second line')
+        )
+
+        self.assertEqual(text, 'first line\nsecond line')
+        self.assertEqual(self.bot.send_message.await_count, 3)
+        self.assertEqual(self.final_edits(), [
+            ('first ', 'first line'),
+            ('second lin', 'second lin'),
+            ('e', 'e'),
+        ])
+
+    @override_settings(STREAM_EDIT_INTERVAL=0)
+    async def test_blank_first_chunk(self):
+        text = await send_streamed_message(
+            self.bot, CHAT_ID, stream('\n\n', 'Hello', ' world')
+        )
+
+        self.assertEqual(text, '\n\nHello world')
+        self.bot.send_message.assert_awaited_once()
+        self.assertEqual(
+            self.final_edits(), [('\n\nHello', '\n\nHello world')]
+        )
+
+    @override_settings(STREAM_EDIT_INTERVAL=60)
+    @patch('bot.helpers.asyncio.sleep', new_callable=AsyncMock)
+    async def test_final_edit_waits_for_rate_limit(self, mock_sleep):
+        self.bot.edit_message_text.side_effect = [RetryAfter(3), None]
+
+        await send_streamed_message(self.bot, CHAT_ID, stream('a', 'b'))
+
+        mock_sleep.assert_awaited_once_with(3)
+        self.assertEqual(self.final_edits(), [('a', 'ab'), ('a', 'ab')])
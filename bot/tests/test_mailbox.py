@@ -0,0 +1,178 @@
+import asyncio
+
+from django.test import override_settings
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from bot import handlers, metrics
+from bot.mailbox import Mailbox, serialized
+
+
+DELAY = 0.1
+
+
+class TestMailbox(IsolatedAsyncioTestCase):
+    def setUp(self):
+        metrics.reset()
+        self.mailbox = Mailbox()
+        self.events = []
+
+        settings = override_settings(
+            CHAT_MERGE_MESSAGES=False, CHAT_MERGE_WINDOW=0
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    async def process(self, key, message):
+        async with self.mailbox.collect(key, message) as messages:
+            self.events.append(('start', messages))
+            await asyncio.sleep(DELAY)
+            self.events.append(('end', messages))
+
+    async def test_serializes_user(self):
+        await asyncio.gather(self.process(1, 'a'), self.process(1, 'b'))
+
+        self.assertEqual(self.events, [
+            ('start', ['a']), ('end', ['a']),
+            ('start', ['b']), ('end', ['b']),
+        ])
+
+    async def test_users_run_concurrently(self):
+        started = asyncio.get_running_loop().time()
+        await asyncio.gather(*(self.process(key, 'a') for key in range(5)))
+
+        elapsed = asyncio.get_running_loop().time() - started
+        self.assertLess(elapsed, DELAY * 2)
+
+    async def test_merges_messages(self):
+        with override_settings(CHAT_MERGE_MESSAGES=True):
+            await asyncio.gather(
+                self.process(1, 'a'),
+                self.process(1, 'b'),
+                self.process(1, 'c'),
+            )
+
+        self.assertEqual(self.events, [
+            ('start', ['a', 'b', 'c']), ('end', ['a', 'b', 'c']),
+            ('start', []), ('end', []),
+            ('start', []), ('end', []),
+        ])
+        self.assertEqual(metrics.get_metrics()['mailbox.merged'], 2)
+
+    async def test_merges_messages_received_while_busy(self):
+        with override_settings(CHAT_MERGE_MESSAGES=True):
+            first = asyncio.create_task(self.process(1, 'a'))
+            await asyncio.sleep(DELAY / 2)
+            await asyncio.gather(
+                first, self.process(1, 'b'), self.process(1, 'c')
+            )
+
+        self.assertEqual(self.events[2], ('start', ['b', 'c']))
+
+    async def test_close_ends_merge_window(self):
+        with override_settings(CHAT_MERGE_MESSAGES=True):
+            first = asyncio.create_task(self.process(1, 'a'))
+            await asyncio.sleep(0)
+            self.mailbox.close(1)
+            await asyncio.gather(first, self.process(1, 'b'))
+
+        self.assertEqual(self.events, [
+            ('start', ['a']), ('end', ['a']),
+            ('start', ['b']), ('end', ['b']),
+        ])
+
+    async def test_releases_locks(self):
+        await self.process(1, 'a')
+        self.assertEqual(len(self.mailbox.locks), 0)
+        self.assertEqual(self.mailbox.pending, {})
+
+
+class TestChatMailbox(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.answered = []
+
+        def send_answer(context, telegram_id, request, **kwargs):
+            self.answered.append(request[-1]['content'])
+            return 'Answer', 5, 10
+
+        self.send_answer = AsyncMock(side_effect=send_answer)
+        mailbox = Mailbox()
+
+        patchers = [
+            patch.object(handlers, 'mailbox', mailbox),
+            patch('bot.mailbox.mailbox', mailbox),
+            patch.object(handlers, 'send_answer', self.send_answer),
+            patch.object(
+                handlers, 'get_or_create_chat',
+                AsyncMock(return_value=MagicMock(topic='Topic'))
+            ),
+            patch.object(
+                handlers, 'get_conversation_history',
+                AsyncMock(side_effect=lambda *args: [])
+            ),
+            patch.object(handlers, 'record_exchange', AsyncMock()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        settings = override_settings(
+            CHAT_MERGE_MESSAGES=True, CHAT_MERGE_WINDOW=DELAY
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def make_update(self, text):
+        update = MagicMock()
+        update.message.chat.id = 1
+        update.effective_message.chat_id = 1
+        update.message.text = text
+        return update
+
+    async def test_rapid_messages_get_one_answer(self):
+        context = MagicMock()
+        context.bot.send_chat_action = AsyncMock()
+
+        await asyncio.gather(
+            handlers.chat(self.make_update('Hello'), context),
+            handlers.chat(self.make_update('How are you?'), context),
+        )
+
+        self.send_answer.assert_awaited_once_with(context, 1, [
+            {'role': 'user', 'content': 'Hello\n\nHow are you?'}
+        ])
+        handlers.record_exchange.assert_awaited_once()
+
+    async def test_command_ends_merge_window(self):
+        context = MagicMock()
+        context.bot.send_chat_action = AsyncMock()
+
+        @serialized
+        async def command(update, context):
+            self.answered.append(update.message.text)
+
+        await asyncio.gather(
+            handlers.chat(self.make_update('Hello'), context),
+            command(self.make_update('/new'), context),
+            handlers.chat(self.make_update('Again'), context),
+        )
+
+        self.assertEqual(self.answered, ['Hello', '/new', 'Again'])
+
+    async def test_chat_action_keeps_order(self):
+        delays = [DELAY, 0]
+
+        async def send_chat_action(**kwargs):
+            # The first chat action is slow to be sent
+            await asyncio.sleep(delays.pop(0))
+
+        context = MagicMock()
+        context.bot.send_chat_action = send_chat_action
+
+        with override_settings(CHAT_MERGE_MESSAGES=False):
+            await asyncio.gather(
+                handlers.chat(self.make_update('Hello'), context),
+                handlers.chat(self.make_update('Again'), context),
+            )
+
+        self.assertEqual(self.answered, ['Hello', 'Again'])
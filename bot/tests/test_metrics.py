@@ -0,0 +1,48 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from bot import metrics
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_counters_and_gauges(self):
+        metrics.increment('updates')
+        metrics.increment('updates', 2)
+        metrics.set_gauge('queue.size', 5)
+
+        self.assertEqual(
+            metrics.get_metrics(), {'updates': 3, 'queue.size': 5}
+        )
+
+    def test_metrics_view(self):
+        metrics.increment('updates')
+        staff = get_user_model().objects.create(
+            username='staff', is_staff=True
+        )
+        self.client.force_login(staff)
+
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'updates': 1})
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_view_token(self):
+        response = self.client.get(
+            reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret'
+        )
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(
+            reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong'
+        )
+        self.assertEqual(response.status_code, 403)
+
+    def test_metrics_view_forbidden(self):
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,158 @@
+import time
+import openai
+
+from django.test import SimpleTestCase, override_settings
+from openai import error
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from bot import helpers, metrics, openai_client
+from bot.openai_client import CircuitBreaker, CircuitOpenError
+from bot.tests.fakes import FakeOpenAIServer
+
+
+REQUEST = [{'role': 'user', 'content': 'Hello'}]
+
+
+class TestOpenAIClient(IsolatedAsyncioTestCase):
+    async def start_server(self, **kwargs):
+        self.server = FakeOpenAIServer(**kwargs)
+        await self.server.start()
+        self.addAsyncCleanup(self.server.stop)
+        self.addAsyncCleanup(helpers.close_openai_session)
+
+        patchers = [
+            patch.object(openai, 'api_base', self.server.url),
+            patch.object(openai, 'api_key', 'test'),
+            patch.object(
+                openai_client, 'breaker',
+                CircuitBreaker('openai.breaker', 4, 60)
+            ),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def setUp(self):
+        metrics.reset()
+
+        settings = override_settings(
+            OPENAI_MAX_RETRIES=3,
+            OPENAI_RETRY_BASE_DELAY=0.01,
+            OPENAI_RETRY_MAX_DELAY=0.05,
+            OPENAI_DEADLINE=5,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    async def test_retries_transient_errors(self):
+        await self.start_server(faults=[429, 500, 503])
+
+        response = await helpers.call_openai_api(REQUEST)
+
+        self.assertEqual(response['choices'][0]['message']['content'],
+                         'Test answer')
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(metrics.get_metrics()['openai.retries'], 3)
+        self.assertEqual(openai_client.breaker.state, CircuitBreaker.CLOSED)
+
+    async def test_gives_up_after_max_retries(self):
+        await self.start_server(faults=[500] * 10)
+
+        with override_settings(OPENAI_MAX_RETRIES=1):
+            with self.assertRaises(error.APIError):
+                await helpers.call_openai_api(REQUEST)
+
+        self.assertEqual(len(self.server.requests), 2)
+
+    async def test_does_not_retry_client_errors(self):
+        await self.start_server(faults=[400])
+
+        with self.assertRaises(error.InvalidRequestError):
+            await helpers.call_openai_api(REQUEST)
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(openai_client.breaker.failures, 0)
+
+    async def test_honors_retry_after(self):
+        await self.start_server(faults=[(429, {'Retry-After': '0.3'})])
+
+        started = time.monotonic()
+        await helpers.call_openai_api(REQUEST)
+
+        # Without Retry-After the backoff is at most 0.05 s
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    async def test_retry_after_past_deadline(self):
+        await self.start_server(faults=[(429, {'Retry-After': '10'})])
+
+        with self.assertRaises(error.RateLimitError):
+            await helpers.call_openai_api(REQUEST)
+
+        self.assertEqual(len(self.server.requests), 1)
+
+    async def test_deadline(self):
+        await self.start_server(delay=1)
+
+        with override_settings(OPENAI_DEADLINE=0.2, OPENAI_MAX_RETRIES=0):
+            with self.assertRaises(error.Timeout):
+                await helpers.call_openai_api(REQUEST)
+
+    async def test_circuit_breaker(self):
+        await self.start_server(faults=[500] * 4)
+
+        with self.assertRaises(error.APIError):
+            await helpers.call_openai_api(REQUEST)
+
+        self.assertEqual(openai_client.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(metrics.get_metrics()['openai.breaker.open'], 1)
+
+        with self.assertRaises(CircuitOpenError):
+            await helpers.call_openai_api(REQUEST)
+
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(metrics.get_metrics()['openai.breaker.rejected'], 1)
+
+    async def test_streaming_retries(self):
+        await self.start_server(faults=[503])
+
+        chunks = [
+            chunk async for chunk in helpers.stream_openai_api(REQUEST)
+        ]
+
+        self.assertEqual(''.join(chunks), 'Test answer')
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class TestCircuitBreaker(SimpleTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('test.breaker', 2, 10)
+
+    @patch('bot.openai_client.time.monotonic')
+    def test_half_open(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertFalse(self.breaker.allow())
+
+        mock_monotonic.return_value = 110
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only a single trial call is let through
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        mock_monotonic.return_value = 120
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
@@ -0,0 +1,205 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from django.test import SimpleTestCase, override_settings
+from telegram.ext import ApplicationHandlerStop
+
+from bot import metrics, ratelimit
+from bot.ratelimit import Admission, CacheBackend, Limit, MemoryBackend
+
+
+TELEGRAM_ID = 12345
+
+
+def make_update(text):
+    update = MagicMock()
+    update.message.text = text
+    update.message.chat.id = TELEGRAM_ID
+    update.message.chat_id = TELEGRAM_ID
+    return update
+
+
+class TestLimit(SimpleTestCase):
+    @patch('bot.ratelimit.time.monotonic')
+    async def test_refills(self, mock_monotonic):
+        backend = MemoryBackend()
+        limit = Limit('test', capacity=2, period=10)
+
+        mock_monotonic.return_value = 100
+        self.assertEqual(await backend.consume([('a', limit, 2)]), 0)
+        self.assertEqual(await backend.consume([('a', limit, 1)]), 5)
+
+        mock_monotonic.return_value = 105
+        self.assertEqual(await backend.consume([('a', limit, 1)]), 0)
+
+    async def test_cost_over_capacity(self):
+        limit = Limit('test', capacity=2)
+        wait = await MemoryBackend().consume([('a', limit, 3)])
+
+        self.assertEqual(wait, float('inf'))
+
+    async def test_all_or_nothing(self):
+        backend = MemoryBackend()
+        small = Limit('small', capacity=1)
+        large = Limit('large', capacity=10)
+
+        await backend.consume([('small', small, 1)])
+        wait = await backend.consume([('large', large, 5), ('small', small, 1)])
+
+        self.assertGreater(wait, 0)
+        self.assertNotIn('large', backend.buckets)
+
+
+@override_settings(
+    RATE_LIMIT_USER_REQUESTS=2,
+    RATE_LIMIT_USER_TOKENS=1000,
+    RATE_LIMIT_GLOBAL_REQUESTS=3,
+    RATE_LIMIT_GLOBAL_TOKENS=10000,
+    CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }},
+)
+class TestAdmission(SimpleTestCase):
+    async def test_user_limit(self):
+        admission = Admission(MemoryBackend())
+
+        self.assertEqual(await admission.admit(1, 10), 0)
+        self.assertEqual(await admission.admit(1, 10), 0)
+        self.assertGreater(await admission.admit(1, 10), 0)
+        self.assertEqual(await admission.admit(2, 10), 0)
+
+    async def test_global_limit(self):
+        admission = Admission(MemoryBackend())
+
+        for telegram_id in range(3):
+            self.assertEqual(await admission.admit(telegram_id, 10), 0)
+        self.assertGreater(await admission.admit(3, 10), 0)
+
+    async def test_token_limit(self):
+        admission = Admission(MemoryBackend())
+
+        self.assertEqual(await admission.admit(1, 900), 0)
+        self.assertGreater(await admission.admit(1, 200), 0)
+
+    async def test_charge(self):
+        admission = Admission(MemoryBackend())
+
+        self.assertEqual(await admission.admit(1, 100), 0)
+        self.assertEqual(await admission.charge(1, 800), 0)
+        self.assertGreater(await admission.charge(1, 200), 0)
+        self.assertEqual(await admission.admit(2, 10), 0)
+
+    async def test_cache_backend(self):
+        first = Admission(CacheBackend())
+        second = Admission(CacheBackend())
+
+        self.assertEqual(await first.admit(1, 10), 0)
+        self.assertEqual(await second.admit(1, 10), 0)
+        self.assertGreater(await first.admit(1, 10), 0)
+
+
+@override_settings(RATE_LIMIT_CHAT_TOKENS=100, RATE_LIMIT_IMAGE_TOKENS=500)
+class TestCheckAdmission(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        ratelimit.slow_down_notices.clear()
+        self.context = MagicMock()
+        self.context.bot.send_message = AsyncMock()
+
+        patcher = patch.object(ratelimit, 'admission', AsyncMock())
+        self.admission = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = patch.object(
+            ratelimit, 'num_tokens_from_string', lambda text: len(text)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_admitted(self):
+        self.admission.admit.return_value = 0
+
+        await ratelimit.check_admission(make_update('Hello'), self.context)
+
+        self.admission.admit.assert_awaited_once_with(
+            TELEGRAM_ID, 5 + ratelimit.settings.RATE_LIMIT_CHAT_TOKENS
+        )
+        self.context.bot.send_message.assert_not_called()
+        self.assertEqual(metrics.get_metrics()['ratelimit.admitted'], 1)
+
+    async def test_rejected(self):
+        self.admission.admit.return_value = 2.4
+
+        with self.assertRaises(ApplicationHandlerStop):
+            await ratelimit.check_admission(
+                make_update('Hello'), self.context
+            )
+
+        self.context.bot.send_message.assert_awaited_once_with(
+            chat_id=TELEGRAM_ID,
+            text=ratelimit.SLOW_DOWN_MESSAGE.format(seconds=2)
+        )
+        self.assertEqual(metrics.get_metrics()['ratelimit.rejected'], 1)
+
+    @patch('bot.ratelimit.time.monotonic')
+    async def test_asks_to_slow_down_once_per_wait(self, mock_monotonic):
+        self.admission.admit.return_value = 2
+        mock_monotonic.return_value = 100
+
+        for _ in range(5):
+            with self.assertRaises(ApplicationHandlerStop):
+                await ratelimit.check_admission(
+                    make_update('Hello'), self.context
+                )
+
+        self.context.bot.send_message.assert_awaited_once()
+        self.assertEqual(metrics.get_metrics()['ratelimit.rejected'], 5)
+
+        mock_monotonic.return_value = 102
+        with self.assertRaises(ApplicationHandlerStop):
+            await ratelimit.check_admission(make_update('Hello'), self.context)
+
+        self.assertEqual(self.context.bot.send_message.await_count, 2)
+
+    def test_backend_is_abstract(self):
+        with self.assertRaises(TypeError):
+            ratelimit.Backend()
+
+    async def test_commands_without_openai_pass(self):
+        for text in ('/start', '/help', '/new', '/unknown'):
+            await ratelimit.check_admission(make_update(text), self.context)
+
+        self.admission.admit.assert_not_called()
+
+    def test_estimate_tokens(self):
+        message = MagicMock()
+
+        message.text = '/img@bot cat'
+        self.assertEqual(
+            ratelimit.estimate_tokens(message),
+            3 + ratelimit.COMMAND_TOKENS['img']
+        )
+
+        message.text = '/help'
+        self.assertIsNone(ratelimit.estimate_tokens(message))
+
+    @override_settings(SUMMARY_CHUNK_TOKENS=100, SUMMARY_MAX_CHUNKS=3)
+    def test_estimate_summary_tokens(self):
+        self.assertEqual(ratelimit.estimate_summary_tokens('a' * 100), 0)
+        self.assertEqual(ratelimit.estimate_summary_tokens('a' * 150), 100)
+        self.assertEqual(ratelimit.estimate_summary_tokens('a' * 1000), 200)
+
+    @override_settings(SUMMARY_CHUNK_TOKENS=100, SUMMARY_MAX_CHUNKS=3)
+    async def test_admit_summary(self):
+        self.admission.charge.return_value = 0
+        update = make_update('/sum url')
+
+        self.assertTrue(
+            await ratelimit.admit_summary(update, self.context, 'a' * 250)
+        )
+        self.admission.charge.assert_awaited_once_with(TELEGRAM_ID, 200)
+
+        self.admission.charge.return_value = 10
+        self.assertFalse(
+            await ratelimit.admit_summary(update, self.context, 'a' * 250)
+        )
+        self.context.bot.send_message.assert_awaited_once()
@@ -0,0 +1,201 @@
+import asyncio
+from datetime import timedelta
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from unittest.mock import AsyncMock, patch
+
+from chats.models import Chat
+from bot.models import Job
+from bot.database import (
+    chat_cache, claim_jobs, create_job, create_message_entry,
+    get_or_create_chat
+)
+from bot.helpers import get_conversation_history
+from bot.tasks import TaskQueue, registry, run_stored_jobs
+
+
+TELEGRAM_ID = 12345
+
+
+class TestTaskQueue(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.queue = TaskQueue(
+            workers=2, max_size=2, max_retries=2, retry_delay=0
+        )
+
+        async def record(value):
+            self.calls.append(value)
+
+        patcher = patch.dict(registry, {'record': record})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_enqueue_runs_in_background(self):
+        await self.queue.enqueue('record', value=1)
+        self.assertEqual(self.calls, [])
+
+        await self.queue.stop()
+        self.assertEqual(self.calls, [1])
+
+    async def test_key_deduplicates(self):
+        await self.queue.enqueue('record', key='a', value=1)
+        await self.queue.enqueue('record', key='a', value=2)
+        await self.queue.stop()
+
+        self.assertEqual(self.calls, [1])
+
+    async def test_retries(self):
+        failing = AsyncMock(side_effect=[ValueError, ValueError, None])
+
+        with patch.dict(registry, {'failing': failing}):
+            await self.queue.enqueue('failing')
+            await self.queue.stop()
+
+        self.assertEqual(failing.await_count, 3)
+        self.assertFalse(await Job.objects.aexists())
+
+    async def test_failed_job_stored(self):
+        failing = AsyncMock(side_effect=ValueError('error'))
+
+        with patch.dict(registry, {'failing': failing}):
+            await self.queue.enqueue('failing', value=1)
+            await self.queue.stop()
+
+        job = await Job.objects.aget()
+        self.assertEqual(failing.await_count, 3)
+        self.assertTrue(job.failed)
+        self.assertEqual(job.payload, {'value': 1})
+        self.assertEqual(job.last_error, "ValueError('error')")
+
+    async def test_concurrency_limit(self):
+        active = []
+        max_active = []
+
+        async def slow():
+            active.append(1)
+            max_active.append(len(active))
+            await asyncio.sleep(0.01)
+            active.pop()
+
+        queue = TaskQueue(workers=2, max_size=10, max_retries=0, retry_delay=0)
+        with patch.dict(registry, {'slow': slow}):
+            for _ in range(6):
+                await queue.enqueue('slow')
+            await queue.stop()
+
+        self.assertEqual(len(max_active), 6)
+        self.assertEqual(max(max_active), 2)
+
+    async def test_full_queue_stores_job(self):
+        release = asyncio.Event()
+
+        async def blocked():
+            await release.wait()
+
+        with patch.dict(registry, {'blocked': blocked}):
+            for _ in range(5):
+                await self.queue.enqueue('blocked')
+            release.set()
+            await self.queue.stop()
+
+        self.assertEqual(await Job.objects.filter(name='blocked').acount(), 1)
+
+    async def test_run_stored_jobs(self):
+        await create_job('record', {'value': 1})
+        await create_job('record', {'value': 2}, delay=60)
+
+        count = await run_stored_jobs()
+
+        self.assertEqual(count, 1)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(await Job.objects.acount(), 1)
+
+    async def test_claim_skips_jobs_taken_by_another_worker(self):
+        first = await create_job('record', {'value': 1})
+        second = await create_job('record', {'value': 2})
+        select_for_update = QuerySet.select_for_update
+
+        def select_and_race(queryset, *args, **kwargs):
+            jobs = list(select_for_update(queryset, *args, **kwargs))
+            Job.objects.filter(pk=first.pk).delete()
+            return jobs
+
+        with patch.object(QuerySet, 'select_for_update', select_and_race):
+            jobs = await claim_jobs(10)
+
+        self.assertEqual([job.pk for job in jobs], [second.pk])
+        self.assertFalse(await Job.objects.aexists())
+
+
+class TestTasks(TestCase):
+    def setUp(self):
+        chat_cache.clear()
+
+    @patch('bot.tasks.get_conversation_topic', return_value='Topic')
+    async def test_generate_chat_topic(self, mock_topic):
+        chat = await get_or_create_chat(TELEGRAM_ID)
+        request = [{'role': 'user', 'content': 'Hello'}]
+
+        await registry['chat_topic'](TELEGRAM_ID, chat.pk, request)
+
+        self.assertEqual(chat.topic, 'Topic')
+        self.assertEqual((await Chat.objects.aget(pk=chat.pk)).topic, 'Topic')
+        self.assertEqual(request, [{'role': 'user', 'content': 'Hello'}])
+
+    @patch('bot.tasks.get_conversation_topic', return_value='Title')
+    @patch('bot.tasks.get_conversation_summary', return_value='Summary')
+    @patch('bot.tasks.get_conversation_history', return_value=[])
+    async def test_generate_chat_summary(self, *mocks):
+        chat = await get_or_create_chat(TELEGRAM_ID)
+
+        with patch('bot.tasks.task_queue.bot') as mock_bot:
+            mock_bot.send_message = AsyncMock()
+            await registry['chat_summary'](TELEGRAM_ID, chat.pk)
+
+        chat = await Chat.objects.aget(pk=chat.pk)
+        self.assertEqual((chat.summary, chat.topic), ('Summary', 'Title'))
+        mock_bot.send_message.assert_awaited_with(
+            chat_id=TELEGRAM_ID, text='Chat saved: Title'
+        )
+
+    @override_settings(MEMORY_RECENT_TOKENS=20, SUMMARY_CHUNK_TOKENS=1000)
+    @patch('bot.tasks.fold_conversation_memory', return_value='Memory')
+    async def test_update_chat_memory(self, mock_fold):
+        chat = await get_or_create_chat(TELEGRAM_ID)
+        start = timezone.now() - timedelta(minutes=10)
+        texts = [
+            await create_message_entry(
+                chat=chat,
+                telegram_id=TELEGRAM_ID,
+                request=f'Request {number}',
+                response=f'Response {number}',
+                request_tokens=5,
+                response_tokens=5,
+                date=start + timedelta(minutes=number),
+            )
+            for number in range(5)
+        ]
+
+        await registry['chat_memory'](TELEGRAM_ID, chat.pk)
+
+        # The last two exchanges fit into the recent tokens
+        folded = mock_fold.await_args.args[1]
+        self.assertEqual([text.pk for text in folded],
+                         [text.pk for text in texts[:3]])
+        self.assertEqual(chat.memory, 'Memory')
+        self.assertEqual(chat.memory_date, texts[2].date)
+
+        request = await get_conversation_history(TELEGRAM_ID, chat)
+        self.assertEqual(request[1]['content'],
+                         'Summary of the earlier conversation: Memory')
+        self.assertEqual(
+            [message['content'] for message in request[2:]],
+            ['Request 3', 'Response 3', 'Request 4', 'Response 4']
+        )
+
+        # The remaining turns are recent, nothing more to fold
+        mock_fold.reset_mock()
+        await registry['chat_memory'](TELEGRAM_ID, chat.pk)
+        mock_fold.assert_not_awaited()
@@ -0,0 +1,49 @@
+from django.test import SimpleTestCase, override_settings
+
+from bot.llm import get_model
+from bot.tokens import (
+    TOKENS_CACHE_MAX_LENGTH, count_tokens, num_tokens_from_message,
+    num_tokens_from_messages, num_tokens_from_string
+)
+
+
+class TestTokens(SimpleTestCase):
+    def test_num_tokens_from_messages(self):
+        messages = [
+            {'role': 'system', 'content': 'You are a helpful assistant.'},
+            {'role': 'user', 'content': 'Hello!', 'name': 'test'},
+        ]
+
+        # 3 per message, 1 for the role, the content and 1 for the name
+        self.assertEqual(num_tokens_from_message(messages[0]), 3 + 1 + 6)
+        self.assertEqual(num_tokens_from_message(messages[1]), 3 + 1 + 2 + 2)
+        # Plus 3 for the reply priming
+        self.assertEqual(num_tokens_from_messages(messages), 10 + 8 + 3)
+
+    def test_model_overhead(self):
+        message = {'role': 'user', 'content': 'Hello!'}
+        content_tokens = num_tokens_from_string('user') + 2
+
+        self.assertEqual(
+            num_tokens_from_message(message, get_model('gpt-3.5-turbo-0301')),
+            content_tokens + 4
+        )
+
+    def test_only_short_strings_memoized(self):
+        count_tokens.cache_clear()
+
+        self.assertEqual(num_tokens_from_string('Hello!'), 2)
+        self.assertEqual(
+            num_tokens_from_string(' word' * TOKENS_CACHE_MAX_LENGTH),
+            TOKENS_CACHE_MAX_LENGTH
+        )
+
+        self.assertEqual(count_tokens.cache_info().currsize, 1)
+
+    @override_settings(OPENAI_MODEL='gpt-4')
+    def test_default_model(self):
+        self.assertEqual(get_model().context_tokens, 8192)
+
+    def test_cost(self):
+        model = get_model('gpt-3.5-turbo')
+        self.assertEqual(str(model.cost(1000, 500)), '0.0025')
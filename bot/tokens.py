@@ -0,0 +1,164 @@
+import tiktoken
+
+from functools import lru_cache
+
+from bot.llm import get_model
+
+
+TOKENS_CACHE_SIZE = 10000
+# Only strings up to this many characters, such as chat messages, are
+# memoized; documents would be kept alive by the cache
+TOKENS_CACHE_MAX_LENGTH = 2000
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "cl100k_base"):
+    """
+    Returns the tiktoken encoding with the given name,
+    loading it only once per process.
+
+    :param name: The name of the encoding.
+    :return: A tiktoken Encoding.
+    """
+
+    return tiktoken.get_encoding(name)
+
+
+def num_tokens_from_string(string: str, encoding="cl100k_base") -> int:
+    """
+    Returns the number of tokens in a text string. Results for strings
+    up to `TOKENS_CACHE_MAX_LENGTH` characters are memoized, so repeated
+    messages are tokenized once.
+
+    :param string: A string to be tokenized.
+    :param encoding: The name of the encoding.
+    :return: Number of tokens in the string.
+    """
+
+    if len(string) <= TOKENS_CACHE_MAX_LENGTH:
+        return count_tokens(string, encoding)
+
+    return count_tokens.__wrapped__(string, encoding)
+
+
+@lru_cache(maxsize=TOKENS_CACHE_SIZE)
+def count_tokens(string: str, encoding: str) -> int:
+    """
+    Returns the number of tokens in a text string, memoized.
+    """
+
+    return len(get_encoding(encoding).encode(string))
+
+
+def num_tokens_from_message(message, model=None) -> int:
+    """
+    Returns the number of tokens a chat message takes in a prompt,
+    including the chat format overhead.
+
+    :param message: A message dictionary.
+    :param model: The Model, `OPENAI_MODEL` by default.
+    :return: Number of tokens in the message.
+    """
+
+    model = model or get_model()
+
+    num_tokens = model.tokens_per_message
+    for key, value in message.items():
+        num_tokens += num_tokens_from_string(value, model.encoding)
+        if key == 'name':
+            num_tokens += model.tokens_per_name
+
+    return num_tokens
+
+
+def num_tokens_from_messages(messages, model=None) -> int:
+    """
+    Returns the number of prompt tokens of a list of chat messages,
+    including the chat format overhead and the reply priming.
+
+    :param messages: A list of message dictionaries.
+    :param model: The Model, `OPENAI_MODEL` by default.
+    :return: Number of tokens in the messages.
+    """
+
+    model = model or get_model()
+
+    return model.reply_tokens + sum(
+        num_tokens_from_message(message, model) for message in messages
+    )
+
+
+def num_tokens_from_text_entry(text) -> int:
+    """
+    Returns the number of tokens in the request and response of a Text
+    instance, using the counts stored at write time when available.
+
+    :param text: A Text instance.
+    :return: Number of tokens in the request and response.
+    """
+
+    request_tokens = text.request_tokens
+    if request_tokens is None:
+        request_tokens = num_tokens_from_string(text.request)
+
+    response_tokens = text.response_tokens
+    if response_tokens is None:
+        response_tokens = num_tokens_from_string(text.response)
+
+    return request_tokens + response_tokens
+
+
+def split_tokens(text: str, max_tokens: int) -> list:
+    """
+    Splits a text into pieces of exactly `max_tokens` tokens
+    (the last one may be shorter), regardless of its structure.
+
+    :param text: The text to split.
+    :param max_tokens: The maximum number of tokens in a piece.
+    :return: A list of strings.
+    """
+
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+
+    return [
+        encoding.decode(tokens[start:start + max_tokens])
+        for start in range(0, len(tokens), max_tokens)
+    ]
+
+
+def split_into_chunks(text: str, max_tokens: int) -> list:
+    """
+    Splits a text into chunks of at most `max_tokens` tokens,
+    keeping paragraphs together where possible.
+
+    :param text: The text to split.
+    :param max_tokens: The maximum number of tokens in a chunk.
+    :return: A list of strings.
+    """
+
+    encoding = get_encoding()
+    chunks = []
+    paragraphs = []
+    chunk_tokens = 0
+
+    for paragraph in text.split('\n'):
+        # One more token for the line break joining the paragraphs
+        tokens = len(encoding.encode(paragraph)) + 1
+
+        if paragraphs and chunk_tokens + tokens > max_tokens:
+            chunks.append('\n'.join(paragraphs))
+            paragraphs = []
+            chunk_tokens = 0
+
+        if tokens > max_tokens:
+            chunks.extend(split_tokens(paragraph, max_tokens))
+            continue
+
+        paragraphs.append(paragraph)
+        chunk_tokens += tokens
+
+    if paragraphs:
+        chunks.append('\n'.join(paragraphs))
+
+    return chunks
@@ -1,9 +1,21 @@
+from django.conf import settings
 from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
 
-from .views import TelegramBotWebhookView
+from .views import (
+    TelegramBotWebhookView, TelegramBotWebhookAsyncView,
+    TelegramBotWebhookDispatchView, MetricsView
+)
 
 
+if settings.TELEGRAM_WEBHOOK_DISPATCH:
+    webhook_view = TelegramBotWebhookDispatchView
+elif settings.TELEGRAM_WEBHOOK_ASYNC:
+    webhook_view = TelegramBotWebhookAsyncView
+else:
+    webhook_view = TelegramBotWebhookView
+
 urlpatterns = [
-    path('webhook/', csrf_exempt(TelegramBotWebhookView.as_view())),
+    path('webhook/', csrf_exempt(webhook_view.as_view())),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
@@ -1,21 +1,105 @@
+import hmac
 import json
-import asyncio
 
+from django.conf import settings
+from django.db import transaction
 from django.http import JsonResponse
 from django.views import View
 
-from .bot import run
+from . import dedup, dispatch, metrics
+from .bot import process, enqueue
 
 
 class TelegramBotWebhookView(View):
     def post(self, request, *args, **kwargs):
         """
         Processes an incoming update from the Telegram webhook and runs the bot.
+        Updates redelivered by Telegram are acknowledged and dropped.
+        An update that fails to be handed to the bot is forgotten,
+        so Telegram's redelivery of it is processed.
 
         :param request: The incoming HTTP request containing the update
         """
 
         data = json.loads(request.body)
-        asyncio.run(run(data))
+        if dedup.is_duplicate(data):
+            return JsonResponse({'message': 'OK'}, status=200)
+
+        try:
+            process(data)
+        except Exception:
+            dedup.forget(data)
+            raise
 
         return JsonResponse({'message': 'OK'}, status=200)
+
+
+class TelegramBotWebhookAsyncView(View):
+    async def post(self, request, *args, **kwargs):
+        """
+        Acknowledges an incoming update from the Telegram webhook
+        immediately and leaves it to the bot to process in the background.
+        An update that fails to be queued is forgotten, see
+        `TelegramBotWebhookView`.
+
+        :param request: The incoming HTTP request containing the update
+        """
+
+        data = json.loads(request.body)
+        if await dedup.ais_duplicate(data):
+            return JsonResponse({'message': 'OK'}, status=200)
+
+        try:
+            await enqueue(data)
+        except Exception:
+            await dedup.aforget(data)
+            raise
+
+        return JsonResponse({'message': 'OK'}, status=200)
+
+
+class TelegramBotWebhookDispatchView(View):
+    def post(self, request, *args, **kwargs):
+        """
+        Queues an incoming update from the Telegram webhook for
+        the dispatcher worker owning its chat's partition. The update is
+        marked as received and queued in one transaction.
+
+        :param request: The incoming HTTP request containing the update
+        """
+
+        data = json.loads(request.body)
+
+        try:
+            with transaction.atomic():
+                if not dedup.is_duplicate(data):
+                    dispatch.put_update(data)
+        except Exception:
+            dedup.forget(data)
+            raise
+
+        return JsonResponse({'message': 'OK'}, status=200)
+
+
+class MetricsView(View):
+    def get(self, request, *args, **kwargs):
+        """
+        Returns the bot's in-process counters and gauges
+        to staff users and to requests bearing `METRICS_TOKEN`.
+        """
+
+        if not self.is_authorized(request):
+            return JsonResponse({'message': 'Forbidden'}, status=403)
+
+        return JsonResponse(metrics.get_metrics())
+
+    def is_authorized(self, request):
+        if request.user.is_staff:
+            return True
+
+        token = settings.METRICS_TOKEN
+        header = request.headers.get('Authorization', '')
+
+        return bool(token) and hmac.compare_digest(
+            header.encode(), f'Bearer {token}'.encode()
+        )
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_text_content_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='text',
+            name='request_tokens',
+            field=models.IntegerField(null=True, verbose_name='Request tokens'),
+        ),
+        migrations.AddField(
+            model_name='text',
+            name='response_tokens',
+            field=models.IntegerField(null=True, verbose_name='Response tokens'),
+        ),
+    ]
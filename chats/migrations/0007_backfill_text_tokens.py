@@ -0,0 +1,44 @@
+import tiktoken
+
+from django.db import migrations
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_text_tokens(apps, schema_editor):
+    Text = apps.get_model('chats', 'Text')
+    texts = Text.objects.filter(
+        request_tokens__isnull=True
+    ).only('request', 'response').order_by('pk')
+
+    if not texts.exists():
+        return
+
+    encoding = tiktoken.get_encoding('cl100k_base')
+
+    last_pk = 0
+    while True:
+        batch = list(texts.filter(pk__gt=last_pk)[:BATCH_SIZE])
+        if not batch:
+            break
+
+        for text in batch:
+            text.request_tokens = len(encoding.encode(text.request))
+            text.response_tokens = len(encoding.encode(text.response))
+
+        Text.objects.bulk_update(batch, ['request_tokens', 'response_tokens'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0006_text_request_tokens_text_response_tokens'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_text_tokens, migrations.RunPython.noop
+        ),
+    ]
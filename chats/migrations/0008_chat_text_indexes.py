@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_backfill_text_tokens'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['telegram_id', 'creation_date'], name='chat_telegram_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='text',
+            index=models.Index(fields=['telegram_id', 'chat', 'content_type', 'date'], name='text_user_chat_type_date_idx'),
+        ),
+    ]
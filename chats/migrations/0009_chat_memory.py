@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0008_chat_text_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='memory',
+            field=models.TextField(blank=True, verbose_name='Memory'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='memory_date',
+            field=models.DateTimeField(null=True, verbose_name='Memory date'),
+        ),
+    ]
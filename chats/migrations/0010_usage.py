@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0009_chat_memory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Usage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('telegram_id', models.CharField(max_length=25, verbose_name='Telegram user ID')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('kind', models.CharField(choices=[('chat', 'Chat'), ('retry', 'Retry'), ('topic', 'Topic'), ('summary', 'Summary'), ('memory', 'Memory'), ('sum', 'Article summary'), ('img', 'Image')], max_length=10, verbose_name='Kind')),
+                ('requests', models.IntegerField(default=0, verbose_name='Requests')),
+                ('prompt_tokens', models.IntegerField(default=0, verbose_name='Prompt tokens')),
+                ('completion_tokens', models.IntegerField(default=0, verbose_name='Completion tokens')),
+                ('images', models.IntegerField(default=0, verbose_name='Images')),
+                ('cost', models.DecimalField(decimal_places=6, default=0, max_digits=12, verbose_name='Cost')),
+            ],
+            options={
+                'verbose_name': 'Usage',
+                'verbose_name_plural': 'Usage',
+            },
+        ),
+        migrations.AddField(
+            model_name='text',
+            name='cost',
+            field=models.DecimalField(decimal_places=6, max_digits=12, null=True, verbose_name='Cost'),
+        ),
+        migrations.AddConstraint(
+            model_name='usage',
+            constraint=models.UniqueConstraint(fields=('telegram_id', 'date', 'kind'), name='usage_user_date_kind_uniq'),
+        ),
+    ]
@@ -17,6 +17,14 @@ class Chat(models.Model):
         verbose_name='Summary',
         blank=True
     )
+    memory = models.TextField(
+        verbose_name='Memory',
+        blank=True
+    )
+    memory_date = models.DateTimeField(
+        null=True,
+        verbose_name='Memory date'
+    )
     creation_date = models.DateTimeField(
         default=timezone.now,
         verbose_name='Creation date'
@@ -32,6 +40,12 @@ class Chat(models.Model):
     class Meta:
         verbose_name = 'Chat'
         verbose_name_plural = 'Chats'
+        indexes = [
+            models.Index(
+                fields=['telegram_id', 'creation_date'],
+                name='chat_telegram_created_idx'
+            ),
+        ]
 
 
 class Text(models.Model):
@@ -87,6 +101,20 @@ class Text(models.Model):
         verbose_name='Total tokens',
         null=True
     )
+    request_tokens = models.IntegerField(
+        verbose_name='Request tokens',
+        null=True
+    )
+    response_tokens = models.IntegerField(
+        verbose_name='Response tokens',
+        null=True
+    )
+    cost = models.DecimalField(
+        max_digits=12,
+        decimal_places=6,
+        null=True,
+        verbose_name='Cost'
+    )
 
     def __str__(self):
         return f"{self.request} - {self.response}"
@@ -94,3 +122,69 @@ class Text(models.Model):
     class Meta:
         verbose_name = 'Text'
         verbose_name_plural = 'Texts'
+        indexes = [
+            models.Index(
+                fields=['telegram_id', 'chat', 'content_type', 'date'],
+                name='text_user_chat_type_date_idx'
+            ),
+        ]
+
+
+class Usage(models.Model):
+    KIND_CHOICES = [
+        ('chat', 'Chat'),
+        ('retry', 'Retry'),
+        ('topic', 'Topic'),
+        ('summary', 'Summary'),
+        ('memory', 'Memory'),
+        ('sum', 'Article summary'),
+        ('img', 'Image'),
+    ]
+
+    telegram_id = models.CharField(
+        max_length=25,
+        verbose_name='Telegram user ID'
+    )
+    date = models.DateField(
+        verbose_name='Date'
+    )
+    kind = models.CharField(
+        max_length=10,
+        choices=KIND_CHOICES,
+        verbose_name='Kind'
+    )
+    requests = models.IntegerField(
+        default=0,
+        verbose_name='Requests'
+    )
+    prompt_tokens = models.IntegerField(
+        default=0,
+        verbose_name='Prompt tokens'
+    )
+    completion_tokens = models.IntegerField(
+        default=0,
+        verbose_name='Completion tokens'
+    )
+    images = models.IntegerField(
+        default=0,
+        verbose_name='Images'
+    )
+    cost = models.DecimalField(
+        max_digits=12,
+        decimal_places=6,
+        default=0,
+        verbose_name='Cost'
+    )
+
+    def __str__(self):
+        return f"{self.telegram_id} - {self.date} - {self.kind}"
+
+    class Meta:
+        verbose_name = 'Usage'
+        verbose_name_plural = 'Usage'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['telegram_id', 'date', 'kind'],
+                name='usage_user_date_kind_uniq'
+            ),
+        ]
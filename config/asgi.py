@@ -4,4 +4,29 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """
+    Serves HTTP requests with Django and handles the lifespan protocol,
+    which Django doesn't support, so that the bot started by the async
+    webhook is drained and stopped when the server shuts down.
+    """
+
+    if scope['type'] != 'lifespan':
+        return await django_application(scope, receive, send)
+
+    # The bot modules use the models, so they are imported once Django
+    # is set up
+    from bot.bot import stop
+
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -11,7 +11,111 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 # TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+# Serve the webhook with the async view (requires running under ASGI)
+TELEGRAM_WEBHOOK_ASYNC = os.getenv('TELEGRAM_WEBHOOK_ASYNC', 'False') == 'True'
+# Queue webhook updates for the dispatcher workers (run_dispatcher)
+TELEGRAM_WEBHOOK_DISPATCH = (
+    os.getenv('TELEGRAM_WEBHOOK_DISPATCH', 'False') == 'True'
+)
+# Webhook updates redelivered by Telegram are dropped by their update_id,
+# remembered in memory and in the ReceivedUpdate table for the TTL (seconds)
+WEBHOOK_DEDUPLICATE = os.getenv('WEBHOOK_DEDUPLICATE', 'True') == 'True'
+WEBHOOK_DEDUP_CACHE_SIZE = int(os.getenv('WEBHOOK_DEDUP_CACHE_SIZE', 10000))
+WEBHOOK_DEDUP_TTL = int(os.getenv('WEBHOOK_DEDUP_TTL', 24 * 60 * 60))
+# Dispatcher: updates are partitioned by chat, each worker process owns
+# a share of the partitions and processes each partition in order
+DISPATCH_QUEUE = os.getenv('DISPATCH_QUEUE', 'bot.dispatch.DatabaseQueue')
+DISPATCH_PARTITIONS = int(os.getenv('DISPATCH_PARTITIONS', 64))
+DISPATCH_PROCESSES = int(os.getenv('DISPATCH_PROCESSES', 4))
+DISPATCH_BATCH_SIZE = int(os.getenv('DISPATCH_BATCH_SIZE', 100))
+DISPATCH_POLL_INTERVAL = float(os.getenv('DISPATCH_POLL_INTERVAL', 0.5))
+# Maximum number of updates processed concurrently by the application
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', 256))
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+# Chat model (see bot.llm.MODELS) and the tokens reserved for its reply
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+OPENAI_MAX_TOKENS = int(os.getenv('OPENAI_MAX_TOKENS', 1000))
+# Timeouts (in seconds) and connection pool size of the OpenAI client
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 10))
+OPENAI_REQUEST_TIMEOUT = float(os.getenv('OPENAI_REQUEST_TIMEOUT', 60))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 100))
+# Retries of failed OpenAI requests within the deadline of a call (seconds)
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 3))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv('OPENAI_RETRY_BASE_DELAY', 1))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv('OPENAI_RETRY_MAX_DELAY', 20))
+OPENAI_DEADLINE = float(os.getenv('OPENAI_DEADLINE', 90))
+# Circuit breaker: failures in a row to open it, seconds to stay open
+OPENAI_BREAKER_THRESHOLD = int(os.getenv('OPENAI_BREAKER_THRESHOLD', 5))
+OPENAI_BREAKER_RESET_TIMEOUT = float(
+    os.getenv('OPENAI_BREAKER_RESET_TIMEOUT', 30)
+)
+# Cache of responses to identical chat completion requests
+RESPONSE_CACHE_ENABLED = (
+    os.getenv('RESPONSE_CACHE_ENABLED', 'False') == 'True'
+)
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1000))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600))
+# Stream chat answers by progressively editing a single Telegram message
+OPENAI_STREAM = os.getenv('OPENAI_STREAM', 'False') == 'True'
+# Minimum interval (in seconds) between edits of a streamed message
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1))
+# Merge messages sent while the previous answer is being generated
+# (or within the window, in seconds) into a single request
+CHAT_MERGE_MESSAGES = os.getenv('CHAT_MERGE_MESSAGES', 'False') == 'True'
+CHAT_MERGE_WINDOW = float(os.getenv('CHAT_MERGE_WINDOW', 1))
+# In-process cache of each user's current chat. Changes made by the same
+# process (/new, update_chat, deleting the chat) update it right away;
+# changes made by other processes (other WSGI workers, run_jobs) are seen
+# once the entry expires after the TTL (in seconds). 'make start' serves
+# a chat from several workers, so it shortens the TTL to a few seconds
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', 10000))
+CHAT_CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', 10 * 60))
+# Bearer token granting access to /bot/metrics/ besides staff users
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Write-behind buffer: exchanges are written in bulk once this many are
+# collected or after the interval (in seconds), and on shutdown.
+# Unflushed exchanges are seen only by the process holding them, so every
+# chat must be served by one process: the polling bot, the dispatcher or
+# a single ASGI worker, not several WSGI workers ('make start')
+WRITE_BUFFER_ENABLED = os.getenv('WRITE_BUFFER_ENABLED', 'False') == 'True'
+WRITE_BUFFER_SIZE = int(os.getenv('WRITE_BUFFER_SIZE', 100))
+WRITE_BUFFER_INTERVAL = float(os.getenv('WRITE_BUFFER_INTERVAL', 0.5))
+# Background tasks (topic and summary generation)
+TASK_WORKERS = int(os.getenv('TASK_WORKERS', 4))
+TASK_QUEUE_SIZE = int(os.getenv('TASK_QUEUE_SIZE', 1000))
+TASK_MAX_RETRIES = int(os.getenv('TASK_MAX_RETRIES', 3))
+TASK_RETRY_DELAY = float(os.getenv('TASK_RETRY_DELAY', 1))
+TASK_SHUTDOWN_TIMEOUT = float(os.getenv('TASK_SHUTDOWN_TIMEOUT', 30))
+# Article fetching for /sum
+ARTICLE_FETCH_TIMEOUT = float(os.getenv('ARTICLE_FETCH_TIMEOUT', 15))
+ARTICLE_MAX_SIZE = int(os.getenv('ARTICLE_MAX_SIZE', 5 * 1024 * 1024))
+ARTICLE_MAX_CONNECTIONS = int(os.getenv('ARTICLE_MAX_CONNECTIONS', 20))
+ARTICLE_CACHE_SIZE = int(os.getenv('ARTICLE_CACHE_SIZE', 1000))
+ARTICLE_CACHE_TTL = float(os.getenv('ARTICLE_CACHE_TTL', 24 * 60 * 60))
+# Long articles are summarized in chunks of at most this many tokens
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', 3000))
+SUMMARY_CONCURRENCY = int(os.getenv('SUMMARY_CONCURRENCY', 4))
+# Only the beginning of longer articles, in this many chunks, is summarized
+SUMMARY_MAX_CHUNKS = int(os.getenv('SUMMARY_MAX_CHUNKS', 5))
+# Rolling memory: once a prompt exceeds the threshold, older turns are
+# folded into a summary, keeping the most recent tokens of the chat as is
+MEMORY_ENABLED = os.getenv('MEMORY_ENABLED', 'False') == 'True'
+MEMORY_THRESHOLD_TOKENS = int(os.getenv('MEMORY_THRESHOLD_TOKENS', 2000))
+MEMORY_RECENT_TOKENS = int(os.getenv('MEMORY_RECENT_TOKENS', 1000))
+# Rate limits per minute, counted in requests and in estimated tokens
+RATE_LIMIT_USER_REQUESTS = int(os.getenv('RATE_LIMIT_USER_REQUESTS', 10))
+RATE_LIMIT_USER_TOKENS = int(os.getenv('RATE_LIMIT_USER_TOKENS', 20000))
+RATE_LIMIT_GLOBAL_REQUESTS = int(os.getenv('RATE_LIMIT_GLOBAL_REQUESTS', 3000))
+RATE_LIMIT_GLOBAL_TOKENS = int(os.getenv('RATE_LIMIT_GLOBAL_TOKENS', 90000))
+# Tokens expected on top of the message text
+RATE_LIMIT_CHAT_TOKENS = int(os.getenv('RATE_LIMIT_CHAT_TOKENS', 1000))
+RATE_LIMIT_IMAGE_TOKENS = int(os.getenv('RATE_LIMIT_IMAGE_TOKENS', 1000))
+# Bucket storage: bot.ratelimit.MemoryBackend (per process)
+# or bot.ratelimit.CacheBackend (shared through the Django cache)
+RATE_LIMIT_BACKEND = os.getenv(
+    'RATE_LIMIT_BACKEND', 'bot.ratelimit.MemoryBackend'
+)
+RATE_LIMIT_CACHE = os.getenv('RATE_LIMIT_CACHE', 'default')
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv('SECRET_KEY')
@@ -82,12 +186,49 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default, PostgreSQL (psycopg) with DATABASE_ENGINE=postgresql
+DATABASE_ENGINE = os.getenv('DATABASE_ENGINE', 'sqlite')
+# Seconds a connection is kept open for reuse by the following requests
+DATABASE_CONN_MAX_AGE = int(os.getenv('DATABASE_CONN_MAX_AGE', 600))
+# SQLite: seconds to wait for a lock, fsync level in WAL mode
+# and bytes of the database file read through memory mapping
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 20))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'chatgpt'),
+            'USER': os.getenv('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'config.sqlite3',
+            'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            # SQLite only: PostgreSQL locks rows, not the whole database,
+            # and keeps its default transactions
+            'OPTIONS': {
+                'timeout': SQLITE_BUSY_TIMEOUT,
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode = WAL;'
+                    f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS};'
+                    f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE};'
+                ),
+            },
+        }
     }
-}
 
 
 # Password validation
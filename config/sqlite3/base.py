@@ -0,0 +1,38 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    The SQLite backend with the `init_command` and `transaction_mode`
+    options of Django 5.1.
+
+    `init_command` holds the statements (separated by semicolons) run on
+    every new connection, such as PRAGMAs. With `transaction_mode` set to
+    IMMEDIATE, transactions take the write lock when they begin, so
+    concurrent writers wait for the busy timeout instead of failing
+    with "database is locked" when a read turns into a write.
+
+    Both options are specific to this backend and are set for SQLite
+    only; the PostgreSQL configuration doesn't use them.
+    """
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.init_command = params.pop('init_command', '')
+        self.transaction_mode = params.pop('transaction_mode', None)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+
+        for statement in self.init_command.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f'BEGIN {self.transaction_mode}')